@@ -0,0 +1,158 @@
+"""Export an index as Vertex AI batch update files.
+
+The rows are read from a memory map and written in shards of ``shard_rows``
+datapoints by several processes, as json lines (``{"id": ..., "embedding": [...]}``)
+or avro.  Ids to remove are written in the ``delete`` sub directory.  The output
+directory can then be uploaded to the bucket and given to the index as its
+``contentsDeltaUri``.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+
+from . import core
+
+
+AVRO_SCHEMA = {
+    "type": "record",
+    "name": "FeatureVector",
+    "fields": [
+        {"name": "id", "type": "string"},
+        {"name": "embedding", "type": {"type": "array", "items": "float"}}
+    ]
+}
+
+
+def _write_shard(
+    datapoints_path: str,
+    total: int,
+    rows: list[int],
+    ids: list[str],
+    path: str,
+    fmt: str
+) -> int:
+    datapoints = np.memmap(datapoints_path, dtype=np.float32, mode='r', shape=(total, core.DIMENSION))
+    tmp = f"{path}.tmp"
+    if fmt == "avro":
+        import fastavro
+        records = (
+            {"id": _id, "embedding": datapoints[row].tolist()}
+            for _id, row in zip(ids, rows)
+        )
+        with open(tmp, mode='wb') as f:
+            fastavro.writer(f, fastavro.parse_schema(AVRO_SCHEMA), records)
+    else:
+        with open(tmp, mode='w') as f:
+            for _id, row in zip(ids, rows):
+                f.write(json.dumps({"id": _id, "embedding": datapoints[row].tolist()}))
+                f.write("\n")
+    os.replace(tmp, path)
+    return len(rows)
+
+
+def select_rows(
+    ids: list[str],
+    datapoints_path: str,
+    since_id: str | None = None,
+    since_manifest: dict[str, str] | None = None
+) -> tuple[list[int], list[str], dict[str, str] | None]:
+    """Return the rows to export, the ids to delete and, when comparing against a
+    sync manifest, the hash of every local row."""
+    if since_id is not None:
+        try:
+            start = ids.index(since_id) + 1
+        except ValueError:
+            raise ValueError(f"{since_id} is not in the index.") from None
+        return list(range(start, len(ids))), [], None
+
+    if since_manifest is not None:
+        from .remote_sync import compute_diff
+        datapoints = np.memmap(datapoints_path, dtype=np.float32, mode='r', shape=(len(ids), core.DIMENSION))
+        return compute_diff(ids, datapoints, since_manifest)
+
+    return list(range(len(ids))), [], None
+
+
+def export(
+    ids: list[str],
+    datapoints_path: str,
+    output_dir: str,
+    rows: list[int] | None = None,
+    deleted: list[str] | None = None,
+    shard_rows: int = 10000,
+    workers: int = 4,
+    fmt: str = "json"
+) -> list[Path]:
+    """Write the shards (and delete file) in output_dir.  Return the written files."""
+    if fmt not in ("json", "avro"):
+        raise ValueError(f"Invalid format: {fmt}")
+    if fmt == "avro":
+        # fail before starting the workers when the optional dependency is missing
+        import fastavro  # noqa: F401
+
+    output = Path(output_dir)
+    output.mkdir(parents=True, exist_ok=True)
+    # the files of a previous export would be read by the batch update too
+    for path in [*output.glob("shard-*"), output.joinpath("delete", "delete.txt")]:
+        path.unlink(missing_ok=True)
+    rows = list(range(len(ids))) if rows is None else rows
+    extension = "avro" if fmt == "avro" else "json"
+
+    jobs = []
+    for shard, start in enumerate(range(0, len(rows), shard_rows)):
+        shard_rows_ = rows[start:start + shard_rows]
+        path = output.joinpath(f"shard-{shard:05d}.{extension}")
+        jobs.append((datapoints_path, len(ids), shard_rows_, [ids[x] for x in shard_rows_], str(path), fmt))
+
+    written = []
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_write_shard, *job) for job in jobs]
+        done = 0
+        for job, future in zip(jobs, futures):
+            done += future.result()
+            written.append(Path(job[4]))
+            print(f"{done}/{len(rows)} datapoints exported", flush=True)
+
+    if deleted:
+        delete_dir = output.joinpath("delete")
+        delete_dir.mkdir(exist_ok=True)
+        path = delete_dir.joinpath("delete.txt")
+        path.write_text("".join(f"{_id}\n" for _id in deleted))
+        written.append(path)
+    return written
+
+
+def upload(files: list[Path], output_dir: str, prefix: str, bucket=None, workers: int = 4) -> str:
+    """Upload the exported files under prefix.  Return the gs:// uri of the directory."""
+    from . import transfer
+
+    bucket = bucket or core.get_bucket()
+    root = Path(output_dir)
+
+    def send(path: Path):
+        transfer.upload_file(bucket, str(path), f"{prefix}/{path.relative_to(root).as_posix()}")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(send, files))
+    return f"gs://{bucket.name}/{prefix}"
+
+
+def apply(client, index: str, contents_uri: str, complete_overwrite: bool = False):
+    """Ask Vertex AI to update the index from the uploaded files."""
+    from google.cloud.aiplatform_v1 import Index
+    from google.protobuf import field_mask_pb2, struct_pb2
+
+    metadata = struct_pb2.Value()
+    metadata.struct_value.update({
+        "contentsDeltaUri": contents_uri,
+        "isCompleteOverwrite": complete_overwrite
+    })
+    operation = client.update_index(
+        index=Index(name=index, metadata=metadata),
+        update_mask=field_mask_pb2.FieldMask(paths=["metadata"])
+    )
+    print(f"Index update started: {operation.operation.name}")
+    return operation
@@ -0,0 +1,100 @@
+"""Send a request to a running ``serve`` instance.
+
+The commands that need the model or the index forward their work to ``serve``
+when one is reachable, instead of loading tensorflow and the index themselves.
+The instance is found with ``PYCOLLECTOR_SOCKET`` (a unix domain socket path,
+tried first) and ``PYCOLLECTOR_PORT`` (default to 19999).
+"""
+from typing import Any
+import json
+import os
+import socket
+import time
+
+
+DEFAULT_PORT = int(os.environ.get("PYCOLLECTOR_PORT", 19999))
+
+DEFAULT_SOCKET = os.environ.get("PYCOLLECTOR_SOCKET", "")
+
+# seconds allowed to reach the server before running in process
+CONNECT_TIMEOUT = 0.2
+
+# seconds allowed for the server to answer, a stalled server doesn't block the command forever
+READ_TIMEOUT = float(os.environ.get("PYCOLLECTOR_READ_TIMEOUT", 300))
+
+# retries of a request rejected because the server is busy
+BUSY_RETRIES = 5
+
+
+class ServeError(Exception):
+    pass
+
+
+def connect(port: int = DEFAULT_PORT, unix: str = DEFAULT_SOCKET) -> socket.socket | None:
+    """Connect to the server, None if none is running."""
+    if unix and os.path.exists(unix):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(unix)
+            sock.settimeout(READ_TIMEOUT)
+            return sock
+        except OSError:
+            sock.close()
+
+    try:
+        sock = socket.create_connection(("127.0.0.1", port), timeout=CONNECT_TIMEOUT)
+    except OSError:
+        return None
+    sock.settimeout(READ_TIMEOUT)
+    return sock
+
+
+def send(sock: socket.socket, request: dict[str, Any]) -> dict[str, Any]:
+    """Send the request on a connected socket and return the response, busy and
+    error answers included.
+
+    Raise ``ServeError`` when the connection fails, times out or the response
+    can't be read.
+    """
+    from . import shm_transport
+
+    is_unix = sock.family == socket.AF_UNIX
+    if is_unix:
+        # same host, large responses can come through shared memory
+        request = {**request, "response": "shm"}
+
+    try:
+        with sock:
+            sock.sendall(json.dumps(request).encode())
+            data = b""
+            while chunk := sock.recv(65536):
+                data += chunk
+
+        response = json.loads(data)
+        return shm_transport.decode(response) if is_unix else response
+    except (OSError, ValueError) as e:
+        raise ServeError(f"{type(e).__name__}: {e}") from e
+
+
+def request(request: dict[str, Any], port: int = DEFAULT_PORT, unix: str = DEFAULT_SOCKET) -> dict[str, Any] | None:
+    """Send the request and return the response, None when no server is running.
+
+    Raise ``ServeError`` when the server answers with an error or can't be read.
+    """
+    for _ in range(BUSY_RETRIES + 1):
+        if (sock := connect(port, unix)) is None:
+            return None
+        response = send(sock, request)
+        if response.get("error") == "Server busy":
+            time.sleep(response.get("retry_after", 0.1))
+            continue
+        if error := response.get("error"):
+            raise ServeError(error)
+        return response
+    raise ServeError("Server busy")
+
+
+def file_argument(file: str) -> str:
+    """The server doesn't run in our directory, local files are sent as absolute paths."""
+    return os.path.abspath(file) if os.path.exists(file) else file
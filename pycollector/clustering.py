@@ -11,13 +11,60 @@ if TYPE_CHECKING:
 from . import core
 
 
+# number of datapoints used to fit the projection
+PCA_SAMPLE = 20000
+
+# rows processed at once when projecting or computing distances
+CHUNK_ROWS = 8192
+
+
+def _project(datapoints: np.ndarray, seed: int = 0) -> np.ndarray:
+    """Fit a randomized PCA once on a sample and project every datapoint, chunk by chunk.
+
+    When the datapoints are writable, the projection is written over their memory:
+    a projected row takes less than half a row, so the rows of a chunk are always
+    read before they are overwritten and the original matrix is never copied.
+    """
+    dimension = min(datapoints.shape[0], int(datapoints.shape[1] / 2))
+    print(f"Appling PCA to reduce dimension from {datapoints.shape[1]} to {dimension}")
+
+    rng = np.random.default_rng(seed)
+    count = datapoints.shape[0]
+    sample = np.sort(rng.choice(count, size=min(count, PCA_SAMPLE), replace=False))
+    pca = PCA(dimension, svd_solver="randomized", random_state=seed)
+    pca.fit(datapoints[sample])
+
+    if datapoints.dtype == np.float32 and datapoints.flags.writeable and datapoints.flags.c_contiguous:
+        projected = datapoints.reshape(-1)[:count * dimension].reshape(count, dimension)
+    else:
+        projected = np.empty((count, dimension), dtype=np.float32)
+    for start in range(0, count, CHUNK_ROWS):
+        chunk = pca.transform(datapoints[start:start + CHUNK_ROWS])
+        projected[start:start + len(chunk)] = chunk
+    return projected
+
+
 def _cluster(
     datapoints: np.ndarray,
+    rows: np.ndarray,
     num_cluster: int
 ) -> tuple[np.ndarray, np.ndarray]:
+    """Cluster the given rows, return the cluster of each row and its distance to
+    the centroid of that cluster.
+
+    Every row is clustered at the top level, the matrix is used as is.  The subsets
+    of the lower levels are the members of one cluster, they are copied once.
+    """
+    subset = datapoints if len(rows) == datapoints.shape[0] else datapoints[rows]
     kmean = KMeans(n_clusters=num_cluster)
-    clusterings = kmean.fit_predict(datapoints)
-    distances = kmean.transform(datapoints)
+    clusterings = kmean.fit_predict(subset)
+
+    centers = kmean.cluster_centers_.astype(np.float32)
+    distances = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), CHUNK_ROWS):
+        chunk = slice(start, start + CHUNK_ROWS)
+        diff = subset[chunk] - centers[clusterings[chunk]]
+        distances[chunk] = np.sqrt(np.einsum("ij,ij->i", diff, diff))
     return clusterings, distances
 
 
@@ -26,22 +73,20 @@ def _split_cluster(
     datapoints: np.ndarray,
     indexes: list[str],
     size: int,
-    dept: int = 1,
-    data_reduction=False
+    rows: np.ndarray | None = None,
+    dept: int = 1
 ) -> int:
-    cluster_count = round(datapoints.shape[0] / size)
+    """Cluster ``datapoints[rows]``, the subsets are passed down as row numbers."""
+    if rows is None:
+        rows = np.arange(datapoints.shape[0])
+
+    cluster_count = round(len(rows) / size)
 
     tab = '    ' * (dept - 1)
 
     print(f"{tab}Splitting cluster {cluster_id} in {cluster_count}")
 
-    if data_reduction:
-        dimension = min(datapoints.shape[0], int(datapoints.shape[1] / 2))
-        print(f"{tab}Appling PCA to reduce dimension from {datapoints.shape[1]} to {dimension}")
-        pca = PCA(dimension)
-        datapoints = pca.fit_transform(datapoints)
-
-    clusters, distances = _cluster(datapoints, cluster_count)
+    clusters, distances = _cluster(datapoints, rows, cluster_count)
     cluster_count = np.max(clusters)
 
     for cluster_idx in range(cluster_count + 1):
@@ -53,7 +98,7 @@ def _split_cluster(
         if numitem <= 1:
             print(f"{tab}Skipping {numitem} items cluster..")
             for idx in cluster_item_indexes:
-                dbid = indexes[idx]
+                dbid = indexes[rows[idx]]
                 doc = core.get_item_collection().document(dbid)
                 doc.update({
                     "cluster": -1,
@@ -62,17 +107,17 @@ def _split_cluster(
         elif dept <= 3 and len(cluster_item_indexes) > int(size * 1.5):
             cluster_id = _split_cluster(
                 cluster_id,
-                np.array([datapoints[idx] for idx in cluster_item_indexes], dtype=np.float32),
-                [indexes[idx] for idx in cluster_item_indexes],
+                datapoints,
+                indexes,
                 size,
-                dept + 1,
-                data_reduction
+                rows[cluster_item_indexes],
+                dept + 1
             )
         else:
             print(f"{tab}Count is good.")
             for idx in cluster_item_indexes:
-                dbid = indexes[idx]
-                dist = float(distances[idx][cluster_idx])
+                dbid = indexes[rows[idx]]
+                dist = float(distances[idx])
                 doc = core.get_item_collection().document(dbid)
                 doc.update({
                     "cluster": cluster_id,
@@ -89,24 +134,23 @@ def cluster(
     no_data_reduction=False
 ):
     try:
-        print("Loading datapoints...")
-        datapoints = core.load_datapoints()
-        print("Loading ids...")
-        indexes = core.load_ids()
+        print("Loading index...")
+        indexes, datapoints = core.load_index()
     except Exception as e:
         print("Error occured loading datapoints. download the data from the bucket")
         core.download_local_index()
 
-        print("Loading datapoints...")
-        datapoints = core.load_datapoints()
-        print("Loading ids...")
-        indexes = core.load_ids()
+        print("Loading index...")
+        indexes, datapoints = core.load_index()
 
     if len(indexes) != datapoints.shape[0]:
         raise ValueError("Inconsistences in data.")
 
     num_vector = len(indexes)
     print(f"{num_vector} datapoints found.")
-    _split_cluster(0, datapoints, indexes, size, data_reduction=not no_data_reduction)
+    if not no_data_reduction:
+        # the projection replaces the datapoints, only one of them is kept in memory
+        datapoints = _project(datapoints)
+    _split_cluster(0, datapoints, indexes, size)
 
     return
@@ -28,9 +28,9 @@ class ClearClusterCommand(BaseCommand):
 
     def run(self, namespace: Namespace):
         from .. import core
-        items = core.get_all_items()
-        for x, index in enumerate(items):
-            print(f"\r{x + 1}/{len(items)} - {index.id}", end='', flush=True)
+        total = core.count_items()
+        for x, index in enumerate(core.get_all_items()):
+            print(f"\r{x + 1}/{total} - {index.id}", end='', flush=True)
 
             index.reference.update({
                 "cluster": -1,
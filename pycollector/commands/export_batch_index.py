@@ -0,0 +1,95 @@
+from argparse import ArgumentParser, Namespace
+from ..base_command import BaseCommand, register
+
+
+class ExportBatchIndex(BaseCommand):
+
+    def __init__(self) -> None:
+        super().__init__("export-batch-index")
+
+    def get_parser(self) -> ArgumentParser:
+        parser = super().get_parser()
+        parser.description = "Export the index as Vertex AI batch update files and upload them to the bucket"
+        parser.add_argument("--dup", action="store_true", help="export the dup index")
+        parser.add_argument("-o", "--output-dir", type=str, default="./batch_export")
+        parser.add_argument("--format", choices=["json", "avro"], default="json")
+        parser.add_argument("--shard-rows", type=int, default=10000)
+        parser.add_argument("-w", "--workers", type=int, default=4)
+        since = parser.add_mutually_exclusive_group()
+        since.add_argument("--since-id", type=str, default=None, help="only export the rows added after this id")
+        since.add_argument(
+            "--changed", action="store_true",
+            help="only export the rows changed since the last sync (uses the sync manifest)"
+        )
+        parser.add_argument("--no-upload", action="store_true", help="only write the files in the output directory")
+        parser.add_argument("--prefix", type=str, default="", help="bucket directory, default to embeddings/batch/<time>")
+        parser.add_argument(
+            "--apply", action="store_true",
+            help="update the remote index from the uploaded files and save the sync manifest"
+        )
+        return parser
+
+    def run(self, namespace: Namespace):
+        import os
+        import time
+        import numpy as np
+        from .. import batch_export, core, remote_sync
+        from .update_remote_index import UpdateRemoteIndex
+        from .update_remote_index_dup import UpdateRemoteIndexDup
+
+        if namespace.dup:
+            remote, ids_path, datapoints_path = UpdateRemoteIndexDup, "./dupids.txt", "./dupdatapoints.bin"
+        else:
+            remote, ids_path, datapoints_path = UpdateRemoteIndex, core.IDS_FILE, core.DATAPOINTS_FILE
+
+        with open(ids_path, mode='r') as f:
+            ids = list(map(lambda x: x.strip(), f.readlines()))
+        if os.path.getsize(datapoints_path) != len(ids) * core.DIMENSION * 4:
+            raise ValueError("Inconsistences in data.")
+
+        manifest = remote_sync.load_manifest(remote.manifest, remote.index) if namespace.changed else None
+        try:
+            rows, deleted, hashes = batch_export.select_rows(ids, datapoints_path, namespace.since_id, manifest)
+        except ValueError as e:
+            print(e)
+            return
+        print(f"Exporting {len(rows)} datapoints, {len(deleted)} to delete.")
+        if not rows and not deleted:
+            return
+
+        files = batch_export.export(
+            ids,
+            datapoints_path,
+            namespace.output_dir,
+            rows,
+            deleted,
+            shard_rows=namespace.shard_rows,
+            workers=namespace.workers,
+            fmt=namespace.format
+        )
+        if namespace.no_upload:
+            print(f"Done! {len(files)} files written in {namespace.output_dir}")
+            return
+
+        prefix = namespace.prefix or f"embeddings/batch/{time.strftime('%Y%m%d-%H%M%S')}"
+        uri = batch_export.upload(files, namespace.output_dir, prefix, workers=namespace.workers)
+        print(f"Uploaded {len(files)} files to {uri}")
+
+        if namespace.apply:
+            operation = batch_export.apply(
+                remote_sync.get_client(),
+                remote.index,
+                uri,
+                complete_overwrite=namespace.since_id is None and not namespace.changed
+            )
+            operation.result()
+            if namespace.since_id is None:
+                if hashes is None:
+                    datapoints = np.memmap(datapoints_path, dtype=np.float32, mode='r', shape=(len(ids), core.DIMENSION))
+                    _, _, hashes = remote_sync.compute_diff(ids, datapoints, {})
+                # the next update-remote-index only sends what changed after this export
+                remote_sync.save_manifest(remote.manifest, remote.index, hashes)
+            print("Done! The remote index was updated.")
+
+
+register(ExportBatchIndex())
@@ -10,16 +10,64 @@ class NeirestNeighbors(BaseCommand):
     def get_parser(self) -> ArgumentParser:
         parser = super().get_parser()
         parser.description = "Find the closest neighbors of the specified file"
-        parser.add_argument("file", nargs=1, type=str, help="the local or remote file")
+        parser.add_argument("file", nargs="+", type=str, help="the local or remote files")
         parser.add_argument("-n", "--number", type=int, default=5)
         parser.add_argument("--to-file", type=str, default="")
+        parser.add_argument("--exclude", nargs="*", default=[], help="ids that can't be returned")
+        parser.add_argument(
+            "--revectorize", action="store_true",
+            help="vectorize the image even if the id is already in the index"
+        )
+        parser.add_argument("--nprobe", type=int, default=None, help="use the ivf index, scanning this number of lists (ignored by the segmented index)")
+        parser.add_argument("--local", action="store_true", help="don't use a running serve instance")
+        parser.add_argument(
+            "--radius", type=float, default=None,
+            help="return every neighbor closer than this distance instead of the closest --number"
+        )
+        parser.add_argument("--limit", type=int, default=None, help="maximum number of neighbors within the radius")
 
         return parser
 
+    def remote(self, namespace: Namespace, command: str, **kwargs) -> dict | None:
+        """Forward the search to a running serve instance, None if there is none
+        or if it failed, the search is then run in process."""
+        if namespace.local:
+            return None
+
+        import os
+        from .. import client
+        try:
+            return client.request({
+                "command": command,
+                "number": namespace.number,
+                "nprobe": namespace.nprobe,
+                "exclude": namespace.exclude,
+                "revectorize": namespace.revectorize,
+                # serve refuses the search when it doesn't use the same index
+                "index_dir": os.getcwd(),
+                **kwargs
+            })
+        except client.ServeError as e:
+            print(f"serve failed ({e}), searching in process.")
+            return None
+
     def run(self, namespace: Namespace):
-        from .. import nearest_neighbors as nn
+        from .. import client
+
+        if namespace.radius is not None:
+            return self.run_radius(namespace)
 
-        result = nn.find(namespace.file[0], namespace.number)
+        if len(namespace.file) > 1:
+            return self.run_batch(namespace)
+
+        file = client.file_argument(namespace.file[0])
+        if (response := self.remote(namespace, "nearest-neighbors", file=file)) is not None:
+            result = response["nearest"]
+        else:
+            from .. import nearest_neighbors as nn
+            result = nn.find(
+                namespace.file[0], namespace.number, namespace.nprobe, namespace.exclude, namespace.revectorize
+            )
 
         if namespace.to_file:
             import json
@@ -30,5 +78,61 @@ class NeirestNeighbors(BaseCommand):
             for _id, dist in result:
                 print(_id, dist)
 
+    def run_radius(self, namespace: Namespace):
+        from .. import client
+
+        results = []
+        for file in namespace.file:
+            try:
+                response = self.remote(
+                    namespace,
+                    "nearest-neighbors-radius",
+                    file=client.file_argument(file),
+                    radius=namespace.radius,
+                    limit=namespace.limit
+                )
+                if response is not None:
+                    results.append({"nearest": response["nearest"]})
+                    continue
+
+                from .. import nearest_neighbors as nn
+                nearest = nn.find_within(
+                    file, namespace.radius, namespace.limit, namespace.exclude, namespace.revectorize
+                )
+                results.append({"nearest": nearest})
+            except Exception as e:
+                results.append({"error": str(e)})
+        self.output(namespace, results)
+
+    def run_batch(self, namespace: Namespace):
+        from .. import client
+
+        items = [client.file_argument(x) for x in namespace.file]
+        if (response := self.remote(namespace, "nearest-neighbors-batch", items=items)) is not None:
+            results = response["results"]
+        else:
+            from .. import nearest_neighbors as nn
+            results = nn.find_many(
+                namespace.file, namespace.number, namespace.nprobe, namespace.exclude, namespace.revectorize
+            )
+
+        self.output(namespace, results)
+
+    def output(self, namespace: Namespace, results: list[dict]):
+        if namespace.to_file:
+            import json
+            with open(namespace.to_file, mode='w') as f:
+                json.dump(dict(zip(namespace.file, results)), f, indent=4)
+                print(f'result written to "{namespace.to_file}"')
+            return
+
+        for file, result in zip(namespace.file, results):
+            print(f"{file}:")
+            if error := result.get("error"):
+                print(f"    error: {error}")
+                continue
+            for _id, dist in result["nearest"]:
+                print("   ", _id, dist)
+
 
 register(NeirestNeighbors())
@@ -0,0 +1,59 @@
+from argparse import ArgumentParser, Namespace
+from ..base_command import BaseCommand, register
+
+
+class IVFIndexCommand(BaseCommand):
+
+    def __init__(self) -> None:
+        super().__init__("ivf-index")
+
+        self.actions = {
+            "build": self.build,
+            "bench": self.bench
+        }
+
+    def get_parser(self) -> ArgumentParser:
+        parser = super().get_parser()
+        parser.description = "Build and evaluate the approximate (ivf) nearest neighbors index"
+        subparser = parser.add_subparsers(dest="subcommand")
+        parser_build = subparser.add_parser("build", description="partition the index with kmeans")
+        parser_build.add_argument("--nlist", type=int, default=None, help="number of lists, default to 4 * sqrt(N)")
+        parser_bench = subparser.add_parser("bench", description="report recall and latency against exact search")
+        parser_bench.add_argument("--nprobe", type=str, default="1,2,4,8,16,32")
+        parser_bench.add_argument("-n", "--number", type=int, default=10)
+        parser_bench.add_argument("-q", "--queries", type=int, default=200)
+        return parser
+
+    def run(self, namespace: Namespace):
+        return self.actions[namespace.subcommand](namespace)
+
+    def build(self, namespace: Namespace):
+        from .. import core, ivf
+
+        ids, datapoints = core.load_index()
+        print(f"Building ivf index of {len(ids)} datapoints...")
+        index = ivf.IVFIndex.build(ids, datapoints, namespace.nlist)
+        index.save()
+        sizes = [b - a for a, b in zip(index.offsets[:-1], index.offsets[1:])]
+        print(f"{index.nlist} lists, {min(sizes)} to {max(sizes)} rows per list.")
+
+    def bench(self, namespace: Namespace):
+        from .. import core, ivf
+
+        ids, datapoints = core.load_index()
+        index = ivf.load_for(ids)
+        if index is None:
+            print("No valid ivf index found. Build it with: ivf-index build")
+            return
+
+        nprobes = [int(x) for x in namespace.nprobe.split(",")]
+        results = ivf.benchmark(datapoints, index, nprobes, namespace.number, namespace.queries)
+        print(f"{'nprobe':>8} {f'recall@{namespace.number}':>10} {'latency':>10} {'scanned':>8}")
+        for result in results:
+            print(
+                f"{result['nprobe']:>8} {result['recall']:>10.3f} "
+                f"{result['latency_ms']:>8.2f}ms {result['scanned'] * 100:>7.1f}%"
+            )
+
+
+register(IVFIndexCommand())
@@ -0,0 +1,68 @@
+from argparse import ArgumentParser, Namespace
+from ..base_command import BaseCommand, register
+
+
+class LiveIndex(BaseCommand):
+
+    def __init__(self) -> None:
+        super().__init__("live-index")
+
+    def get_parser(self) -> ArgumentParser:
+        parser = super().get_parser()
+        parser.description = "Keep the segmented index up to date with the item changes as they happen"
+        parser.add_argument("-b", "--batch-size", type=int, default=32, help="maximum changes handled at once")
+        parser.add_argument(
+            "-d", "--batch-delay", type=float, default=2.0,
+            help="seconds to wait for more changes after the first one"
+        )
+        parser.add_argument(
+            "--reconcile", type=float, default=300.0,
+            help="seconds between checks for deleted older items, 0 to disable"
+        )
+        parser.add_argument(
+            "--retry", type=float, default=30.0,
+            help="seconds without changes before trying again the items that couldn't be vectorized"
+        )
+        parser.add_argument("--update-text", action="store_true")
+        return parser
+
+    def run(self, namespace: Namespace):
+        import time
+        from .. import segments
+        from ..live_index import LiveIndexer
+
+        if not segments.exists():
+            print("No segments found, run `segment-index init` first.")
+            return
+
+        index = segments.SegmentedIndex()
+        # held until the indexer stops, the indexer takes it again in its thread
+        if not index.acquire_writer(blocking=False):
+            print("Another process is writing to the segments.")
+            return
+        try:
+            if recovered := index.recover():
+                print(f"Recovered interrupted segments: {', '.join(recovered)}")
+
+            indexer = LiveIndexer(
+                index,
+                batch_size=namespace.batch_size,
+                batch_delay=namespace.batch_delay,
+                reconcile_interval=namespace.reconcile,
+                update_text=namespace.update_text,
+                retry_interval=namespace.retry
+            )
+            indexer.start()
+            try:
+                while indexer.is_alive():
+                    time.sleep(1.0)
+            except KeyboardInterrupt:
+                print("Stopping...")
+            finally:
+                indexer.stop()
+                indexer.join()
+        finally:
+            index.release_writer()
+
+
+register(LiveIndex())
@@ -0,0 +1,115 @@
+from argparse import ArgumentParser, Namespace
+from ..base_command import BaseCommand, register
+
+
+class LoadTestCommand(BaseCommand):
+
+    def __init__(self) -> None:
+        super().__init__("load-test")
+
+    def get_parser(self) -> ArgumentParser:
+        from ..client import DEFAULT_PORT, DEFAULT_SOCKET
+        from ..load_test import DEFAULT_MIX
+
+        parser = super().get_parser()
+        parser.description = "Send a mix of requests to serve and report the throughput and latency percentiles"
+        parser.add_argument("targets", nargs="*", help="files or ids to send, default to ids of the local index")
+        parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT)
+        parser.add_argument("--unix", type=str, default=DEFAULT_SOCKET)
+        parser.add_argument("-c", "--clients", type=int, default=4, help="closed loop clients")
+        parser.add_argument("-r", "--rate", type=float, default=0, help="requests per second sent by an open loop client")
+        parser.add_argument("--think", type=float, default=0, help="mean seconds between the requests of a closed loop client")
+        parser.add_argument("--max-outstanding", type=int, default=256, help="concurrent requests of the open loop client")
+        parser.add_argument("-d", "--duration", type=float, default=30)
+        parser.add_argument("--warmup", type=float, default=5, help="seconds excluded from the report")
+        parser.add_argument("--mix", type=str, default=DEFAULT_MIX, help="command=weight,... of the requests")
+        parser.add_argument("--sample", type=int, default=1000, help="number of local index ids used as targets")
+        parser.add_argument("-n", "--number", type=int, default=5, help="neighbors asked by nearest-neighbors")
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument("--json", type=str, default=None, help="also write the report to this file")
+        parser.add_argument(
+            "--spawn", action="store_true",
+            help="start serve with the local stand-ins of the google services for the test"
+        )
+        parser.add_argument("--bucket", type=str, default="./bucket", help="bucket directory of the spawned serve")
+        parser.add_argument("--ocr-latency", type=float, default=0.3, help="text detection seconds of the spawned serve")
+        parser.add_argument("--database", type=str, default="", help="json documents of the spawned serve")
+        parser.add_argument("--serve-args", type=str, default="", help="extra arguments of the spawned serve")
+        return parser
+
+    def targets(self, namespace: Namespace) -> list[str]:
+        import random
+        from .. import core
+
+        if namespace.targets:
+            return namespace.targets
+        ids = core.load_ids()
+        if len(ids) > namespace.sample:
+            ids = random.Random(namespace.seed).sample(ids, namespace.sample)
+        return ids
+
+    def spawn(self, namespace: Namespace):
+        """Start serve with the stand-ins and wait until it answers."""
+        import os
+        import shlex
+        import subprocess
+        import sys
+        import time
+        from .. import client
+
+        env = {
+            **os.environ,
+            "PYCOLLECTOR_LOCAL_BUCKET": os.path.abspath(namespace.bucket),
+            "PYCOLLECTOR_FAKE_OCR": str(namespace.ocr_latency),
+            "PYCOLLECTOR_MEMORY_DATABASE": os.path.abspath(namespace.database) if namespace.database else "1"
+        }
+        args = [sys.executable, "-m", "pycollector", "serve", "--port", str(namespace.port), "--init"]
+        if namespace.unix:
+            args += ["--unix", namespace.unix]
+        args += shlex.split(namespace.serve_args)
+
+        process = subprocess.Popen(args, env=env)
+        while client.request({"command": "status"}, namespace.port, namespace.unix) is None:
+            if process.poll() is not None:
+                raise RuntimeError(f"serve exited with code {process.returncode}")
+            time.sleep(0.5)
+        return process
+
+    def run(self, namespace: Namespace):
+        import json
+        from .. import client, load_test
+
+        workload = load_test.Workload(load_test.parse_mix(namespace.mix), self.targets(namespace), namespace.number)
+        if not namespace.clients and namespace.rate <= 0:
+            print("Nothing to run, specify --clients or --rate.")
+            return
+
+        process = self.spawn(namespace) if namespace.spawn else None
+        try:
+            if process is None and client.request({"command": "status"}, namespace.port, namespace.unix) is None:
+                print("serve is not running, start it or use --spawn.")
+                return
+
+            print(
+                f"Running {namespace.clients} closed loop clients"
+                + (f" and an open loop client at {namespace.rate:g} req/s" if namespace.rate > 0 else "")
+                + f" for {namespace.duration:g}s...",
+                flush=True
+            )
+            test = load_test.LoadTest(workload, namespace.port, namespace.unix, namespace.seed)
+            samples = test.run(
+                namespace.duration, namespace.clients, namespace.rate, namespace.think, namespace.max_outstanding
+            )
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+        result = load_test.report(samples, namespace.duration, min(namespace.warmup, namespace.duration))
+        load_test.print_report(result)
+        if namespace.json:
+            with open(namespace.json, mode='w') as f:
+                json.dump(result, f, indent=2)
+
+
+register(LoadTestCommand())
@@ -11,7 +11,8 @@ class LocalIndex(BaseCommand):
             "upload": self.upload,
             "update": self.update,
             "download": self.download,
-            "remove": self.remove
+            "remove": self.remove,
+            "verify": self.verify
         }
 
     def download(self, namespace: Namespace):
@@ -44,6 +45,29 @@ class LocalIndex(BaseCommand):
             core.write_ids(ids)
             core.upload_local_index()
 
+    def verify(self, namespace: Namespace):
+        from .. import journal
+
+        report = journal.inspect()
+        print(f"ids: {report['id_rows']} rows")
+        if report["partial_id"]:
+            print("ids: last line is incomplete")
+        print(f"datapoints: {report['datapoint_rows']} rows")
+        if report["trailing_bytes"]:
+            print(f"datapoints: {report['trailing_bytes']} trailing bytes")
+        print(f"checkpoint: {report['checkpoint_rows']}")
+
+        if journal.is_consistent(report):
+            print("Local index is consistent.")
+            return
+
+        if not namespace.repair:
+            print(f"Local index is inconsistent, {report['consistent_rows']} rows can be kept. Use --repair to fix it.")
+            return
+
+        rows = journal.repair()
+        print(f"Local index truncated to {rows} rows.")
+
     def get_parser(self) -> ArgumentParser:
         parser = super().get_parser()
         subparser = parser.add_subparsers(dest="subcommand")
@@ -51,86 +75,115 @@ class LocalIndex(BaseCommand):
         parser_update = subparser.add_parser("update", description="update local index to match remote")
         parser_update.add_argument("-o", "--override", action="store_true")
         parser_update.add_argument("--update-text", action="store_true")
+        parser_update.add_argument(
+            "--resume", action="store_true",
+            help="continue an interrupted update from the last committed item"
+        )
+        parser_update.add_argument(
+            "--checkpoint-every", type=int, default=25,
+            help="number of items between each checkpoint"
+        )
         parser_download = subparser.add_parser("download", description="update local index to match remote")
         parser_remove = subparser.add_parser("remove", description="update local index to match remote")
         parser_remove.add_argument('datapoints', nargs='+', type=str)
+        parser_verify = subparser.add_parser("verify", description="verify that ids and datapoints are consistent")
+        parser_verify.add_argument("--repair", action="store_true", help="truncate to the last consistent row")
 
         return parser
 
     def run(self, namespace: Namespace):
+        from .. import segments
+
+        if namespace.subcommand in ("update", "remove") and segments.exists():
+            # serve and the clustering read the segments, the changes go there
+            return self.segment_index(namespace)
         return self.actions[namespace.subcommand](namespace)
 
+    def segment_index(self, namespace: Namespace):
+        from .segment_index import SegmentIndex
+
+        print("The index is stored in segments, updating them.")
+        if namespace.subcommand == "update":
+            arguments = Namespace(
+                subcommand="update",
+                update_text=namespace.update_text,
+                verify=not namespace.resume,
+                checkpoint_every=namespace.checkpoint_every,
+                no_upload=False
+            )
+        else:
+            arguments = Namespace(subcommand="remove", datapoints=namespace.datapoints, no_upload=False)
+        return SegmentIndex().run(arguments)
+
     def update(self, namespace: Namespace):
         import numpy as np
-        from .. import core
+        from .. import core, journal
 
-        if namespace.override:
+        if namespace.resume:
+            rows = journal.repair()
+            print(f"Resuming update from the last checkpoint ({rows} rows).")
+        elif namespace.override:
             print('Overriding existing files with the one in the bucket.')
             core.download_local_index()
+        elif not journal.is_consistent(report := journal.inspect()):
+            # starting over would append the whole collection after the kept rows
+            print(
+                f"Local index is inconsistent, {report['consistent_rows']} rows can be kept. "
+                "Use --resume to continue the interrupted update."
+            )
+            return
 
         try:
             ids = core.load_ids()
             datapoints = core.load_datapoints()
-        except:
+        except FileNotFoundError:
             ids = []
             datapoints = None
 
         removed = False
         if ids and datapoints is not None:
-            # verify the existance of all the ids
-            print("Verifying existance of ids...")
-            to_remove: list[tuple[int, str]] = []
-            for x, _id in enumerate(ids):
-                if not core.get_item_collection().document(_id).get([]).exists:
-                    to_remove.append((x, _id))
-
-                print(f"\r{x + 1}/{len(ids)} - {_id}", end='', flush=True)
-            
-            print(flush=True)
-            
-            for idx, _id in reversed(to_remove):
-                print(f'Id "{_id}" doesn\'t exist anymore')
-                ids.pop(idx)
-                datapoints = np.delete(datapoints, idx, 0)
-                removed = True
+            if not namespace.resume:
+                # verify the existance of all the ids
+                print("Verifying existance of ids...")
+                to_remove: list[tuple[int, str]] = []
+                for x, _id in enumerate(ids):
+                    if not core.get_item_collection().document(_id).get([]).exists:
+                        to_remove.append((x, _id))
 
-            if removed:
-                core.write_ids(ids)
-                core.write_datapoints(datapoints)
+                    print(f"\r{x + 1}/{len(ids)} - {_id}", end='', flush=True)
+
+                print(flush=True)
+
+                for idx, _id in reversed(to_remove):
+                    print(f'Id "{_id}" doesn\'t exist anymore')
+                    ids.pop(idx)
+                    datapoints = np.delete(datapoints, idx, 0)
+                    removed = True
+
+                if removed:
+                    core.write_datapoints(datapoints)
+                    core.write_ids(ids)
 
             print(f"Starting update after item: {ids[-1]}")
-            items = core.get_all_items(start_after_id=ids[-1])
+            start_after_id = ids[-1]
         else:
             print("No local index found starting the generation from the begining..")
-            items = core.get_all_items()
+            start_after_id = None
 
-        if not len(items):
+        total = core.count_items(start_after_id=start_after_id)
+        if not total:
             print("No item found to update.")
             if removed:
                 core.upload_local_index()
             return
-        
-        from .. import core_tf
-
-        print(f"Found {len(items)} items to update")
-
-        with (
-            open("./ids.txt", mode='a') as ids_file,
-            open("./datapoints.bin", mode="ab") as datapoints_file
-        ):
-            for x, item in enumerate(items):
-                _id = item.id
-                print(f'{x + 1}/{len(items)} {_id}')
-                with core.DownloadOrLocalImage(_id) as filename:
-                    texts = core.detect_text(filename)
-                    if namespace.update_text:
-                        item.reference.update({"text": texts})
-                        print(f'Text updated with {texts}')
-                    result, _ = core_tf.vectorize_with_text(filename, texts=texts)
-                    result.tofile(datapoints_file)
-                ids_file.write(f"{_id}\n")
 
-            core.upload_local_index()
+        print(f"Found {total} items to update")
+
+        items = core.get_all_items(start_after_id=start_after_id)
+        with journal.JournaledIndexWriter(checkpoint_every=namespace.checkpoint_every) as writer:
+            core.append_items(writer, items, namespace.update_text, total)
+
+        core.upload_local_index()
 
 
 register(LocalIndex())
@@ -1,10 +1,11 @@
-from typing import TYPE_CHECKING
-
 from argparse import ArgumentParser, Namespace
 from ..base_command import BaseCommand, register
 
-if TYPE_CHECKING:
-    from google.cloud.firestore_v1.collection import CollectionReference
+DUP_IDS_FILE = "./dupids.txt"
+
+DUP_DATAPOINTS_FILE = "./dupdatapoints.bin"
+
+DUP_CHECKPOINT_FILE = "./dupindex.checkpoint"
 
 
 class LocalIndexDup(BaseCommand):
@@ -21,31 +22,20 @@ class LocalIndexDup(BaseCommand):
         }
 
     def generate(self, namespace: Namespace):
-        import numpy as np
-        from .. import core, core_tf
+        import os
+        from .. import core, journal
 
-        collection: "CollectionReference" = core.get_admin_user().collection("duplicates")
-        items = collection.select(["text"]).order_by("timestamp").get()
+        query = core.dup_query()
+        total = core.count_query(query)
+        items = core.stream_query(query)
 
-        with (
-            open("./dupids.txt", mode='w') as ids_file,
-            open("./dupdatapoints.bin", mode="wb") as datapoints_file
-        ):
-            for x, item in enumerate(items):
-                _id = item.id
-                print(f'{x + 1}/{len(items)} {_id}')
-                ids_file.write(f"{_id}\n")
-                if text := item.get("text"):
-                    print("Using text: ", text)
-                    result = core.encode_text(text)
-                    if result is not None:
-                        result.tofile(datapoints_file)
-                        continue
-                    print("Text is not valid not enough character")
+        # start from scratch
+        for path in (DUP_IDS_FILE, DUP_DATAPOINTS_FILE, DUP_CHECKPOINT_FILE):
+            if os.path.exists(path):
+                os.remove(path)
 
-                with core.DownloadOrLocalImage(_id) as filename:
-                    result = core_tf.vectorize_file(filename)
-                    result.tofile(datapoints_file)
+        with journal.JournaledIndexWriter(DUP_IDS_FILE, DUP_DATAPOINTS_FILE, DUP_CHECKPOINT_FILE) as writer:
+            core.append_dup_items(writer, items, total)
 
 
     def download(self, namespace: Namespace):
@@ -130,16 +120,19 @@ class LocalIndexDup(BaseCommand):
                 removed = True
 
             if removed:
-                core.write_ids(ids)
                 core.write_datapoints(datapoints)
+                core.write_ids(ids)
 
             print(f"Starting update after item: {ids[-1]}")
-            items = core.get_all_items(start_after_id=ids[-1])
+            start_after_id = ids[-1]
         else:
             print("No local index found starting the generation from the begining..")
-            items = core.get_all_items()
+            start_after_id = None
+
+        total = core.count_items(start_after_id=start_after_id)
+        items = core.get_all_items(start_after_id=start_after_id)
 
-        if not len(items):
+        if not total:
             print("No item found to update.")
             if removed:
                 core.upload_local_index()
@@ -147,7 +140,7 @@ class LocalIndexDup(BaseCommand):
         
         from .. import core_tf
 
-        print(f"Found {len(items)} items to update")
+        print(f"Found {total} items to update")
 
         with (
             open("./ids.txt", mode='a') as ids_file,
@@ -155,13 +148,13 @@ class LocalIndexDup(BaseCommand):
         ):
             for x, item in enumerate(items):
                 _id = item.id
-                print(f'{x + 1}/{len(items)} {_id}')
+                print(f'{x + 1}/{total} {_id}')
                 with core.DownloadOrLocalImage(_id) as filename:
                     texts = core.detect_text(filename)
                     if namespace.update_text:
                         item.reference.update({"text": texts})
                         print(f'Text updated with {texts}')
-                    result, _ = core_tf.vectorize_with_text(filename, texts=texts)
+                    result, _ = core_tf.vectorize_with_text(filename, texts=texts, _id=_id)
                     result.tofile(datapoints_file)
                 ids_file.write(f"{_id}\n")
 
@@ -0,0 +1,58 @@
+from argparse import ArgumentParser, Namespace
+from ..base_command import BaseCommand, register
+
+
+class NeighborTableCommand(BaseCommand):
+
+    def __init__(self) -> None:
+        super().__init__("neighbor-table")
+
+        self.actions = {
+            "update": self.update,
+            "show": self.show
+        }
+
+    def get_parser(self) -> ArgumentParser:
+        from ..neighbor_table import DEFAULT_K
+
+        parser = super().get_parser()
+        parser.description = "Precompute the nearest neighbors of every indexed item"
+        subparser = parser.add_subparsers(dest="subcommand")
+        parser_update = subparser.add_parser("update", description="build the table or refresh the changed rows")
+        parser_update.add_argument("-k", type=int, default=DEFAULT_K, help="number of neighbors per item")
+        parser_update.add_argument("--full", action="store_true", help="rebuild the whole table")
+        parser_update.add_argument("--firestore", action="store_true", help="write the changed rows in the items")
+        parser_update.add_argument("--upload", action="store_true", help="upload the table to the bucket")
+        parser_show = subparser.add_parser("show", description="print the neighbors of an item")
+        parser_show.add_argument("id", type=str)
+        parser_show.add_argument("-n", "--number", type=int, default=None)
+        return parser
+
+    def run(self, namespace: Namespace):
+        return self.actions[namespace.subcommand](namespace)
+
+    def update(self, namespace: Namespace):
+        from .. import core, neighbor_table, transfer
+
+        table, changed = neighbor_table.update(namespace.k, full=namespace.full)
+        print(f"{len(table)} items, neighbors of {len(changed)} changed.")
+
+        if namespace.firestore and len(changed):
+            written = table.to_firestore(changed)
+            print(f"{written} items updated in firestore.")
+
+        if namespace.upload:
+            transfer.upload_file(core.get_bucket(), neighbor_table.NEIGHBORS_FILE, neighbor_table.BUCKET_FILE)
+
+    def show(self, namespace: Namespace):
+        from ..neighbor_table import NeighborTable
+
+        neighbors = NeighborTable.load().lookup(namespace.id, namespace.number)
+        if neighbors is None:
+            print(f"{namespace.id} is not in the table.")
+            return
+        for _id, distance in neighbors:
+            print(f"{_id}: {distance}")
+
+
+register(NeighborTableCommand())
@@ -9,41 +9,61 @@ class RebuildIndexes(BaseCommand):
 
     def get_parser(self) -> ArgumentParser:
         parser = super().get_parser()
+        parser.add_argument("-b", "--batch-size", type=int, default=1024)
         return parser
 
     def run(self, namespace: Namespace):
-        from .. import core
+        from .. import core, segments
         import numpy as np
 
-        ids = core.load_ids()
-        b0datas = core.load_datapoints()
+        if segments.refuse_local_writes(self.name):
+            return
 
-        total = b0datas.shape[0]
+        ids = core.load_ids()
+        total = len(ids)
 
-        to_remove = []
+        print("Reading the text of all the items...")
+        texts: dict[str, list[str] | None] = {}
+        for item in core.get_all_items(fields=["text"]):
+            texts[item.id] = (item.to_dict() or {}).get("text")
+            print(f"\r{len(texts)} items", end='', flush=True)
+        print(flush=True)
 
-        for x, (_id, data) in enumerate(zip(ids, b0datas), 1):
-            print(f"{round((x/total) * 100)}% ({x} / {total}) {_id}")
-            doc = core.get_item_collection().document(_id)
-            texts = doc.get(["text"]).get("text")
-            if texts is None:
-                to_remove.append((x - 1, _id))
+        # the rows are updated in place, only the changed ones are written
+        datapoints = np.memmap(core.DATAPOINTS_FILE, dtype=np.float32, mode='r+', shape=(total, core.DIMENSION))
+        updated = 0
+        for start in range(0, total, namespace.batch_size):
+            end = min(start + namespace.batch_size, total)
+            rows = [x for x in range(start, end) if texts.get(ids[x])]
+            if not rows:
                 continue
 
-            result = core.encode_text(texts)
-            if result is not None:
-                print("Updated index with text: ", texts)
-                data[:] = result
-            else:
-                print("Text is invalid", texts)
+            encoded, valid = core.encode_texts([texts[ids[x]] for x in rows])
+            for row, vector, is_valid in zip(rows, encoded, valid):
+                if not is_valid:
+                    print("Text is invalid", ids[row], texts[ids[row]])
+                elif not np.array_equal(datapoints[row], vector):
+                    datapoints[row] = vector
+                    updated += 1
+            print(f"{round((end / total) * 100)}% ({end} / {total}) {updated} updated", flush=True)
+        datapoints.flush()
+
+        keep = [x for x, _id in enumerate(ids) if _id in texts]
+        if len(keep) != total:
+            for x, _id in enumerate(ids):
+                if _id not in texts:
+                    print(f"Removing {_id} at {x}. It doesn't exist anymore.")
+
+            # copy the remaining rows in a single pass
+            def write(f):
+                for start in range(0, len(keep), namespace.batch_size):
+                    f.write(datapoints[keep[start:start + namespace.batch_size]].tobytes())
 
-        for idx, rem in reversed(to_remove):
-            print(f"Removing {rem} at {idx}. It doesn't exist anymore.")
-            ids.pop(idx)
-            b0datas = np.delete(b0datas, idx, 0)
+            core.replace_file(core.DATAPOINTS_FILE, write, mode='wb')
+            core.write_ids([ids[x] for x in keep])
 
-        core.write_datapoints(b0datas)
-        core.write_ids(ids)
+        del datapoints
+        print(f"Done! {updated} rows updated, {total - len(keep)} removed.")
 
 
 register(RebuildIndexes())
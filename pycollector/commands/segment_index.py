@@ -0,0 +1,153 @@
+from argparse import ArgumentParser, Namespace
+from ..base_command import BaseCommand, register
+
+
+class SegmentIndex(BaseCommand):
+
+    def __init__(self) -> None:
+        super().__init__("segment-index")
+
+        self.actions = {
+            "init": self.init,
+            "update": self.update,
+            "remove": self.remove,
+            "merge": self.merge,
+            "status": self.status,
+            "upload": self.upload,
+            "download": self.download,
+            "export": self.export
+        }
+
+    def get_parser(self) -> ArgumentParser:
+        parser = super().get_parser()
+        parser.description = "Manage the index stored as immutable segments"
+        subparser = parser.add_subparsers(dest="subcommand")
+        subparser.add_parser("init", description="create the first segment from the local index")
+        parser_update = subparser.add_parser("update", description="add the new items in a new segment")
+        parser_update.add_argument("--update-text", action="store_true")
+        parser_update.add_argument("--verify", action="store_true", help="tombstone the ids that doesn't exist anymore")
+        parser_update.add_argument("--checkpoint-every", type=int, default=25)
+        parser_update.add_argument("--no-upload", action="store_true")
+        parser_remove = subparser.add_parser("remove", description="tombstone the specified ids")
+        parser_remove.add_argument('datapoints', nargs='+', type=str)
+        parser_remove.add_argument("--no-upload", action="store_true")
+        parser_merge = subparser.add_parser("merge", description="merge segments according to the merge policy")
+        parser_merge.add_argument("--all", action="store_true", help="merge all the segments into one")
+        parser_merge.add_argument("--background", type=float, default=0, help="keep merging every N seconds")
+        subparser.add_parser("status", description="list the segments")
+        subparser.add_parser("upload", description="upload the new segments to the bucket")
+        subparser.add_parser("download", description="download the new segments from the bucket")
+        subparser.add_parser("export", description="write the live rows to ids.txt and datapoints.bin")
+        return parser
+
+    def run(self, namespace: Namespace):
+        from .. import segments
+
+        index = segments.SegmentedIndex()
+        if namespace.subcommand in ("status", "export"):
+            # read only, a writer may be running next to them
+            return self.actions[namespace.subcommand](index, namespace)
+
+        if not index.acquire_writer(blocking=False):
+            print("Another process is writing to the segments.")
+            return
+        try:
+            if recovered := index.recover():
+                print(f"Recovered interrupted segments: {', '.join(recovered)}")
+            return self.actions[namespace.subcommand](index, namespace)
+        finally:
+            index.release_writer()
+
+    def init(self, index, namespace: Namespace):
+        from .. import core
+
+        if index.segments:
+            print("Segments already exist.")
+            return
+
+        ids = core.load_ids()
+        datapoints = core.load_datapoints()
+        if len(ids) != datapoints.shape[0]:
+            raise ValueError("Inconsistences in data.")
+        index.add(ids, datapoints)
+        print(f"Created segment with {len(ids)} rows.")
+
+    def update(self, index, namespace: Namespace):
+        from .. import core
+
+        if namespace.verify:
+            missing = []
+            for segment in index.segments:
+                for _id in segment.ids:
+                    if _id not in segment.deleted and not core.get_item_collection().document(_id).get([]).exists:
+                        print(f'Id "{_id}" doesn\'t exist anymore')
+                        missing.append(_id)
+            index.delete(missing)
+
+        if last_id := index.last_id:
+            print(f"Starting update after item: {last_id}")
+
+        if total := core.count_items(start_after_id=last_id):
+            print(f"Found {total} items to update")
+            items = core.get_all_items(start_after_id=last_id)
+            with index.new_segment(namespace.checkpoint_every) as writer:
+                core.append_items(writer, items, namespace.update_text, total)
+        else:
+            print("No item found to update.")
+
+        while index.merge():
+            pass
+
+        if not namespace.no_upload:
+            index.upload()
+
+    def remove(self, index, namespace: Namespace):
+        found = index.delete(namespace.datapoints)
+        for _id in namespace.datapoints:
+            if _id in found:
+                print(f"Removing {_id}")
+            else:
+                print(f"couldn't find index: {_id}")
+
+        if found and not namespace.no_upload:
+            index.upload()
+
+    def merge(self, index, namespace: Namespace):
+        from .. import segments
+
+        if namespace.all:
+            index.merge_all()
+        elif namespace.background:
+            merger = segments.BackgroundMerger(index, namespace.background)
+            merger.start()
+            print(f"Merging every {namespace.background} seconds, Ctrl-C to stop.")
+            try:
+                merger.join()
+            except KeyboardInterrupt:
+                merger.stop()
+        else:
+            while index.merge():
+                pass
+
+    def status(self, index, namespace: Namespace):
+        for segment in index.segments:
+            print(f"{segment.name}: {len(segment.ids)} rows, {len(segment.deleted)} deleted")
+        print(f"{len(index)} live rows in {len(index.segments)} segments. Last id: {index.last_id}")
+
+    def upload(self, index, namespace: Namespace):
+        index.upload()
+
+    def download(self, index, namespace: Namespace):
+        added = index.download()
+        print(f"{len(added)} new segments.")
+
+    def export(self, index, namespace: Namespace):
+        from .. import core
+
+        ids, datapoints = index.live()
+        core.write_datapoints(datapoints)
+        core.write_ids(ids)
+        print(f"Exported {len(ids)} rows.")
+
+
+register(SegmentIndex())
@@ -1,12 +1,21 @@
 from typing import Callable, Any
+import os
+import signal
 import socket
 import json
+import sys
 
 from argparse import ArgumentParser, Namespace
 
 from ..base_command import BaseCommand, register
 
 
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+# seconds allowed to a client to send its request
+RECEIVE_TIMEOUT = 10
+
+
 class ServeCommand(BaseCommand):
 
     def __init__(self) -> None:
@@ -17,13 +26,35 @@ class ServeCommand(BaseCommand):
             "vectorize-with-text": self.vectorize_with_text,
             "status": self.status_cmd,
             "nearest-neighbors": self.nearest_neighbors,
+            "nearest-neighbors-batch": self.nearest_neighbors_batch,
+            "nearest-neighbors-radius": self.nearest_neighbors_radius,
             "vectorize-text": self.vectorize_text
         }
+        self.lanes: dict[str, tuple[int, int]] | None = None
+        self.shm_responses = None
 
     def get_parser(self) -> ArgumentParser:
+        from ..client import DEFAULT_PORT, DEFAULT_SOCKET
+
         parser = super().get_parser()
-        parser.add_argument("-p", "--port",  type=int)
+        parser.add_argument("-p", "--port",  type=int, default=DEFAULT_PORT)
+        parser.add_argument(
+            "--unix", type=str, default=DEFAULT_SOCKET, help="also listen on this unix domain socket"
+        )
+        parser.add_argument("--no-tcp", action="store_true", help="only listen on the unix domain socket")
         parser.add_argument("--init", action="store_true")
+        parser.add_argument(
+            "-w", "--workers", type=int, default=1,
+            help="number of pre-forked worker processes sharing the index"
+        )
+        parser.add_argument(
+            "--lane", action="append", default=[],
+            help="worker threads and queue size of a lane (light, search or heavy), ie: heavy=2:16"
+        )
+        parser.add_argument(
+            "--reload-interval", type=float, default=30,
+            help="seconds between checks for a new index when using workers, 0 to only reload on SIGHUP"
+        )
 
         return parser
 
@@ -35,9 +66,45 @@ class ServeCommand(BaseCommand):
             return conn.sendall(json.dumps({"error": "File not specified"}).encode())
         
         number = request.get("number", 5) or 5
+        nprobe = request.get("nprobe", None)
+        exclude = request.get("exclude", None)
+        revectorize = request.get("revectorize", False)
+
+        result = nearest_neighbors.find(file, number, nprobe, exclude, revectorize)
+        self.respond(conn, request, {"nearest": result})
+
+    def nearest_neighbors_batch(self, conn: socket.socket, request: dict[str, Any]):
+        from .. import nearest_neighbors
+
+        items = request.get("items", None)
+        if not items or not isinstance(items, list):
+            return conn.sendall(json.dumps({"error": "Items not specified"}).encode())
+
+        number = request.get("number", 5) or 5
+        nprobe = request.get("nprobe", None)
+        exclude = request.get("exclude", None)
+        revectorize = request.get("revectorize", False)
+
+        results = nearest_neighbors.find_many(items, number, nprobe, exclude, revectorize)
+        self.respond(conn, request, {"results": results})
+
+    def nearest_neighbors_radius(self, conn: socket.socket, request: dict[str, Any]):
+        from .. import nearest_neighbors
+
+        file = request.get("file", None)
+        if not file:
+            return conn.sendall(json.dumps({"error": "File not specified"}).encode())
 
-        result = nearest_neighbors.find(file, number)
-        conn.sendall(json.dumps({"nearest": result}).encode())
+        radius = request.get("radius", None)
+        if radius is None:
+            return conn.sendall(json.dumps({"error": "Radius not specified"}).encode())
+
+        limit = request.get("limit", None)
+        exclude = request.get("exclude", None)
+        revectorize = request.get("revectorize", False)
+
+        result = nearest_neighbors.find_within(file, float(radius), limit, exclude, revectorize)
+        self.respond(conn, request, {"nearest": result})
 
     def status_cmd(self, conn: socket.socket, request: dict[str, Any]):
         conn.sendall(json.dumps({"status": "running"}).encode())
@@ -52,10 +119,15 @@ class ServeCommand(BaseCommand):
         # assume that this is a list of string
         text = request.get("text", None)
 
-        with core.DownloadOrLocalImage(file) as img:
-            result, _ = core_tf.vectorize_with_text(img, text)
+        image = core.DownloadOrLocalImage(file)
+        if text == [] and not image.local:
+            # no text detection, a stored image isn't downloaded at all
+            result = core_tf.vectorize_id(file)
+        else:
+            with image as img:
+                result, _ = core_tf.vectorize_with_text(img, text, None if image.local else file)
 
-        return conn.sendall(json.dumps({"vector": result.tolist()}).encode())
+        return self.respond(conn, request, {"vector": result})
 
     def vectorize_with_text(self, conn: socket.socket, request: dict[str, Any]):
         from .. import core
@@ -64,10 +136,11 @@ class ServeCommand(BaseCommand):
         if not file:
             return conn.sendall(json.dumps({"error": "File not specified"}).encode())
 
-        with core.DownloadOrLocalImage(file) as img:
-            result, texts = core_tf.vectorize_with_text(img)
+        image = core.DownloadOrLocalImage(file)
+        with image as img:
+            result, texts = core_tf.vectorize_with_text(img, _id=None if image.local else file)
 
-        return conn.sendall(json.dumps({"vector": result.tolist(), "text": texts}).encode())
+        return self.respond(conn, request, {"vector": result, "text": texts})
 
     def vectorize_text(self, conn: socket.socket, request: dict[str, Any]):
         from .. import core
@@ -78,47 +151,221 @@ class ServeCommand(BaseCommand):
         result = core.encode_text(text)
         if result is None:
             return conn.sendall(json.dumps({"error": "Invalid text"}).encode())
-        return conn.sendall(json.dumps({"vector": result.tolist()}).encode())
+        return self.respond(conn, request, {"vector": result})
 
-    def process(self, conn: socket.socket):
+    def respond(self, conn: socket.socket, request: dict[str, Any], response: dict[str, Any]):
+        """Send the response, through shared memory if the client asked for it."""
+        from .. import shm_transport
+
+        if request.get("response") == "shm":
+            if self.shm_responses is None:
+                self.shm_responses = shm_transport.ShmResponses()
+            return conn.sendall(self.shm_responses.encode(response))
+        return conn.sendall(shm_transport.encode_json(response))
+
+    def receive(self, conn: socket.socket) -> dict:
+        """Read until the received data is a complete json document."""
+        data = b""
+        while chunk := conn.recv(65536):
+            data += chunk
+            try:
+                return json.loads(data)
+            except ValueError:
+                if len(data) > MAX_REQUEST_SIZE:
+                    raise ValueError("Request is too large")
+        return json.loads(data)
+
+    def read_request(self, conn: socket.socket) -> dict | None:
+        """Read and validate the request, answer with an error if it is invalid."""
         try:
-            received: dict = json.loads(conn.recv(1024))
+            conn.settimeout(RECEIVE_TIMEOUT)
+            received: dict = self.receive(conn)
+            conn.settimeout(None)
         except Exception as e:
             response = {"error": f"Invalid packet: {e}"}
-            return conn.sendall(json.dumps(response).encode())
+            conn.sendall(json.dumps(response).encode())
+            return None
+        return received if self.check_request(conn, received) else None
 
+    def check_request(self, conn: socket.socket, received: dict[str, Any]) -> bool:
+        """Answer with an error if the request is invalid."""
         if not (command := received.get("command", None)):
             response = {"error": "Command not specified"}
-            return conn.sendall(json.dumps(response).encode())
+            conn.sendall(json.dumps(response).encode())
+            return False
 
-        if not (to_run := self._commands.get(command, None)):
+        if command not in self._commands:
             response = {"error": f"Invalid command: {command}"}
-            return conn.sendall(json.dumps(response).encode())
-        
+            conn.sendall(json.dumps(response).encode())
+            return False
+
+        index_dir = received.get("index_dir")
+        if index_dir is not None and os.path.realpath(index_dir) != os.path.realpath(os.getcwd()):
+            response = {"error": f"Serving the index of {os.getcwd()}"}
+            conn.sendall(json.dumps(response).encode())
+            return False
+
+        return True
+
+    def handle(self, conn: socket.socket, received: dict[str, Any]):
         try:
-            to_run(conn, received)
+            self._commands[received["command"]](conn, received)
         except Exception as e:
             response = {"error": str(e)}
             conn.sendall(json.dumps(response).encode())
 
+    def process(self, conn: socket.socket):
+        if (received := self.read_request(conn)) is not None:
+            self.handle(conn, received)
+
     def run(self, namespace: Namespace):
-        if namespace.port:
-            port = namespace.port
-        else:
-            port = 19999
+        port = namespace.port
 
-        if namespace.init:
+        from ..dispatcher import parse_lanes
+        self.lanes = parse_lanes(namespace.lane)
+
+        if namespace.init and namespace.workers <= 1:
             # initialize here
             from .. import core_tf
 
-        print(f"Python is listenning on port: {port}", flush=True)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(("127.0.0.1", port))
-        sock.listen()
+        socks = []
+        if not namespace.no_tcp:
+            print(f"Python is listenning on port: {port}", flush=True)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(("127.0.0.1", port))
+            sock.listen()
+            socks.append(sock)
+
+        if namespace.unix:
+            if os.path.exists(namespace.unix):
+                os.remove(namespace.unix)
+            print(f"Python is listenning on unix socket: {namespace.unix}", flush=True)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(namespace.unix)
+            sock.listen()
+            socks.append(sock)
+
+        if not socks:
+            raise ValueError("--no-tcp requires --unix")
+
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        try:
+            if namespace.workers > 1 and hasattr(os, "fork"):
+                return self.run_prefork(socks, namespace)
+
+            self.serve_forever(socks)
+        finally:
+            if namespace.unix and os.path.exists(namespace.unix):
+                os.remove(namespace.unix)
+
+    def accept_loop(self, sock: socket.socket, reader):
+        # the request is read by the reader, a slow client doesn't block the accept
         while True:
             conn, addr = sock.accept()
-            with conn:
-                self.process(conn)
+            reader.add(conn)
+
+    def serve_forever(self, socks: list[socket.socket]):
+        import threading
+        from ..dispatcher import Dispatcher, RequestReader
+        from ..shm_transport import ShmResponses
+
+        self.shm_responses = ShmResponses()
+        dispatcher = Dispatcher(self.handle, self.lanes)
+        dispatcher.start()
+
+        def on_request(conn: socket.socket, received: dict[str, Any]):
+            if not self.check_request(conn, received):
+                conn.close()
+                return
+            # the lane worker closes the connection
+            dispatcher.submit(conn, received)
+
+        reader = RequestReader(on_request, RECEIVE_TIMEOUT, MAX_REQUEST_SIZE)
+        reader.start()
+        for sock in socks[1:]:
+            threading.Thread(target=self.accept_loop, args=(sock, reader), daemon=True).start()
+        try:
+            self.accept_loop(socks[0], reader)
+        finally:
+            self.shm_responses.close()
+
+    def run_worker(self, socks: list[socket.socket], publisher, namespace: Namespace):
+        from .. import shared_index
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        shared_index.READER = shared_index.SharedIndexReader(publisher)
+
+        if namespace.init:
+            # tensorflow must be initialized after the fork
+            from .. import core_tf
+
+        try:
+            self.serve_forever(socks)
+        finally:
+            os._exit(0)
+
+    def run_prefork(self, socks: list[socket.socket], namespace: Namespace):
+        """Fork the workers, they all accept on the same socket and share the index."""
+        import time
+        from .. import shared_index
+
+        publisher = shared_index.SharedIndexPublisher()
+        try:
+            publisher.publish()
+        except OSError as e:
+            print(f"No index to share: {e}", flush=True)
+
+        reload_requested = False
+
+        def request_reload(*args):
+            nonlocal reload_requested
+            reload_requested = True
+
+        signal.signal(signal.SIGHUP, request_reload)
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+        workers: set[int] = set()
+
+        def spawn():
+            if pid := os.fork():
+                workers.add(pid)
+            else:
+                self.run_worker(socks, publisher, namespace)
+
+        for _ in range(namespace.workers):
+            spawn()
+        print(f"Started {namespace.workers} workers", flush=True)
+
+        last_check = time.monotonic()
+        try:
+            while True:
+                time.sleep(1)
+                while workers and (pid := os.waitpid(-1, os.WNOHANG)[0]):
+                    print(f"Worker {pid} exited, restarting it", flush=True)
+                    workers.discard(pid)
+                    spawn()
+
+                interval = namespace.reload_interval
+                if interval and time.monotonic() - last_check >= interval:
+                    last_check = time.monotonic()
+                    reload_requested = reload_requested or publisher.changed()
+
+                if reload_requested:
+                    reload_requested = False
+                    try:
+                        publisher.publish()
+                    except Exception as e:
+                        print(f"Couldn't reload the index: {e}", flush=True)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+            for pid in workers:
+                os.waitpid(pid, 0)
+            publisher.close()
 
 
 register(ServeCommand())
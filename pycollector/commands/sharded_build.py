@@ -0,0 +1,81 @@
+from argparse import ArgumentParser, Namespace
+from ..base_command import BaseCommand, register
+
+
+class ShardedBuild(BaseCommand):
+
+    def __init__(self) -> None:
+        super().__init__("sharded-build")
+
+    def get_parser(self) -> ArgumentParser:
+        import os
+
+        parser = super().get_parser()
+        parser.description = "Build the index with several worker processes, each building a shard of the items"
+        parser.add_argument("--dup", action="store_true", help="build the dup index")
+        parser.add_argument("-n", "--shards", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("-w", "--workers", type=int, default=None, help="default to the number of shards")
+        parser.add_argument("--full", action="store_true", help="rebuild from the first item")
+        parser.add_argument("--update-text", action="store_true")
+        parser.add_argument("--resume", action="store_true", help="continue the interrupted build of the saved plan")
+        parser.add_argument("--checkpoint-every", type=int, default=25)
+        parser.add_argument("--no-upload", action="store_true")
+        parser.add_argument("--keep-shards", action="store_true", help="don't delete the shards once merged")
+        return parser
+
+    @staticmethod
+    def _last_id(path: str) -> str | None:
+        try:
+            with open(path, mode='r') as f:
+                ids = [x.strip() for x in f if x.strip()]
+        except FileNotFoundError:
+            return None
+        return ids[-1] if ids else None
+
+    def run(self, namespace: Namespace):
+        import shutil
+        from .. import core, journal, segments, sharded_build
+        from . import local_index_dup
+
+        if not namespace.dup and segments.refuse_local_writes(self.name):
+            return
+
+        if namespace.dup:
+            source = "duplicates"
+            paths = (local_index_dup.DUP_IDS_FILE, local_index_dup.DUP_DATAPOINTS_FILE, local_index_dup.DUP_CHECKPOINT_FILE)
+        else:
+            source = "items"
+            paths = (core.IDS_FILE, core.DATAPOINTS_FILE, journal.CHECKPOINT_FILE)
+
+        saved = sharded_build.load_plan() if namespace.resume else None
+        if saved is not None and saved["source"] == source:
+            parts, start_after_id = saved["shards"], saved["start_after_id"]
+            print(f"Resuming the build of {len(parts)} shards.")
+        else:
+            # partial shards of another plan can't be reused
+            shutil.rmtree(sharded_build.SHARDS_DIR, ignore_errors=True)
+            start_after_id = None if namespace.full else self._last_id(paths[0])
+            if start_after_id:
+                print(f"Starting update after item: {start_after_id}")
+            parts = sharded_build.plan(source, namespace.shards, start_after_id)
+
+        total = sum(len(x) for x in parts)
+        if not total:
+            print("No item found to update.")
+            return
+
+        workers = namespace.workers or len(parts)
+        print(f"Building {total} items in {len(parts)} shards with {min(workers, len(parts))} workers")
+        sharded_build.build(parts, source, workers, namespace.update_text, namespace.checkpoint_every)
+
+        rows = sharded_build.merge(parts, *paths, start_after_id=start_after_id)
+        print(f"{rows} rows merged.")
+
+        if not namespace.keep_shards:
+            shutil.rmtree(sharded_build.SHARDS_DIR, ignore_errors=True)
+
+        if not namespace.dup and not namespace.no_upload:
+            core.upload_local_index()
+
+
+register(ShardedBuild())
@@ -0,0 +1,116 @@
+from argparse import ArgumentParser, Namespace
+from ..base_command import BaseCommand, register
+
+
+DUP_IDS_FILE = "./dupids.txt"
+
+DUP_DATAPOINTS_FILE = "./dupdatapoints.bin"
+
+
+class TensorStoreCommand(BaseCommand):
+
+    def __init__(self) -> None:
+        super().__init__("tensor-store")
+
+        self.actions = {
+            "build": self.build,
+            "compact": self.compact,
+            "status": self.status,
+            "reembed": self.reembed
+        }
+
+    def get_parser(self) -> ArgumentParser:
+        parser = super().get_parser()
+        parser.description = "Manage the store of preprocessed images"
+        subparser = parser.add_subparsers(dest="subcommand")
+        parser_build = subparser.add_parser("build", description="decode the images of the indexed items missing from the store")
+        parser_build.add_argument("-w", "--workers", type=int, default=8)
+        subparser.add_parser("compact", description="remove the items that are not indexed anymore")
+        subparser.add_parser("status", description="print the size of the store")
+        parser_reembed = subparser.add_parser(
+            "reembed", description="vectorize again the image rows of the index from the store"
+        )
+        parser_reembed.add_argument("--dup", action="store_true", help="update the dup index")
+        parser_reembed.add_argument("-b", "--batch-size", type=int, default=64)
+        return parser
+
+    def run(self, namespace: Namespace):
+        from ..tensor_store import TensorStore
+        return self.actions[namespace.subcommand](TensorStore(), namespace)
+
+    @staticmethod
+    def _index_ids(dup: bool | None = None) -> list[str]:
+        """Ids of the local index, of the dup index, or of both when dup is None."""
+        import os
+        from .. import core
+
+        files = {False: core.IDS_FILE, True: DUP_IDS_FILE}
+        ids = []
+        for key, path in files.items():
+            if (dup is None or dup == key) and os.path.exists(path):
+                with open(path, mode='r') as f:
+                    ids.extend(x.strip() for x in f if x.strip())
+        return ids
+
+    def build(self, store, namespace: Namespace):
+        added, errors = store.build(self._index_ids(), workers=namespace.workers)
+        for _id, error in errors.items():
+            print(f"Couldn't decode {_id}: {error}")
+        print(f"Done! {added} added, {len(store)} in the store.")
+
+    def compact(self, store, namespace: Namespace):
+        removed = store.compact(self._index_ids())
+        print(f"Done! {removed} removed, {len(store)} in the store.")
+
+    def status(self, store, namespace: Namespace):
+        ids = self._index_ids()
+        missing = sum(1 for x in ids if x not in store)
+        print(f"{len(store)} images in the store, {missing} indexed items missing.")
+
+    def reembed(self, store, namespace: Namespace):
+        """The rows vectorized from their text are kept, the others are vectorized
+        again from the store in batches."""
+        import os
+        import numpy as np
+        from .. import core, core_tf, segments
+
+        if not namespace.dup and segments.refuse_local_writes(f"{self.name} reembed"):
+            return
+
+        ids = self._index_ids(namespace.dup)
+        datapoints_path = DUP_DATAPOINTS_FILE if namespace.dup else core.DATAPOINTS_FILE
+        if os.path.getsize(datapoints_path) != len(ids) * core.DIMENSION * 4:
+            raise ValueError("Inconsistences in data.")
+        datapoints = np.memmap(datapoints_path, dtype=np.float32, mode='r+', shape=(len(ids), core.DIMENSION))
+
+        print("Reading the text of all the items...")
+        if namespace.dup:
+            query = core.get_admin_user().collection("duplicates").select(["text", "timestamp"]).order_by("timestamp")
+            items = core.stream_query(query)
+        else:
+            items = core.get_all_items(fields=["text"])
+        texts = {item.id: (item.to_dict() or {}).get("text") for item in items}
+
+        with_text = [_id for _id in ids if texts.get(_id)]
+        _, valid = core.encode_texts([texts[x] for x in with_text]) if with_text else (None, [])
+        from_text = {_id for _id, is_valid in zip(with_text, valid) if is_valid}
+        images = [_id for _id in ids if _id not in from_text]
+
+        rows = {_id: x for x, _id in enumerate(ids)}
+        missing = [x for x in images if x not in store]
+        if missing:
+            print(f"{len(missing)} images are not in the store, run tensor-store build first.")
+
+        done = 0
+        total = len(images) - len(missing)
+        for batch_ids, tensors in store.batches(images, namespace.batch_size):
+            vectors = core_tf.vectorize_tensors(tensors, namespace.batch_size)
+            for _id, vector in zip(batch_ids, vectors):
+                datapoints[rows[_id]] = vector
+            done += len(batch_ids)
+            print(f"{done}/{total} images vectorized", flush=True)
+        datapoints.flush()
+        print(f"Done! {done} rows updated.")
+
+
+register(TensorStoreCommand())
@@ -1,55 +1,55 @@
-from argparse import Namespace
+from argparse import ArgumentParser, Namespace
 from ..base_command import BaseCommand, register
 
 
 
 class UpdateRemoteIndex(BaseCommand):
 
-    def __init__(self) -> None:
-        super().__init__("update-remote-index")
+    index = "projects/339871598892/locations/northamerica-northeast1/indexes/5608529648448176128"
+    manifest = "./sync_manifest.json"
 
-    def run(self, namespace: Namespace):
-        # https://cloud.google.com/python/docs/reference/aiplatform/1.24.0/google.cloud.aiplatform_v1.services.index_service.IndexServiceClient
-        from google.cloud.aiplatform_v1 import IndexServiceClient, UpsertDatapointsRequest, IndexDatapoint
+    def __init__(self, name: str = "update-remote-index") -> None:
+        super().__init__(name)
+
+    def get_parser(self) -> ArgumentParser:
+        from ..remote_sync import REQUESTS_PER_MINUTE
 
-        import time
+        parser = super().get_parser()
+        parser.description = "Upsert the new or changed datapoints and remove the deleted ones"
+        parser.add_argument("--full", action="store_true", help="ignore the manifest and upsert everything")
+        parser.add_argument("--dry-run", action="store_true", help="only print what would be done")
+        parser.add_argument("-b", "--batch-size", type=int, default=1000)
+        parser.add_argument("--requests-per-minute", type=float, default=REQUESTS_PER_MINUTE)
+        parser.add_argument("-c", "--concurrency", type=int, default=4)
+        parser.add_argument("--max-retries", type=int, default=5)
+        return parser
+
+    def load(self):
         from .. import core
+        return core.load_ids(), core.load_datapoints()
 
-        client = IndexServiceClient(client_options={"api_endpoint": "northamerica-northeast1-aiplatform.googleapis.com"})
-        
-        indexes = core.load_ids()
-        datapoints = core.load_datapoints()
-
-        start = 0
-        step = 1000
-
-        first_time = True
-
-        for end in range(start + step, len(indexes) + step, step):
-            if not first_time:
-                print("Sleeping...", flush=True)
-                time.sleep(30) # do only 2 request per minutes
-            
-            end = min(end, len(indexes))
-
-            print(f"Updating from {start} to {end - 1}...")
-            request = UpsertDatapointsRequest()
-            request.index = "projects/339871598892/locations/northamerica-northeast1/indexes/5608529648448176128"
-
-            for idx, dt in zip(indexes[start:end], datapoints[start:end]):
-                request.datapoints.append(
-                    IndexDatapoint(
-                        datapoint_id=idx,
-                        feature_vector=dt.tolist() 
-                    )
-                )
-
-            response = client.upsert_datapoints(request)
-            # this returns nothing...
-            # print(response)
-
-            start = end
-            first_time = False
+    def run(self, namespace: Namespace):
+        from .. import remote_sync
+
+        indexes, datapoints = self.load()
+        if len(indexes) != datapoints.shape[0]:
+            raise ValueError("Inconsistences in data.")
+
+        client = remote_sync.get_client()
+        upserted, removed = remote_sync.sync(
+            client,
+            self.index,
+            indexes,
+            datapoints,
+            self.manifest,
+            batch_size=namespace.batch_size,
+            requests_per_minute=namespace.requests_per_minute,
+            concurrency=namespace.concurrency,
+            max_retries=namespace.max_retries,
+            full=namespace.full,
+            dry_run=namespace.dry_run
+        )
+        print(f"Done! {upserted} upserted, {removed} removed.")
 
 
 register(UpdateRemoteIndex())
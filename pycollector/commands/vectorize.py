@@ -12,17 +12,33 @@ class Vectorize(BaseCommand):
         parser.description = "Vectorize specified file"
         parser.add_argument("file", nargs=1, type=str, help="the local or remote file")
         parser.add_argument("--no-text", action="store_true")
+        parser.add_argument("--local", action="store_true", help="don't use a running serve instance")
 
         return parser
 
     def run(self, namespace: Namespace):
+        if not namespace.local:
+            from .. import client
+            request = {"command": "vectorize", "file": client.file_argument(namespace.file[0])}
+            if namespace.no_text:
+                request["text"] = []
+            try:
+                response = client.request(request)
+            except client.ServeError as e:
+                print(f"serve failed ({e}), vectorizing in process.")
+                response = None
+            if response is not None:
+                print(list(map(float, response["vector"])))
+                return
+
         from .. import core, core_tf
 
-        with core.DownloadOrLocalImage(namespace.file[0]) as file:
-            if namespace.no_text:
-                result = core_tf.vectorize_file(file)
-            else:
-                result, _ = core_tf.vectorize_with_text(file)
+        if namespace.no_text:
+            result = core_tf.vectorize_id(namespace.file[0])
+        else:
+            image = core.DownloadOrLocalImage(namespace.file[0])
+            with image as file:
+                result, _ = core_tf.vectorize_with_text(file, _id=None if image.local else namespace.file[0])
 
         print(result.tolist())
 
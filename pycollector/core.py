@@ -1,4 +1,4 @@
-from typing import Iterable, Optional, TYPE_CHECKING
+from typing import IO, Callable, Iterable, Iterator, Optional, TYPE_CHECKING
 import os
 from pathlib import Path
 
@@ -15,10 +15,21 @@ BUCKET: Optional["storage.Bucket"] = None
 
 FIRESTORE_DB: Optional["firestore.Client"] = None
 
+ANNOTATOR = None
+
+DIMENSION = 1280
+
+IDS_FILE = "./ids.txt"
+
+DATAPOINTS_FILE = "./datapoints.bin"
+
 
 def get_bucket():
     global BUCKET
-    if BUCKET is None:
+    if BUCKET is None and (local_bucket := os.environ.get("PYCOLLECTOR_LOCAL_BUCKET")):
+        from .fakes import LocalBucket
+        BUCKET = LocalBucket(local_bucket)
+    elif BUCKET is None:
         from google.cloud import storage
         storage_client = storage.Client(PROJECT_ID)
         BUCKET = storage_client.get_bucket(f"{PROJECT_ID}-collector")
@@ -27,7 +38,10 @@ def get_bucket():
 
 def get_database():
     global FIRESTORE_DB
-    if FIRESTORE_DB is None:
+    if FIRESTORE_DB is None and (memory_database := os.environ.get("PYCOLLECTOR_MEMORY_DATABASE")):
+        from .fakes import MemoryDatabase
+        FIRESTORE_DB = MemoryDatabase.load(memory_database) if os.path.isfile(memory_database) else MemoryDatabase()
+    elif FIRESTORE_DB is None:
         from google.cloud import firestore
         FIRESTORE_DB = firestore.Client(PROJECT_ID, database="collector")
     return FIRESTORE_DB
@@ -47,14 +61,24 @@ class DownloadOrLocalImage:
     def __init__(self, imageid: str) -> None:
         self.filepath = Path(imageid)
         self.local = self.filepath.exists()
-        self.filename = f"{imageid}.png"
+        self.blob_name = f"{imageid}.png"
+        self.filename = ""
 
     def __enter__(self, *args, **kwargs) -> str:
+        import tempfile
+
         if self.local:
             return str(self.filepath)
 
-        blob = get_bucket().get_blob(self.filename)
-        blob.download_to_filename(self.filename)
+        blob = get_bucket().get_blob(self.blob_name)
+        # concurrent requests for the same id must not share the file
+        fd, self.filename = tempfile.mkstemp(prefix=f"{self.filepath.name}-", suffix=".png", dir=".")
+        os.close(fd)
+        try:
+            blob.download_to_filename(self.filename)
+        except BaseException:
+            os.remove(self.filename)
+            raise
         return self.filename
 
     def __exit__(self, *args, **kwargs):
@@ -62,8 +86,20 @@ class DownloadOrLocalImage:
             os.remove(self.filename)
 
 
+def get_annotator():
+    """The local text detection stand-in, None to use the vision api."""
+    global ANNOTATOR
+    if ANNOTATOR is None and os.environ.get("PYCOLLECTOR_FAKE_OCR") is not None:
+        from .fakes import SlowAnnotator
+        ANNOTATOR = SlowAnnotator.from_env()
+    return ANNOTATOR
+
+
 def detect_text(path: str) -> list[str]:
     """Detect the text in the specified local image"""
+    if (annotator := get_annotator()) is not None:
+        return annotator.detect_text(path)
+
     # https://cloud.google.com/vision/docs/ocr?hl=fr
     from google.cloud import vision
 
@@ -99,6 +135,20 @@ def encode_text(texts: list[str], dimension: int = 1280) -> np.ndarray | None:
     return None
 
 
+def encode_texts(
+    texts: list[list[str]],
+    dimension: int = 1280
+) -> tuple[np.ndarray, np.ndarray]:
+    """Encode many texts like encode_text.  Return the vectors and a mask of the
+    ones that have enough distinct characters."""
+    out = np.zeros((len(texts), dimension), dtype=np.float32)
+    for x, text in enumerate(texts):
+        codes = np.fromiter((ord(l) for l in "".join(text)), dtype=np.int64)
+        codes = codes[codes < dimension]
+        out[x] = np.bincount(codes, minlength=dimension)
+    return out, np.count_nonzero(out, axis=1) >= 3
+
+
 def decode_text(data: Iterable[float]) -> dict[str, int]:
     out = {}
     for idx, n in enumerate(data):
@@ -108,16 +158,75 @@ def decode_text(data: Iterable[float]) -> dict[str, int]:
     return out
 
 
-def get_all_items(
+ITEMS_PAGE_SIZE = 500
+
+
+def _transient_errors() -> tuple[type[Exception], ...]:
+    try:
+        from google.api_core import exceptions
+    except ImportError:
+        # the local stand-ins don't fail
+        return ()
+    return (
+        exceptions.ServiceUnavailable,
+        exceptions.DeadlineExceeded,
+        exceptions.InternalServerError,
+        exceptions.Aborted,
+        exceptions.ResourceExhausted
+    )
+
+
+def stream_query(
+    query,
+    page_size: int = ITEMS_PAGE_SIZE,
+    max_retries: int = 5
+) -> Iterator["firestore.DocumentSnapshot"]:
+    """Iterate over the query one page at a time.
+
+    The query must select the fields it is ordered by.  Each page is read in full
+    before its documents are yielded, so the stream isn't kept open while the
+    consumer works on them.  A page that fails with a transient error is requested
+    again.
+    """
+    import time
+
+    transient = _transient_errors()
+    last = None
+    retries = 0
+    while True:
+        page = query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+
+        try:
+            snapshots = list(page.stream())
+        except transient as e:
+            retries += 1
+            if retries > max_retries:
+                raise
+            print(f"Error reading items ({e}), retrying...", flush=True)
+            time.sleep(2 ** retries)
+            continue
+
+        retries = 0
+        if snapshots:
+            last = snapshots[-1]
+        yield from snapshots
+
+        if len(snapshots) < page_size:
+            return
+
+
+def _items_query(
     start_id: str | None = None,
     start_after_id: str | None = None,
     fields: Iterable[str] | None = None
 ):
     item_collection = get_item_collection()
     query = item_collection.order_by("timestamp", direction="ASCENDING")
-    if fields is None:
-        fields = []
-    query = query.select(fields)
+    if fields is not None:
+        # the cursor of the next page need the timestamp
+        query = query.select(list({*fields, "timestamp"}))
     if start_id:
         doc = item_collection.document(start_id)
         snapshot = doc.get(["timestamp"])
@@ -126,37 +235,129 @@ def get_all_items(
         doc = item_collection.document(start_after_id)
         snapshot = doc.get(["timestamp"])
         query = query.start_after(snapshot)
-    return query.get()
+    return query
+
+
+def get_all_items(
+    start_id: str | None = None,
+    start_after_id: str | None = None,
+    fields: Iterable[str] | None = None,
+    page_size: int = ITEMS_PAGE_SIZE
+) -> Iterator["firestore.DocumentSnapshot"]:
+    """Stream the items ordered by timestamp, ``page_size`` documents at a time."""
+    if fields is None:
+        fields = []
+    query = _items_query(start_id, start_after_id, fields)
+    return stream_query(query, page_size)
+
+
+def count_items(
+    start_id: str | None = None,
+    start_after_id: str | None = None
+) -> int:
+    """Count the items with an aggregation query, without reading them."""
+    query = _items_query(start_id, start_after_id)
+    return count_query(query)
+
+
+def count_query(query) -> int:
+    return int(query.count().get()[0][0].value)
+
+
+def dup_query(start_id: str | None = None):
+    """The duplicates ordered by timestamp, starting at start_id."""
+    collection = get_admin_user().collection("duplicates")
+    query = collection.select(["text", "timestamp"]).order_by("timestamp")
+    if start_id:
+        query = query.start_at(collection.document(start_id).get(["timestamp"]))
+    return query
+
+
+def replace_file(path: str, write: Callable[[IO], None], mode: str = 'w'):
+    """Write to a temporary file and move it over path once it is on disk."""
+    tmp = f"{path}.tmp"
+    with open(tmp, mode=mode) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 
 def load_ids() -> list[str]:
-    with open("./ids.txt", mode='r') as f:
+    with open(IDS_FILE, mode='r') as f:
         return list(map(lambda x: x.strip(), f.readlines()))
 
 
 def write_ids(ids: list[str]):
-    with open("./ids.txt", mode='w') as f:
+    """Rewrite the ids, after the datapoints, and record the new row count in the journal checkpoint."""
+    from . import journal
+
+    def write(f):
         for _id in ids:
             f.write(f"{_id}\n")
+    replace_file(IDS_FILE, write)
+    # the removed rows must not be reported as lost by the next repair
+    journal.write_checkpoint(len(ids), ids[-1] if ids else None)
 
 
 def load_datapoints() -> np.ndarray:
-    return np.fromfile("./datapoints.bin", dtype=np.float32).reshape((-1, 1280))
+    return np.fromfile(DATAPOINTS_FILE, dtype=np.float32).reshape((-1, DIMENSION))
 
 
 def write_datapoints(arr: np.ndarray):
-    arr.tofile("./datapoints.bin")
+    replace_file(DATAPOINTS_FILE, arr.tofile, mode='wb')
+
+
+def load_index() -> tuple[list[str], np.ndarray]:
+    """Load the ids and datapoints from the segments if any, else from the local index."""
+    from . import segments
+    if segments.exists():
+        return segments.SegmentedIndex().live()
+    return load_ids(), load_datapoints()
+
+
+def append_items(writer, items, update_text: bool = False, total: int | str = "?"):
+    """Vectorize the items and append them to the journaled writer."""
+    from . import core_tf
+
+    for x, item in enumerate(items):
+        _id = item.id
+        print(f'{x + 1}/{total} {_id}')
+        with DownloadOrLocalImage(_id) as filename:
+            texts = detect_text(filename)
+            if update_text:
+                item.reference.update({"text": texts})
+                print(f'Text updated with {texts}')
+            result, _ = core_tf.vectorize_with_text(filename, texts=texts, _id=_id)
+        writer.append(_id, result)
+
+
+def append_dup_items(writer, items, total: int | str = "?"):
+    """Vectorize the duplicates from their text when it is valid, else from their
+    image, and append them to the journaled writer."""
+    for x, item in enumerate(items):
+        _id = item.id
+        print(f'{x + 1}/{total} {_id}')
+        if text := item.get("text"):
+            print("Using text: ", text)
+            result = encode_text(text)
+            if result is not None:
+                writer.append(_id, result)
+                continue
+            print("Text is not valid not enough character")
+
+        from . import core_tf
+        writer.append(_id, core_tf.vectorize_id(_id))
 
 
 def upload_local_index():
-    for file in ['ids.txt', 'datapoints.bin']:
-        print(f"uploading {file}...")
-        blob = get_bucket().blob(f'embeddings/{file}')
-        blob.upload_from_filename(file)
+    from . import transfer
+    # upload the ids last so a reader never sees ids without their datapoints
+    for file in ['datapoints.bin', 'ids.txt']:
+        transfer.upload_file(get_bucket(), file, f'embeddings/{file}')
 
 
 def download_local_index():
+    from . import transfer
     for file in ['ids.txt', 'datapoints.bin']:
-        print(f"downloading {file}...")
-        blob = get_bucket().blob(f'embeddings/{file}')
-        blob.download_to_filename(file)
+        transfer.download_file(get_bucket(), f'embeddings/{file}', file)
@@ -1,9 +1,7 @@
 import tensorflow as tf
 import numpy as np
 
-from PIL import Image
-
-from . import core
+from . import core, tensor_store
 
 
 MODEL_B0 = tf.keras.applications.EfficientNetB0(include_top=False, pooling="avg", weights="imagenet")
@@ -12,8 +10,10 @@ MODEL_B0 = tf.keras.applications.EfficientNetB0(include_top=False, pooling="avg"
 
 def vectorize_with_text(
     filename: str,
-    texts: list[str] | None = None
+    texts: list[str] | None = None,
+    _id: str | None = None
 ) -> tuple[np.ndarray, list[str]]:
+    """``_id`` is the item of the image, its tensor is read from the store when it is there."""
     if texts is None:
         texts = core.detect_text(filename)
 
@@ -22,10 +22,76 @@ def vectorize_with_text(
         if encoded_text is not None:
             return encoded_text, texts
 
-    return vectorize_file(filename), []
+    return vectorize_file(filename, _id), []
+
+
+def _load_image(filename: str, _id: str | None = None) -> np.ndarray:
+    """The preprocessed image, from the tensor store when the item is in it."""
+    if _id is not None and (store := tensor_store.get_store()) is not None:
+        if (tensor := store.get(_id)) is not None:
+            return np.asarray(tensor)
+    return tensor_store.preprocess(filename)
+
+
+def vectorize_file(filename: str, _id: str | None = None) -> np.ndarray:
+    return MODEL_B0.predict(np.array([_load_image(filename, _id)]))[0]
+
+
+def vectorize_tensors(tensors: np.ndarray, batch_size: int = 32) -> np.ndarray:
+    """Vectorize images already preprocessed by ``tensor_store.preprocess``."""
+    if not len(tensors):
+        return np.zeros((0, core.DIMENSION), dtype=np.float32)
+    return MODEL_B0.predict(tensors, batch_size=batch_size, verbose=0)
+
 
+def vectorize_id(_id: str) -> np.ndarray:
+    """Vectorize the image of an item, from the tensor store when it is there."""
+    if (store := tensor_store.get_store()) is not None and (tensor := store.get(_id)) is not None:
+        return vectorize_tensors(tensor[None])[0]
+
+    with core.DownloadOrLocalImage(_id) as filename:
+        return vectorize_file(filename)
+
+
+def vectorize_files(
+    filenames: list[str],
+    batch_size: int = 32,
+    ids: list[str | None] | None = None
+) -> np.ndarray:
+    """Vectorize the images in batches through one model call per batch."""
+    if not filenames:
+        return np.zeros((0, core.DIMENSION), dtype=np.float32)
+    if ids is None:
+        ids = [None] * len(filenames)
+    images = np.array([_load_image(x, _id) for x, _id in zip(filenames, ids)])
+    return MODEL_B0.predict(images, batch_size=batch_size, verbose=0)
+
+
+def vectorize_many_with_text(
+    filenames: list[str],
+    texts: list[list[str] | None] | None = None,
+    ids: list[str | None] | None = None
+) -> list[tuple[np.ndarray, list[str]]]:
+    """Same as vectorize_with_text for many files, the images without valid text
+    are vectorized in a single batch."""
+    if texts is None:
+        texts = [None] * len(filenames)
+    if ids is None:
+        ids = [None] * len(filenames)
+
+    results: list[tuple[np.ndarray, list[str]] | None] = []
+    to_vectorize: list[int] = []
+    for x, (filename, text) in enumerate(zip(filenames, texts)):
+        if text is None:
+            text = core.detect_text(filename)
+        encoded_text = core.encode_text(text) if text else None
+        if encoded_text is not None:
+            results.append((encoded_text, text))
+        else:
+            results.append(None)
+            to_vectorize.append(x)
 
-def vectorize_file(filename: str) -> np.ndarray:
-    img = Image.open(filename).convert("RGB")
-    resized = np.array(img.resize([224, 224]))
-    return MODEL_B0.predict(np.array([resized]))[0]
+    vectors = vectorize_files([filenames[x] for x in to_vectorize], ids=[ids[x] for x in to_vectorize])
+    for x, vector in zip(to_vectorize, vectors):
+        results[x] = (vector, [])
+    return results
@@ -0,0 +1,239 @@
+"""Dispatch the ``serve`` requests in lanes.
+
+Each command belongs to a lane with its own worker threads and bounded queue, so
+a cheap ``status`` never waits behind an OCR + inference request.  A request is
+rejected right away with a retry hint when its lane is full, and a request whose
+deadline passed while it was queued is dropped instead of being processed.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Callable
+import json
+import queue
+import socket
+import threading
+import time
+
+
+@dataclass
+class Lane:
+    name: str
+    workers: int
+    queue_size: int
+    # moving average of the time needed to process a request
+    service_time: float = 0.1
+    pending: queue.Queue = field(init=False)
+
+    def __post_init__(self):
+        self.pending = queue.Queue(maxsize=self.queue_size)
+
+    def retry_after(self) -> float:
+        return round(self.service_time * (self.pending.qsize() + 1) / self.workers, 3)
+
+    def record(self, duration: float):
+        self.service_time = 0.8 * self.service_time + 0.2 * duration
+
+
+DEFAULT_LANES = {
+    "light": (2, 64),
+    "search": (2, 32),
+    "heavy": (1, 8)
+}
+
+COMMAND_LANES = {
+    "status": "light",
+    "vectorize-text": "light",
+    "nearest-neighbors": "search",
+    "nearest-neighbors-radius": "search",
+    "nearest-neighbors-batch": "heavy",
+    "vectorize": "heavy",
+    "vectorize-with-text": "heavy"
+}
+
+
+def parse_lanes(specs: list[str]) -> dict[str, tuple[int, int]]:
+    """Parse ``name=workers:queue_size`` overrides of the default lanes."""
+    lanes = dict(DEFAULT_LANES)
+    for spec in specs:
+        name, _, value = spec.partition("=")
+        workers, _, size = value.partition(":")
+        if name not in lanes:
+            raise ValueError(f"Invalid lane: {name}")
+        lanes[name] = (int(workers), int(size or lanes[name][1]))
+    return lanes
+
+
+def send(conn: socket.socket, response: dict[str, Any]):
+    try:
+        conn.sendall(json.dumps(response).encode())
+    except OSError:
+        # the client is gone
+        pass
+
+
+class Dispatcher:
+
+    def __init__(
+        self,
+        handle: Callable[[socket.socket, dict[str, Any]], None],
+        lanes: dict[str, tuple[int, int]] | None = None,
+        command_lanes: dict[str, str] | None = None
+    ) -> None:
+        self.handle = handle
+        self.lanes = {
+            name: Lane(name, workers, size)
+            for name, (workers, size) in (lanes or DEFAULT_LANES).items()
+        }
+        self.command_lanes = command_lanes or COMMAND_LANES
+
+    def start(self):
+        for lane in self.lanes.values():
+            for x in range(lane.workers):
+                threading.Thread(target=self._work, args=(lane,), name=f"{lane.name}-{x}", daemon=True).start()
+
+    def lane_for(self, command: str | None) -> Lane:
+        return self.lanes[self.command_lanes.get(command or "", "heavy")]
+
+    @staticmethod
+    def deadline(request: dict[str, Any], received: float) -> float | None:
+        """The client can send an absolute ``deadline`` (unix time) or a ``timeout`` in seconds."""
+        if (deadline := request.get("deadline")) is not None:
+            return float(deadline)
+        if (timeout := request.get("timeout")) is not None:
+            return received + float(timeout)
+        return None
+
+    def submit(self, conn: socket.socket, request: dict[str, Any]) -> bool:
+        """Queue the request, or reject it when its lane is full.  The connection is
+        closed by the lane worker."""
+        lane = self.lane_for(request.get("command"))
+        deadline = self.deadline(request, time.time())
+        try:
+            lane.pending.put_nowait((conn, request, deadline))
+            return True
+        except queue.Full:
+            send(conn, {"error": "Server busy", "lane": lane.name, "retry_after": lane.retry_after()})
+            conn.close()
+            return False
+
+    def _work(self, lane: Lane):
+        while True:
+            conn, request, deadline = lane.pending.get()
+            try:
+                if deadline is not None and time.time() > deadline:
+                    send(conn, {"error": "Deadline exceeded"})
+                    continue
+
+                start = time.monotonic()
+                self.handle(conn, request)
+                lane.record(time.monotonic() - start)
+            except Exception as e:
+                send(conn, {"error": str(e)})
+            finally:
+                conn.close()
+                lane.pending.task_done()
+
+
+class RequestReader(threading.Thread):
+    """Read the requests of the accepted connections.
+
+    A single thread waits on all the connections with a selector, so a slow or
+    idle client never delays the accept of the others.  Once a request is a
+    complete json document, ``on_request`` is called with the connection (back in
+    blocking mode) and the request, to be classified in a lane.
+    """
+
+    def __init__(
+        self,
+        on_request: Callable[[socket.socket, dict[str, Any]], None],
+        timeout: float = 10.0,
+        max_size: int = 64 * 1024 * 1024
+    ) -> None:
+        import selectors
+
+        super().__init__(daemon=True, name="reader")
+        self.on_request = on_request
+        self.timeout = timeout
+        self.max_size = max_size
+        self.selector = selectors.DefaultSelector()
+        self.added: queue.Queue = queue.Queue()
+        # written to wake the selector up when a connection is added
+        self._wake_read, self._wake_write = socket.socketpair()
+        self._wake_read.setblocking(False)
+        self.selector.register(self._wake_read, selectors.EVENT_READ)
+
+    def add(self, conn: socket.socket):
+        self.added.put(conn)
+        try:
+            self._wake_write.send(b"\0")
+        except BlockingIOError:
+            # already awake
+            pass
+
+    def _register(self):
+        import selectors
+
+        while True:
+            try:
+                conn = self.added.get_nowait()
+            except queue.Empty:
+                return
+            conn.setblocking(False)
+            # [data, deadline]
+            self.selector.register(conn, selectors.EVENT_READ, [b"", time.monotonic() + self.timeout])
+
+    def _close(self, conn: socket.socket, error: str):
+        self.selector.unregister(conn)
+        conn.setblocking(True)
+        send(conn, {"error": error})
+        conn.close()
+
+    def _read(self, conn: socket.socket, state: list):
+        try:
+            chunk = conn.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.selector.unregister(conn)
+            conn.close()
+            return
+
+        state[0] += chunk
+        try:
+            received = json.loads(state[0])
+        except ValueError:
+            if not chunk:
+                return self._close(conn, "Invalid packet: incomplete request")
+            if len(state[0]) > self.max_size:
+                return self._close(conn, "Invalid packet: Request is too large")
+            return
+
+        self.selector.unregister(conn)
+        conn.setblocking(True)
+        if not isinstance(received, dict):
+            send(conn, {"error": "Invalid packet: not an object"})
+            conn.close()
+            return
+        try:
+            self.on_request(conn, received)
+        except Exception as e:
+            send(conn, {"error": str(e)})
+            conn.close()
+
+    def run(self):
+        while True:
+            events = self.selector.select(timeout=0.5)
+            for key, _ in events:
+                if key.fileobj is self._wake_read:
+                    try:
+                        while self._wake_read.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    self._register()
+                else:
+                    self._read(key.fileobj, key.data)
+
+            now = time.monotonic()
+            for key in list(self.selector.get_map().values()):
+                if key.fileobj is not self._wake_read and key.data[1] < now:
+                    self._close(key.fileobj, "Invalid packet: timed out")
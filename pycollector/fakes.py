@@ -0,0 +1,420 @@
+"""Local stand-ins for the google services used by pycollector.
+
+Set ``PYCOLLECTOR_LOCAL_BUCKET`` to a directory to replace the storage bucket,
+``PYCOLLECTOR_FAKE_OCR`` to a latency in seconds to replace the text detection
+(the texts returned are ``PYCOLLECTOR_FAKE_OCR_TEXT``, comma separated) and
+``PYCOLLECTOR_MEMORY_DATABASE`` to a json file (``{"collection/path": {id: {...}}}``)
+to replace firestore with an in memory database loaded from it, or to any
+other value to start with an empty one.
+
+``FakeIndexServiceClient`` replaces the Vertex AI index client in the tests, a
+sync against it doesn't save the sync manifest.
+"""
+from typing import Any, Iterable, Iterator
+from pathlib import Path
+import base64
+import hashlib
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+
+
+def _crc32c(data: bytes) -> str | None:
+    try:
+        import google_crc32c
+    except ImportError:
+        return None
+    return base64.b64encode(google_crc32c.Checksum(data).digest()).decode()
+
+
+class LocalBlob:
+    """Subset of ``storage.Blob`` backed by a file."""
+
+    def __init__(self, bucket: "LocalBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.path = bucket.root.joinpath(name)
+        self.size: int | None = None
+        self.md5_hash: str | None = None
+        self.crc32c: str | None = None
+        self.generation: int | None = None
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def reload(self):
+        data = self.path.read_bytes()
+        self.size = len(data)
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.crc32c = _crc32c(data)
+        self.generation = self.path.stat().st_mtime_ns
+
+    def upload_from_filename(self, filename: str, **kwargs):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.uploading")
+        shutil.copyfile(filename, tmp)
+        os.replace(tmp, self.path)
+        self.reload()
+
+    def upload_from_string(self, data: bytes | str, **kwargs):
+        if isinstance(data, str):
+            data = data.encode()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_bytes(data)
+        self.reload()
+
+    def download_as_bytes(self, start: int | None = None, end: int | None = None, **kwargs) -> bytes:
+        with open(self.path, mode='rb') as f:
+            f.seek(start or 0)
+            if end is None:
+                return f.read()
+            # like gcs, end is inclusive
+            return f.read(end - (start or 0) + 1)
+
+    def download_to_filename(self, filename: str, **kwargs):
+        shutil.copyfile(self.path, filename)
+
+    def delete(self):
+        self.path.unlink()
+
+
+class LocalBucket:
+    """Subset of ``storage.Bucket`` backed by a directory."""
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.name = str(self.root)
+
+    def blob(self, name: str) -> LocalBlob:
+        return LocalBlob(self, name)
+
+    def get_blob(self, name: str) -> LocalBlob | None:
+        blob = self.blob(name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+    def list_blobs(self, prefix: str = ""):
+        for path in sorted(self.root.rglob("*")):
+            name = path.relative_to(self.root).as_posix()
+            if path.is_file() and name.startswith(prefix):
+                yield self.get_blob(name)
+
+
+class SlowAnnotator:
+    """Text detection answering canned texts after ``latency`` seconds.
+
+    ``jitter`` is the fraction of the latency randomly added or removed.
+    """
+
+    def __init__(self, latency: float = 0.0, texts: Iterable[str] = ("pin", "gallery"), jitter: float = 0.0) -> None:
+        self.latency = latency
+        self.texts = list(texts)
+        self.jitter = jitter
+
+    @classmethod
+    def from_env(cls) -> "SlowAnnotator":
+        texts = os.environ.get("PYCOLLECTOR_FAKE_OCR_TEXT", "pin,gallery")
+        return cls(
+            float(os.environ.get("PYCOLLECTOR_FAKE_OCR", 0) or 0),
+            [x for x in texts.split(",") if x],
+            float(os.environ.get("PYCOLLECTOR_FAKE_OCR_JITTER", 0) or 0)
+        )
+
+    def detect_text(self, path: str) -> list[str]:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        if self.latency > 0:
+            time.sleep(max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter))))
+        return list(self.texts)
+
+
+def _value(data: dict[str, Any], field: str) -> Any:
+    for key in field.split("."):
+        data = data[key]
+    return data
+
+
+class MemorySnapshot:
+    """Subset of ``firestore.DocumentSnapshot``."""
+
+    def __init__(self, reference: "MemoryDocument", data: dict[str, Any] | None) -> None:
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def get(self, field: str) -> Any:
+        if self._data is None:
+            raise KeyError(field)
+        return _value(self._data, field)
+
+    def to_dict(self) -> dict[str, Any] | None:
+        return None if self._data is None else dict(self._data)
+
+
+class MemoryDocument:
+    """Subset of ``firestore.DocumentReference``."""
+
+    def __init__(self, database: "MemoryDatabase", path: str) -> None:
+        self.database = database
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "MemoryCollection":
+        return MemoryCollection(self.database, f"{self.path}/{name}")
+
+    def get(self, field_paths: Iterable[str] | None = None, **kwargs) -> MemorySnapshot:
+        with self.database.lock:
+            data = self.database.documents.get(self.path)
+        if data is not None and field_paths is not None:
+            data = {x: data[x] for x in field_paths if x in data}
+        return MemorySnapshot(self, data)
+
+    def set(self, data: dict[str, Any], merge: bool = False):
+        with self.database.lock:
+            if merge:
+                data = {**self.database.documents.get(self.path, {}), **data}
+            self.database.documents[self.path] = dict(data)
+
+    def update(self, data: dict[str, Any]):
+        with self.database.lock:
+            if self.path not in self.database.documents:
+                raise KeyError(f"No document to update: {self.path}")
+            self.database.documents[self.path].update(data)
+
+    def delete(self):
+        with self.database.lock:
+            self.database.documents.pop(self.path, None)
+
+
+class _Count:
+
+    def __init__(self, value: int) -> None:
+        self.value = value
+
+
+class _Aggregation:
+
+    def __init__(self, query: "MemoryQuery") -> None:
+        self.query = query
+
+    def get(self) -> list[list[_Count]]:
+        return [[_Count(sum(1 for _ in self.query.stream()))]]
+
+
+class MemoryQuery:
+    """Subset of ``firestore.Query``, documents are compared on the ordered fields then on the id."""
+
+    def __init__(self, collection: "MemoryCollection", **state) -> None:
+        self.collection = collection
+        self.orders: list[tuple[str, bool]] = state.get("orders", [])
+        self.fields: list[str] | None = state.get("fields")
+        self.start: tuple[Any, bool] | None = state.get("start")
+        self.end: tuple[Any, bool] | None = state.get("end")
+        self.count_limit: int | None = state.get("count_limit")
+
+    def _copy(self, **state) -> "MemoryQuery":
+        current = {
+            "orders": self.orders,
+            "fields": self.fields,
+            "start": self.start,
+            "end": self.end,
+            "count_limit": self.count_limit
+        }
+        return MemoryQuery(self.collection, **{**current, **state})
+
+    def order_by(self, field: str, direction: str = "ASCENDING") -> "MemoryQuery":
+        return self._copy(orders=[*self.orders, (field, direction == "DESCENDING")])
+
+    def select(self, fields: Iterable[str]) -> "MemoryQuery":
+        return self._copy(fields=list(fields))
+
+    def limit(self, count: int) -> "MemoryQuery":
+        return self._copy(count_limit=count)
+
+    def _cursor(self, values) -> tuple:
+        if isinstance(values, MemorySnapshot):
+            return tuple(values.get(x) for x, _ in self.orders) + (values.id,)
+        # a dict cursor only holds the ordered fields
+        return tuple(values[x] for x, _ in self.orders)
+
+    def start_at(self, values) -> "MemoryQuery":
+        return self._copy(start=(self._cursor(values), True))
+
+    def start_after(self, values) -> "MemoryQuery":
+        return self._copy(start=(self._cursor(values), False))
+
+    def end_at(self, values) -> "MemoryQuery":
+        return self._copy(end=(self._cursor(values), True))
+
+    def end_before(self, values) -> "MemoryQuery":
+        return self._copy(end=(self._cursor(values), False))
+
+    def _directions(self) -> list[bool]:
+        # like firestore, the id is ordered in the direction of the last field
+        directions = [x for _, x in self.orders]
+        return directions + directions[-1:] if directions else [False]
+
+    def _compare(self, key: tuple, cursor: tuple) -> int:
+        directions = self._directions()
+        for descending, a, b in zip(directions, key, cursor):
+            if a != b:
+                return (1 if a > b else -1) * (-1 if descending else 1)
+        return 0
+
+    def stream(self, **kwargs) -> Iterator[MemorySnapshot]:
+        prefix = f"{self.collection.path}/"
+        with self.collection.database.lock:
+            documents = [
+                (path, dict(data))
+                for path, data in self.collection.database.documents.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+            ]
+
+        rows = []
+        for path, data in documents:
+            try:
+                key = tuple(_value(data, x) for x, _ in self.orders) + (path[len(prefix):],)
+            except KeyError:
+                # like firestore, documents without an ordered field are left out
+                continue
+            rows.append((key, path, data))
+
+        # stable sorts, from the last key to the first
+        directions = self._directions()
+        for position in reversed(range(len(directions))):
+            rows.sort(key=lambda x: x[0][position], reverse=directions[position])
+
+        count = 0
+        for key, path, data in rows:
+            if self.start is not None:
+                order = self._compare(key, self.start[0])
+                if order < 0 or (order == 0 and not self.start[1]):
+                    continue
+            if self.end is not None:
+                order = self._compare(key, self.end[0])
+                if order > 0 or (order == 0 and not self.end[1]):
+                    break
+            if self.count_limit is not None and count >= self.count_limit:
+                break
+            if self.fields is not None:
+                data = {x: data[x] for x in self.fields if x in data}
+            count += 1
+            yield MemorySnapshot(MemoryDocument(self.collection.database, path), data)
+
+    def get(self, **kwargs) -> list[MemorySnapshot]:
+        return list(self.stream())
+
+    def count(self) -> _Aggregation:
+        return _Aggregation(self)
+
+
+class MemoryCollection(MemoryQuery):
+    """Subset of ``firestore.CollectionReference``."""
+
+    def __init__(self, database: "MemoryDatabase", path: str) -> None:
+        self.database = database
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+        super().__init__(self)
+
+    def document(self, document_id: str | None = None) -> MemoryDocument:
+        return MemoryDocument(self.database, f"{self.path}/{document_id or uuid.uuid4().hex}")
+
+    def add(self, data: dict[str, Any]) -> tuple[None, MemoryDocument]:
+        document = self.document()
+        document.set(data)
+        return None, document
+
+
+class MemoryBatch:
+
+    def __init__(self) -> None:
+        self.operations: list = []
+
+    def set(self, reference: MemoryDocument, data: dict[str, Any], merge: bool = False):
+        self.operations.append(lambda: reference.set(data, merge))
+
+    def update(self, reference: MemoryDocument, data: dict[str, Any]):
+        self.operations.append(lambda: reference.update(data))
+
+    def delete(self, reference: MemoryDocument):
+        self.operations.append(reference.delete)
+
+    def commit(self):
+        for operation in self.operations:
+            operation()
+        self.operations = []
+
+
+class MemoryDatabase:
+    """Subset of ``firestore.Client`` holding the documents in a dict keyed by path."""
+
+    def __init__(self, documents: dict[str, dict[str, Any]] | None = None) -> None:
+        self.documents: dict[str, dict[str, Any]] = dict(documents or {})
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, path: str) -> "MemoryDatabase":
+        """Load ``{"collection/path": {id: {...}}}`` from a json file."""
+        with open(path, mode='r') as f:
+            collections = json.load(f)
+        return cls({
+            f"{name}/{_id}": data
+            for name, documents in collections.items()
+            for _id, data in documents.items()
+        })
+
+    def collection(self, path: str) -> MemoryCollection:
+        return MemoryCollection(self, path)
+
+    def document(self, path: str) -> MemoryDocument:
+        return MemoryDocument(self, path)
+
+    def batch(self) -> MemoryBatch:
+        return MemoryBatch()
+
+
+class FakeQuotaExceeded(Exception):
+    """Raised by the fake client like the 429 of the api."""
+
+
+class FakeIndexServiceClient:
+    """In memory stand-in for ``aiplatform_v1.IndexServiceClient``.
+
+    ``fail_every`` makes every nth call fail with ``FakeQuotaExceeded``.
+    """
+
+    def __init__(self, latency: float = 0.0, fail_every: int = 0) -> None:
+        self.datapoints: dict[str, list[float]] = {}
+        self.calls: list[tuple[str, int]] = []
+        self.latency = latency
+        self.fail_every = fail_every
+        self._lock = threading.Lock()
+
+    def _call(self, name: str, count: int):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls.append((name, count))
+            if self.fail_every and len(self.calls) % self.fail_every == 0:
+                raise FakeQuotaExceeded("429 Quota exceeded (fake)")
+
+    def upsert_datapoints(self, request: dict[str, Any]):
+        self._call("upsert", len(request["datapoints"]))
+        with self._lock:
+            for dt in request["datapoints"]:
+                self.datapoints[dt["datapoint_id"]] = dt["feature_vector"]
+
+    def remove_datapoints(self, request: dict[str, Any]):
+        self._call("remove", len(request["datapoint_ids"]))
+        with self._lock:
+            for _id in request["datapoint_ids"]:
+                self.datapoints.pop(_id, None)
@@ -0,0 +1,230 @@
+"""Inverted file (IVF) approximate nearest neighbors search.
+
+The datapoints are partitioned with KMeans like ``clustering`` does.  Each
+centroid owns the list of the rows closest to it.  A query only scans the rows of
+its ``nprobe`` closest centroids instead of the whole index.
+
+The range search is exact: the distance of a row is at least the distance of the
+query to its centroid minus the radius of the list, so the lists are scanned by
+increasing bound and the scan stops at the first list that can't hold a result.
+"""
+import hashlib
+import os
+import time
+
+import numpy as np
+
+from . import search
+
+
+IVF_FILE = "./ivf.npz"
+
+DEFAULT_NPROBE = 8
+
+
+def _ids_digest(ids: list[str]) -> str:
+    return hashlib.blake2b("\n".join(ids).encode(), digest_size=16).hexdigest()
+
+
+class IVFIndex:
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        offsets: np.ndarray,
+        rows: np.ndarray,
+        digest: str
+    ) -> None:
+        self.centroids = centroids
+        # rows of list ``i`` are ``rows[offsets[i]:offsets[i + 1]]``
+        self.offsets = offsets
+        self.rows = rows
+        self.digest = digest
+        self._centroids_engine = search.ExactSearch(centroids)
+        # datapoints the radii and norms were computed for
+        self._prepared: np.ndarray | None = None
+        self._radii = np.zeros(0, dtype=np.float32)
+        self._squared_norms = np.zeros(0, dtype=np.float32)
+
+    @classmethod
+    def build(cls, ids: list[str], datapoints: np.ndarray, nlist: int | None = None) -> "IVFIndex":
+        from sklearn.cluster import KMeans
+
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(datapoints.shape[0])))
+        nlist = min(nlist, datapoints.shape[0])
+
+        kmean = KMeans(n_clusters=nlist, n_init="auto")
+        assignments = kmean.fit_predict(datapoints)
+        rows = np.argsort(assignments, kind="stable").astype(np.int64)
+        counts = np.bincount(assignments, minlength=nlist)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(kmean.cluster_centers_.astype(np.float32), offsets, rows, _ids_digest(ids))
+
+    def save(self, path: str = IVF_FILE):
+        with open(path, mode='wb') as f:
+            np.savez(f, centroids=self.centroids, offsets=self.offsets, rows=self.rows, digest=self.digest)
+
+    @classmethod
+    def load(cls, path: str = IVF_FILE) -> "IVFIndex":
+        data = np.load(path)
+        return cls(data["centroids"], data["offsets"], data["rows"], str(data["digest"]))
+
+    def matches(self, ids: list[str]) -> bool:
+        return self.digest == _ids_digest(ids)
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    def search(
+        self,
+        vectors: np.ndarray,
+        datapoints: np.ndarray,
+        number: int,
+        nprobe: int = DEFAULT_NPROBE,
+        mask: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return (distances, rows) of the closest rows, padded with inf and -1.
+
+        The candidate rows are compared against the row norms computed once for the
+        datapoints, only their products with the query are computed.
+        """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        self._prepare(datapoints)
+        probes = self._centroids_engine.search(vectors, nprobe)[1]
+
+        out_distances = np.full((len(vectors), number), np.inf, dtype=np.float32)
+        out_rows = np.full((len(vectors), number), -1, dtype=np.int64)
+        for query, (vector, lists) in enumerate(zip(vectors, probes)):
+            candidates = np.concatenate([self.rows[self.offsets[x]:self.offsets[x + 1]] for x in lists if x >= 0])
+            if mask is not None:
+                candidates = candidates[mask[candidates]]
+            if not len(candidates):
+                continue
+            distances = self._squared_norms[candidates] - 2 * (datapoints[candidates] @ vector) + vector @ vector
+            count = min(number, len(candidates))
+            closest = np.argpartition(distances, count - 1)[:count]
+            closest = closest[np.argsort(distances[closest], kind="stable")]
+            out_distances[query, :count] = np.sqrt(np.maximum(distances[closest], 0))
+            out_rows[query, :count] = candidates[closest]
+        return out_distances, out_rows
+
+    def _prepare(self, datapoints: np.ndarray):
+        """Row norms and the radius of every list, computed once per datapoints."""
+        if self._prepared is datapoints:
+            return
+        self._squared_norms = np.einsum("ij,ij->i", datapoints, datapoints, dtype=np.float32)
+        radii = np.zeros(self.nlist, dtype=np.float32)
+        for x in range(self.nlist):
+            rows = self.rows[self.offsets[x]:self.offsets[x + 1]]
+            if len(rows):
+                radii[x] = np.sqrt(np.max(np.sum((datapoints[rows] - self.centroids[x]) ** 2, axis=1)))
+        self._radii = radii
+        self._prepared = datapoints
+
+    def range_search(
+        self,
+        vectors: np.ndarray,
+        datapoints: np.ndarray,
+        radius: float,
+        limit: int | None = None,
+        mask: np.ndarray | None = None
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Return the sorted (distances, rows) of the rows within radius of each vector."""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        self._prepare(datapoints)
+        distances, lists = self._centroids_engine.search(vectors, self.nlist)
+
+        out = []
+        for query, centroid_distances, query_lists in zip(vectors, distances, lists):
+            # a little slack for the rounding errors
+            lower = np.maximum(centroid_distances - self._radii[query_lists] - 1e-4, 0)
+            order = np.argsort(lower, kind="stable")
+            blocks = (
+                (self.rows[self.offsets[x]:self.offsets[x + 1]], float(bound))
+                for x, bound in zip(query_lists[order], lower[order])
+            )
+            out.append(search.range_scan(
+                datapoints, self._squared_norms, query, blocks, radius, limit, mask
+            ))
+        return out
+
+
+# (path, file stamp, index) of the last loaded ivf index
+_LOADED: tuple[str, tuple, IVFIndex] | None = None
+
+# (stamp of the ids, digest) of the last ids checked
+_DIGEST: tuple[tuple, str] | None = None
+
+# (ivf file stamp, ids digest) of the last outdated warning
+_WARNED: tuple | None = None
+
+
+def _digest_for(ids: list[str], ids_stamp: tuple | None) -> str:
+    global _DIGEST
+    if ids_stamp is None:
+        return _ids_digest(ids)
+    if _DIGEST is None or _DIGEST[0] != ids_stamp:
+        _DIGEST = (ids_stamp, _ids_digest(ids))
+    return _DIGEST[1]
+
+
+def load_for(ids: list[str], path: str = IVF_FILE, ids_stamp: tuple | None = None) -> IVFIndex | None:
+    """Load the ivf index if it was built for these ids.
+
+    ``ids_stamp`` identifies the loaded ids (like the stamp of the ids file), the
+    digest of the ids is only computed again when it changes.
+    """
+    global _LOADED, _WARNED
+    try:
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if _LOADED is None or _LOADED[:2] != (path, stamp):
+            _LOADED = (path, stamp, IVFIndex.load(path))
+        index = _LOADED[2]
+    except OSError:
+        return None
+
+    digest = _digest_for(ids, ids_stamp)
+    if index.digest != digest:
+        if _WARNED != (stamp, digest):
+            _WARNED = (stamp, digest)
+            print("The ivf index is outdated, using exact search. Rebuild it with: ivf-index build")
+        return None
+    return index
+
+
+def benchmark(
+    datapoints: np.ndarray,
+    index: IVFIndex,
+    nprobes: list[int],
+    number: int = 10,
+    queries: int = 200,
+    seed: int = 0
+) -> list[dict]:
+    """Measure recall@number and latency against exact search for each nprobe."""
+    rng = np.random.default_rng(seed)
+    sample = datapoints[rng.choice(datapoints.shape[0], min(queries, datapoints.shape[0]), replace=False)]
+
+    engine = search.ExactSearch(datapoints)
+    start = time.perf_counter()
+    truth = [engine.search(query, number)[1][0] for query in sample]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(sample)
+
+    results = [{"nprobe": "exact", "recall": 1.0, "latency_ms": exact_ms, "scanned": 1.0}]
+    for nprobe in nprobes:
+        hits = 0
+        start = time.perf_counter()
+        found = [index.search(query, datapoints, number, nprobe)[1][0] for query in sample]
+        latency = (time.perf_counter() - start) * 1000 / len(sample)
+        for expected, got in zip(truth, found):
+            hits += len(set(expected.tolist()) & set(got.tolist()))
+        sizes = np.diff(index.offsets)
+        results.append({
+            "nprobe": nprobe,
+            "recall": hits / (len(sample) * len(truth[0])),
+            "latency_ms": latency,
+            "scanned": min(1.0, float(nprobe * sizes.mean() / datapoints.shape[0]))
+        })
+    return results
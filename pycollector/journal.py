@@ -0,0 +1,162 @@
+"""Crash safe writes for the ids.txt / datapoints.bin pair.
+
+Row ``n`` of the datapoints file belongs to line ``n`` of the ids file.  Rows are
+appended to both files and every few rows the two files are flushed, fsynced and
+the number of committed rows is recorded in a checkpoint file.  If the process
+dies, ``repair`` truncates both files back to the last row present in both.
+"""
+import json
+import os
+
+import numpy as np
+
+from . import core
+
+
+CHECKPOINT_FILE = "./index.checkpoint"
+
+ROW_SIZE = core.DIMENSION * np.dtype(np.float32).itemsize
+
+
+def read_checkpoint(path: str = CHECKPOINT_FILE) -> dict | None:
+    try:
+        with open(path, mode='r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(rows: int, last_id: str | None, path: str = CHECKPOINT_FILE):
+    tmp = f"{path}.tmp"
+    with open(tmp, mode='w') as f:
+        json.dump({"rows": rows, "last_id": last_id}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _scan_ids(ids_path: str) -> tuple[list[int], bool]:
+    """Return the byte offset of the end of each complete line and if a partial
+    line is dangling at the end of the file."""
+    offsets = []
+    if not os.path.exists(ids_path):
+        return offsets, False
+
+    with open(ids_path, mode='rb') as f:
+        data = f.read()
+
+    pos = 0
+    while (end := data.find(b"\n", pos)) != -1:
+        pos = end + 1
+        offsets.append(pos)
+    return offsets, pos != len(data)
+
+
+def inspect(
+    ids_path: str = core.IDS_FILE,
+    datapoints_path: str = core.DATAPOINTS_FILE,
+    checkpoint_path: str = CHECKPOINT_FILE
+) -> dict:
+    offsets, partial_id = _scan_ids(ids_path)
+    size = os.path.getsize(datapoints_path) if os.path.exists(datapoints_path) else 0
+    checkpoint = read_checkpoint(checkpoint_path)
+    return {
+        "id_rows": len(offsets),
+        "partial_id": partial_id,
+        "datapoint_rows": size // ROW_SIZE,
+        "trailing_bytes": size % ROW_SIZE,
+        "consistent_rows": min(len(offsets), size // ROW_SIZE),
+        "checkpoint_rows": checkpoint["rows"] if checkpoint else None,
+        "_offsets": offsets
+    }
+
+
+def is_consistent(report: dict) -> bool:
+    return (
+        report["id_rows"] == report["datapoint_rows"]
+        and not report["partial_id"]
+        and not report["trailing_bytes"]
+    )
+
+
+def repair(
+    ids_path: str = core.IDS_FILE,
+    datapoints_path: str = core.DATAPOINTS_FILE,
+    checkpoint_path: str = CHECKPOINT_FILE
+) -> int:
+    """Truncate both files to the last row present in both.  Return the row count."""
+    report = inspect(ids_path, datapoints_path, checkpoint_path)
+    rows = report["consistent_rows"]
+
+    if not is_consistent(report):
+        ids_size = report["_offsets"][rows - 1] if rows else 0
+        if os.path.exists(ids_path):
+            os.truncate(ids_path, ids_size)
+        if os.path.exists(datapoints_path):
+            os.truncate(datapoints_path, rows * ROW_SIZE)
+
+    checkpoint_rows = report["checkpoint_rows"]
+    if checkpoint_rows is not None and checkpoint_rows > rows:
+        print(
+            f"Warning: checkpoint recorded {checkpoint_rows} rows but only {rows} "
+            "could be recovered."
+        )
+
+    last_id = None
+    if rows:
+        with open(ids_path, mode='rb') as f:
+            start = report["_offsets"][rows - 2] if rows > 1 else 0
+            f.seek(start)
+            last_id = f.readline().decode().strip()
+    write_checkpoint(rows, last_id, checkpoint_path)
+    return rows
+
+
+class JournaledIndexWriter:
+    """Append rows to the local index, checkpointing every ``checkpoint_every`` rows."""
+
+    def __init__(
+        self,
+        ids_path: str = core.IDS_FILE,
+        datapoints_path: str = core.DATAPOINTS_FILE,
+        checkpoint_path: str = CHECKPOINT_FILE,
+        checkpoint_every: int = 25
+    ) -> None:
+        self.ids_path = ids_path
+        self.datapoints_path = datapoints_path
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.rows = 0
+        self.last_id: str | None = None
+        self._pending = 0
+
+    def __enter__(self) -> "JournaledIndexWriter":
+        self.rows = repair(self.ids_path, self.datapoints_path, self.checkpoint_path)
+        self.last_id = (read_checkpoint(self.checkpoint_path) or {}).get("last_id")
+        self._ids_file = open(self.ids_path, mode='a')
+        self._datapoints_file = open(self.datapoints_path, mode='ab')
+        return self
+
+    def append(self, _id: str, vector: np.ndarray):
+        self._datapoints_file.write(np.asarray(vector, dtype=np.float32).tobytes())
+        self._ids_file.write(f"{_id}\n")
+        self.rows += 1
+        self.last_id = _id
+        self._pending += 1
+        if self._pending >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        for f in (self._datapoints_file, self._ids_file):
+            f.flush()
+            os.fsync(f.fileno())
+        write_checkpoint(self.rows, self.last_id, self.checkpoint_path)
+        self._pending = 0
+
+    def __exit__(self, *args, **kwargs):
+        for f in (self._datapoints_file, self._ids_file):
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        # an interruption between the two writes of append leaves a dangling row
+        self.rows = repair(self.ids_path, self.datapoints_path, self.checkpoint_path)
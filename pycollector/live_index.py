@@ -0,0 +1,236 @@
+"""Keep the segmented index up to date from the Firestore change notifications.
+
+A listener on the items ordered by timestamp, starting at the last indexed item,
+queues the changes.  They are handled in micro batches: the added items are
+vectorized and written in a new segment, the deleted ones are tombstoned.  The
+segment commit records the last indexed id, so a restarted listener (after a
+disconnection or a crash) starts from there and the items added in the meantime
+come in its first snapshot, nothing is scanned again.
+
+Deleting an item older than the listened range isn't notified.  Every
+``reconcile_interval`` seconds, the number of items up to the last indexed one is
+counted with an aggregation query and, only when it is lower than the number of
+indexed items, the ids are listed to tombstone the missing ones.
+
+The items that couldn't be vectorized are tried again with the next batch, or
+after ``retry_interval`` seconds without changes.  The writer lock of the
+segments is held as long as the indexer runs.
+
+Set ``FIRESTORE_EMULATOR_HOST`` to run against the Firestore emulator.
+"""
+from typing import Any
+import queue
+import threading
+import time
+
+from . import core, segments
+
+
+STATE_FILE = "live.json"
+
+
+class LiveIndexer(threading.Thread):
+
+    def __init__(
+        self,
+        index: segments.SegmentedIndex,
+        batch_size: int = 32,
+        batch_delay: float = 2.0,
+        reconcile_interval: float = 300.0,
+        update_text: bool = False,
+        retry_interval: float = 30.0
+    ) -> None:
+        super().__init__(daemon=True)
+        self.index = index
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.reconcile_interval = reconcile_interval
+        self.update_text = update_text
+        self.retry_interval = retry_interval
+        self.changes: queue.Queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.watch = None
+        self.indexed: set[str] = set()
+        # items that couldn't be vectorized, tried again with the next batch
+        self.failed: dict[str, Any] = {}
+        self.state_path = index.root.joinpath(STATE_FILE)
+
+    # state
+
+    def _load_indexed(self):
+        self.index.refresh()
+        self.indexed = {
+            _id
+            for segment in self.index.segments
+            for _id in segment.ids
+            if _id not in segment.deleted
+        }
+
+    def _read_state(self) -> dict:
+        import json
+        try:
+            with open(self.state_path, mode='r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, last_id: str, timestamp: Any):
+        import json
+        state = {"last_id": last_id, "timestamp": timestamp.isoformat() if hasattr(timestamp, "isoformat") else timestamp}
+        core.replace_file(str(self.state_path), lambda f: json.dump(state, f))
+
+    def _start_timestamp(self):
+        """Timestamp of the last indexed item, None to start from the first item."""
+        from datetime import datetime
+
+        last_id = self.index.last_id
+        if last_id is None:
+            return None
+        state = self._read_state()
+        if state.get("last_id") == last_id and state.get("timestamp"):
+            return datetime.fromisoformat(state["timestamp"])
+        snapshot = core.get_item_collection().document(last_id).get(["timestamp"])
+        if snapshot.exists:
+            return snapshot.get("timestamp")
+        # the last item was deleted, start from the beginning, indexed items are skipped
+        print(f"Last indexed item {last_id} doesn't exist anymore, listening to all the items.", flush=True)
+        return None
+
+    # listener
+
+    def _on_snapshot(self, docs, changes, read_time):
+        for change in changes:
+            self.changes.put((change.type.name, change.document))
+
+    def listen(self):
+        """(Re)start the listener from the last indexed item."""
+        if self.watch is not None:
+            try:
+                self.watch.unsubscribe()
+            except Exception:
+                pass
+
+        query = core.get_item_collection().order_by("timestamp")
+        if (timestamp := self._start_timestamp()) is not None:
+            # inclusive, items sharing the timestamp of the last one are skipped if indexed
+            query = query.start_at({"timestamp": timestamp})
+        self.watch = query.on_snapshot(self._on_snapshot)
+        print(f"Listening to the items after {self.index.last_id}", flush=True)
+
+    def _listening(self) -> bool:
+        return self.watch is not None and getattr(self.watch, "is_active", True)
+
+    # processing
+
+    def _collect(self) -> list[tuple[str, Any]]:
+        """Wait for a change, then for more during batch_delay, up to batch_size."""
+        try:
+            batch = [self.changes.get(timeout=1.0)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size and (remaining := deadline - time.monotonic()) > 0:
+            try:
+                batch.append(self.changes.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def process(self, batch: list[tuple[str, Any]]) -> tuple[int, int]:
+        """Apply a batch of changes.  Return the number of added and deleted items."""
+        added: dict[str, Any] = dict(self.failed)
+        removed: set[str] = set()
+        for kind, document in batch:
+            if kind == "ADDED" and document.id not in self.indexed:
+                added[document.id] = document
+                removed.discard(document.id)
+            elif kind == "REMOVED":
+                added.pop(document.id, None)
+                # a document also leaves the query when its timestamp changes
+                if not core.get_item_collection().document(document.id).get([]).exists:
+                    removed.add(document.id)
+
+        deleted = self.index.delete(removed & self.indexed) if removed else []
+        self.indexed.difference_update(deleted)
+
+        # the index stays in timestamp order, except for the items tried again
+        items = sorted(added.values(), key=lambda x: (x.get("timestamp"), x.id))
+        self.failed = {}
+        if items:
+            start = self._start_timestamp()
+            with self.index.new_segment(checkpoint_every=len(items)) as writer:
+                for item in items:
+                    try:
+                        core.append_items(writer, [item], self.update_text, len(items))
+                    except Exception as e:
+                        print(f"Couldn't vectorize {item.id}, trying again later: {e}", flush=True)
+                        self.failed[item.id] = item
+                        continue
+                    self.indexed.add(item.id)
+                written = [x for x in items if x.id not in self.failed]
+                newest = written[-1] if written else None
+                if newest is not None and start is not None and newest.get("timestamp") < start:
+                    # only items tried again were written, the listener keeps its start
+                    writer.last_id = self.index.last_id
+                    newest = None
+            if newest is not None:
+                self._write_state(newest.id, newest.get("timestamp"))
+            while self.index.merge():
+                pass
+        return len(items) - len(self.failed), len(deleted)
+
+    def reconcile(self) -> list[str]:
+        """Tombstone the indexed items deleted outside of the listened range."""
+        if (timestamp := self._start_timestamp()) is None:
+            return []
+        query = core.get_item_collection().order_by("timestamp").end_at({"timestamp": timestamp})
+        # the items waiting to be vectorized again are counted but not indexed
+        if core.count_query(query) - len(self.failed) >= len(self.indexed):
+            return []
+
+        existing = {x.id for x in core.get_all_items(fields=[])}
+        deleted = self.index.delete(self.indexed - existing)
+        self.indexed.difference_update(deleted)
+        for _id in deleted:
+            print(f'Id "{_id}" doesn\'t exist anymore', flush=True)
+        return deleted
+
+    def run(self):
+        # no other process may write to the segments while they are watched
+        with self.index.writing(blocking=False):
+            self._run()
+
+    def _run(self):
+        self._load_indexed()
+        last_reconcile = last_batch = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                if not self._listening():
+                    self.listen()
+
+                batch = self._collect()
+                retry = bool(self.failed) and time.monotonic() - last_batch >= self.retry_interval
+                if batch or retry:
+                    last_batch = time.monotonic()
+                    added, deleted = self.process(batch)
+                    if added or deleted:
+                        print(f"Live index: {added} added, {deleted} deleted, {len(self.indexed)} items", flush=True)
+
+                if self.reconcile_interval and time.monotonic() - last_reconcile >= self.reconcile_interval:
+                    last_reconcile = time.monotonic()
+                    self.reconcile()
+            except Exception as e:
+                print(f"Live index error: {e}, restarting the listener", flush=True)
+                if self.watch is not None:
+                    try:
+                        self.watch.unsubscribe()
+                    except Exception:
+                        pass
+                self.watch = None
+                time.sleep(self.batch_delay)
+
+        if self.watch is not None:
+            self.watch.unsubscribe()
+
+    def stop(self):
+        self.stopped.set()
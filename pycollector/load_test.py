@@ -0,0 +1,205 @@
+"""Drive a running ``serve`` with a mix of requests and measure it.
+
+Closed loop clients send their next request as soon as the previous one is
+answered (plus an optional think time), they measure the capacity of the server.
+Open loop clients send requests at a fixed average rate (poisson arrivals)
+whether or not the previous ones are answered, the latency is measured from the
+time each request was scheduled so a saturated server isn't hidden by the
+generator waiting for it.
+
+Run serve with the stand-ins of ``fakes`` to load-test without cloud calls.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any
+import random
+import threading
+import time
+
+import numpy as np
+
+from . import client
+
+
+COMMANDS = ("vectorize", "vectorize-with-text", "nearest-neighbors", "status")
+
+DEFAULT_MIX = "vectorize=1,vectorize-with-text=1,nearest-neighbors=4,status=1"
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+@dataclass
+class Sample:
+    command: str
+    # seconds since the start of the test
+    start: float
+    latency: float
+    # None, "busy" when the server rejected the request, else the error message
+    error: str | None = None
+
+
+def parse_mix(spec: str) -> dict[str, float]:
+    """Parse ``command=weight,...``."""
+    mix = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        command, _, weight = part.partition("=")
+        command = command.strip()
+        if command not in COMMANDS:
+            raise ValueError(f"Invalid command: {command}")
+        mix[command] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("The mix doesn't contain any request")
+    return mix
+
+
+class Workload:
+    """Pick the requests according to the mix, the files or ids to send are picked at random."""
+
+    def __init__(self, mix: dict[str, float], targets: list[str], number: int = 5) -> None:
+        if not targets and any(x != "status" for x in mix):
+            raise ValueError("No file or id to send")
+        self.commands = list(mix)
+        self.weights = [mix[x] for x in self.commands]
+        self.targets = targets
+        self.number = number
+
+    def next(self, rand: random.Random) -> dict[str, Any]:
+        command = rand.choices(self.commands, self.weights)[0]
+        request: dict[str, Any] = {"command": command}
+        if command != "status":
+            request["file"] = client.file_argument(rand.choice(self.targets))
+        if command == "nearest-neighbors":
+            request["number"] = self.number
+        return request
+
+
+class LoadTest:
+
+    def __init__(
+        self,
+        workload: Workload,
+        port: int = client.DEFAULT_PORT,
+        unix: str = client.DEFAULT_SOCKET,
+        seed: int | None = None
+    ) -> None:
+        self.workload = workload
+        self.port = port
+        self.unix = unix
+        self.seed = seed
+        self.samples: list[Sample] = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.origin = 0.0
+
+    def send(self, request: dict[str, Any], scheduled: float | None = None):
+        """Send the request once, busy answers are recorded and not retried."""
+        start = time.perf_counter() if scheduled is None else scheduled
+        error = None
+        try:
+            if (sock := client.connect(self.port, self.unix)) is None:
+                error = "Connection failed"
+            else:
+                response = client.send(sock, request)
+                if response.get("error") == "Server busy":
+                    error = "busy"
+                elif response.get("error"):
+                    error = str(response["error"])
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        sample = Sample(request["command"], start - self.origin, time.perf_counter() - start, error)
+        with self.lock:
+            self.samples.append(sample)
+
+    def closed_loop(self, index: int, think: float):
+        rand = random.Random(None if self.seed is None else self.seed + index)
+        while not self.stopped.is_set():
+            self.send(self.workload.next(rand))
+            if think > 0:
+                self.stopped.wait(rand.expovariate(1 / think))
+
+    def open_loop(self, rate: float, max_outstanding: int):
+        rand = random.Random(None if self.seed is None else self.seed - 1)
+        executor = ThreadPoolExecutor(max_outstanding)
+        scheduled = time.perf_counter()
+        while not self.stopped.is_set():
+            scheduled += rand.expovariate(rate)
+            if (delay := scheduled - time.perf_counter()) > 0 and self.stopped.wait(delay):
+                break
+            executor.submit(self.send, self.workload.next(rand), scheduled)
+        # the requests still waiting for a thread at the end are not sent
+        executor.shutdown(cancel_futures=True)
+
+    def run(
+        self,
+        duration: float,
+        clients: int = 0,
+        rate: float = 0.0,
+        think: float = 0.0,
+        max_outstanding: int = 256
+    ) -> list[Sample]:
+        """Run the clients for duration seconds and return the samples."""
+        self.origin = time.perf_counter()
+        threads = [
+            threading.Thread(target=self.closed_loop, args=(x, think), daemon=True)
+            for x in range(clients)
+        ]
+        if rate > 0:
+            threads.append(threading.Thread(target=self.open_loop, args=(rate, max_outstanding), daemon=True))
+        for thread in threads:
+            thread.start()
+        self.stopped.wait(duration)
+        self.stopped.set()
+        for thread in threads:
+            thread.join()
+        return self.samples
+
+
+def _stats(samples: list[Sample], duration: float) -> dict[str, Any]:
+    ok = np.array([x.latency for x in samples if x.error is None], dtype=np.float64) * 1000
+    stats: dict[str, Any] = {
+        "requests": len(samples),
+        "ok": len(ok),
+        "busy": sum(1 for x in samples if x.error == "busy"),
+        "errors": sum(1 for x in samples if x.error not in (None, "busy")),
+        "throughput": round(len(ok) / duration, 2) if duration > 0 else 0.0
+    }
+    if len(ok):
+        stats["mean_ms"] = round(float(ok.mean()), 2)
+        for percentile, value in zip(PERCENTILES, np.percentile(ok, PERCENTILES)):
+            stats[f"p{percentile:g}_ms"] = round(float(value), 2)
+        stats["max_ms"] = round(float(ok.max()), 2)
+    return stats
+
+
+def report(samples: list[Sample], duration: float, warmup: float = 0.0) -> dict[str, Any]:
+    """Throughput and latency percentiles of the requests started after the warmup."""
+    measured = [x for x in samples if x.start >= warmup]
+    duration = max(0.0, duration - warmup)
+    errors: dict[str, int] = {}
+    for x in measured:
+        if x.error not in (None, "busy"):
+            errors[x.error] = errors.get(x.error, 0) + 1
+    return {
+        "duration": duration,
+        "total": _stats(measured, duration),
+        "commands": {
+            command: _stats([x for x in measured if x.command == command], duration)
+            for command in sorted({x.command for x in measured})
+        },
+        "errors": errors
+    }
+
+
+def print_report(result: dict[str, Any]):
+    columns = ["requests", "ok", "busy", "errors", "throughput", "mean_ms"]
+    columns += [f"p{x:g}_ms" for x in PERCENTILES] + ["max_ms"]
+    rows = [*result["commands"].items(), ("total", result["total"])]
+    width = max(len(x) for x, _ in rows)
+    print(f"Measured {result['duration']:.1f}s")
+    print(" ".join([" " * width] + [f"{x:>10}" for x in columns]))
+    for name, stats in rows:
+        print(" ".join([f"{name:<{width}}"] + [f"{stats.get(x, '-'):>10}" for x in columns]))
+    for error, count in sorted(result["errors"].items(), key=lambda x: -x[1]):
+        print(f"{count} x {error}")
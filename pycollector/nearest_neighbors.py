@@ -1,62 +1,274 @@
-from pathlib import Path
+from contextlib import ExitStack
+from typing import Any, Iterable
+import os
 
-from sklearn.neighbors import NearestNeighbors
 import numpy as np
 
-from . import core, core_tf
+from . import core, search, shared_index
+
+
+# (files stamp, ids, search engine, row of each id) of the last loaded local index
+_LOADED: tuple[tuple, list[str], search.ExactSearch, dict[str, int]] | None = None
+
+
+# the segmented index, kept open so only the new segments are read by refresh
+_SEGMENTS = None
+
+
+def _segments():
+    """The refreshed segmented index, None when the local index is used."""
+    global _SEGMENTS
+    from . import segments
+    if shared_index.READER is not None or not segments.exists():
+        return None
+    if _SEGMENTS is None:
+        _SEGMENTS = segments.SegmentedIndex()
+    else:
+        _SEGMENTS.refresh()
+    return _SEGMENTS
+
+
+def _load() -> tuple[tuple, list[str], search.ExactSearch, dict[str, int]]:
+    global _LOADED
+    if shared_index.READER is not None:
+        return shared_index.READER.get()
+
+    stamp = tuple(
+        (os.stat(x).st_mtime_ns, os.stat(x).st_size)
+        for x in (core.IDS_FILE, core.DATAPOINTS_FILE)
+    )
+    if _LOADED is None or _LOADED[0] != stamp:
+        ids = core.load_ids()
+        rows = {_id: x for x, _id in enumerate(ids)}
+        _LOADED = (stamp, ids, search.ExactSearch(core.load_datapoints()), rows)
+    return _LOADED
+
+
+def load_index() -> tuple[list[str], search.ExactSearch]:
+    """Load the local index, it is only reloaded when the files change."""
+    _, ids, engine, _ = _load()
+    return ids, engine
+
+
+def get_vector(_id: str) -> np.ndarray | None:
+    """Return the vector stored in the index for this id, if any."""
+    if (index := _segments()) is not None:
+        return index.get_vector(_id)
+
+    try:
+        _, _, engine, rows = _load()
+    except OSError:
+        return None
+    if (row := rows.get(_id)) is None:
+        return None
+    return engine.datapoints[row]
+
+
+def _indexed_vector(query: str) -> np.ndarray | None:
+    # a local file is never looked up in the index
+    if os.path.exists(query):
+        return None
+    return get_vector(query)
+
+
+def search_vectors(
+    vectors: np.ndarray,
+    number: int,
+    nprobe: int | None = None,
+    exclude: Iterable[str] | None = None
+) -> list[list[tuple[str, float]]]:
+    """Find the closest neighbors of every vector, skipping the excluded ids.
+
+    ``nprobe`` is ignored when the index is segmented, the segments are always
+    searched exactly.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+
+    if (index := _segments()) is not None:
+        return index.search(vectors, number, exclude)
+
+    stamp, strids, engine, _ = _load()
+    mask = search.mask_excluding(strids, exclude) if exclude else None
+
+    if nprobe:
+        from . import ivf
+        if (index := ivf.load_for(strids, ids_stamp=stamp)) is not None:
+            distances, ids = index.search(vectors, engine.datapoints, number, nprobe, mask)
+            return search.to_results(strids, distances, ids)
+
+    distances, ids = engine.search(vectors, number, mask)
+    return search.to_results(strids, distances, ids)
+
+
+def search_radius(
+    vectors: np.ndarray,
+    radius: float,
+    limit: int | None = None,
+    exclude: Iterable[str] | None = None
+) -> list[list[tuple[str, float]]]:
+    """Find every neighbor closer than radius (the closest ``limit`` ones) of every vector.
+
+    The scan uses the lists of the ivf index when it is up to date, the results
+    are exact either way.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+
+    if (index := _segments()) is not None:
+        return index.search_radius(vectors, radius, limit, exclude)
+
+    stamp, strids, engine, _ = _load()
+    mask = search.mask_excluding(strids, exclude) if exclude else None
+
+    from . import ivf
+    if os.path.exists(ivf.IVF_FILE) and (index := ivf.load_for(strids, ids_stamp=stamp)) is not None:
+        found = index.range_search(vectors, engine.datapoints, radius, limit, mask)
+    else:
+        found = engine.range_search(vectors, radius, limit, mask)
+    return search.to_range_results(strids, found)
 
 
 def _find(
     image: str,
-    number: int
+    number: int,
+    nprobe: int | None = None,
+    exclude: Iterable[str] | None = None,
+    _id: str | None = None
 ) -> list[tuple[str, float]]:
-    vector, _ = core_tf.vectorize_with_text(image)
-    weights = core.load_datapoints()
+    from . import core_tf
+    vector, _ = core_tf.vectorize_with_text(image, _id=_id)
+    return search_vectors(vector, number, nprobe, exclude)[0]
 
-    # use all processes
-    nn = NearestNeighbors(n_jobs=-1)
-    nn.fit(weights)
 
-    distances, ids = nn.kneighbors(
-        np.array([vector]),
-        n_neighbors=number
-    )
-    strids = core.load_ids()
-    return list(zip((strids[x] for x in ids[0]), distances[0].tolist()))
+def find(
+    local_file_or_id: str,
+    number: int = 5,
+    nprobe: int | None = None,
+    exclude: Iterable[str] | None = None,
+    revectorize: bool = False
+) -> list[tuple[str, float]]:
+    """Find the closest neighbors.  With nprobe, use the ivf index when it is up to date.
 
+    The vector of an id already in the index is used as is unless ``revectorize``.
+    """
+    if not revectorize and (vector := _indexed_vector(local_file_or_id)) is not None:
+        return search_vectors(vector, number, nprobe, exclude)[0]
 
-def find(
+    image = core.DownloadOrLocalImage(local_file_or_id)
+    with image as filepath:
+        return _find(filepath, number, nprobe, exclude, None if image.local else local_file_or_id)
+
+
+def find_within(
     local_file_or_id: str,
-    number: int = 5
+    radius: float,
+    limit: int | None = None,
+    exclude: Iterable[str] | None = None,
+    revectorize: bool = False
 ) -> list[tuple[str, float]]:
-    
-    with core.DownloadOrLocalImage(local_file_or_id) as filepath:
-        return _find(filepath, number)
+    """Find every neighbor closer than radius, the closest first."""
+    if not revectorize and (vector := _indexed_vector(local_file_or_id)) is not None:
+        return search_radius(vector, radius, limit, exclude)[0]
 
+    from . import core_tf
+    image = core.DownloadOrLocalImage(local_file_or_id)
+    with image as filepath:
+        vector, _ = core_tf.vectorize_with_text(filepath, _id=None if image.local else local_file_or_id)
+    return search_radius(vector, radius, limit, exclude)[0]
 
-def find_all():
-    weights = core.load_datapoints()
-    strids = core.load_ids()
 
-    nn = NearestNeighbors(n_jobs=-1)
-    nn.fit(weights)
+def _vectorize_files(
+    files: dict[int, str],
+    errors: dict[int, str],
+    ids: dict[int, str] | None = None
+) -> dict[int, np.ndarray]:
+    """``ids`` gives the item of the files downloaded from the bucket, their
+    images are read from the tensor store when they are there."""
+    ids = ids or {}
+    if not files:
+        return {}
 
-    distances, ids = nn.kneighbors(
-        weights,
-        n_neighbors=10
-    )
+    from . import core_tf
+    texts = {}
+    for x, filepath in files.items():
+        try:
+            texts[x] = core.detect_text(filepath)
+        except Exception as e:
+            errors[x] = str(e)
 
-    with open("test.txt", mode='w') as f:
-        for x, (idx, dist) in enumerate(zip(ids, distances)):
-            data = []
-            for i, d in zip(idx, dist):
-                if i == x:
+    order = list(texts)
+    try:
+        results = core_tf.vectorize_many_with_text(
+            [files[x] for x in order], [texts[x] for x in order], [ids.get(x) for x in order]
+        )
+        return {x: vector for x, (vector, _) in zip(order, results)}
+    except Exception:
+        # find the culprit instead of failing the whole batch
+        vectors = {}
+        for x in order:
+            try:
+                vectors[x] = core_tf.vectorize_with_text(files[x], texts[x], ids.get(x))[0]
+            except Exception as e:
+                errors[x] = str(e)
+        return vectors
+
+
+def find_many(
+    queries: list[str | list[float]],
+    number: int = 5,
+    nprobe: int | None = None,
+    exclude: Iterable[str] | None = None,
+    revectorize: bool = False
+) -> list[dict[str, Any]]:
+    """Find the closest neighbors of many local files, ids or vectors at once.
+
+    The images are vectorized in one batch and all the vectors are searched in one
+    call.  Return a ``{"nearest": [...]}`` or ``{"error": "..."}`` per query.
+    """
+    errors: dict[int, str] = {}
+    vectors: dict[int, np.ndarray] = {}
+    files: dict[int, str] = {}
+    ids: dict[int, str] = {}
+
+    with ExitStack() as stack:
+        for x, query in enumerate(queries):
+            if isinstance(query, str):
+                if not revectorize and (vector := _indexed_vector(query)) is not None:
+                    vectors[x] = vector
+                    continue
+                image = core.DownloadOrLocalImage(query)
+                try:
+                    files[x] = stack.enter_context(image)
+                except Exception as e:
+                    errors[x] = f"Couldn't get image {query}: {e}"
                     continue
+                if not image.local:
+                    ids[x] = query
+            elif isinstance(query, list) and len(query) == core.DIMENSION:
+                vectors[x] = np.asarray(query, dtype=np.float32)
+            else:
+                errors[x] = f"Invalid query, expected an id, a file or a vector of {core.DIMENSION} values"
 
-                if d > 1.0:
-                    break
+        vectors.update(_vectorize_files(files, errors, ids))
 
-                data.append((strids[i], d))
+    order = [x for x in range(len(queries)) if x in vectors and x not in errors]
+    found = search_vectors(np.array([vectors[x] for x in order]), number, nprobe, exclude) if order else []
+    results = dict(zip(order, found))
+    return [
+        {"error": errors[x]} if x in errors else {"nearest": results[x]}
+        for x in range(len(queries))
+    ]
+
+
+def find_all():
+    strids, weights = core.load_index()
+
+    engine = search.ExactSearch(weights)
+    # the item itself is always its closest neighbor
+    found = engine.range_search(weights, 1.0, 9, exclude_rows=range(len(strids)))
+
+    with open("test.txt", mode='w') as f:
+        for x, (dist, idx) in enumerate(found):
+            data = [(strids[i], d) for i, d in zip(idx, dist)]
             if data:
                 f.write(f"{x}: {strids[x]}\n")
                 
@@ -0,0 +1,237 @@
+"""Precomputed top-k nearest neighbors of every indexed item.
+
+The table is saved in a single little endian binary file that can be read
+without numpy or the model:
+
+    magic "PCNT" | version u32 | k u32 | count u32 | ids size u32
+    ids          utf-8, separated by "\\n"
+    neighbors    int32[count, k]   row of each neighbor, -1 when missing
+    distances    float32[count, k]
+    hashes       uint64[count]     hash of each vector, used to refresh the table
+
+Refreshing the table only recomputes the rows that had a removed or changed item
+as neighbor, the other rows only compare their current neighbors with the new
+and changed items.
+"""
+from typing import Iterable
+import hashlib
+import struct
+
+import numpy as np
+
+from . import core, search
+
+
+NEIGHBORS_FILE = "./neighbors.bin"
+
+BUCKET_FILE = "embeddings/neighbors.bin"
+
+DEFAULT_K = 20
+
+MAGIC = b"PCNT"
+
+VERSION = 1
+
+_HEADER = struct.Struct("<4sIIII")
+
+# above this ratio of new or changed rows, refreshing is slower than rebuilding
+REBUILD_RATIO = 0.25
+
+# firestore limits a batch to 500 writes
+FIRESTORE_BATCH = 500
+
+
+def _hashes(datapoints: np.ndarray) -> np.ndarray:
+    return np.fromiter(
+        (
+            int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), "little")
+            for row in datapoints
+        ),
+        dtype=np.uint64,
+        count=datapoints.shape[0]
+    )
+
+
+def _top(distances: np.ndarray, rows: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Keep the k smallest distances of each line, sorted."""
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    distances = np.take_along_axis(distances, order, axis=1)
+    rows = np.take_along_axis(rows, order, axis=1)
+    rows[np.isinf(distances)] = -1
+    return distances, rows
+
+
+class NeighborTable:
+
+    def __init__(
+        self,
+        ids: list[str],
+        neighbors: np.ndarray,
+        distances: np.ndarray,
+        hashes: np.ndarray
+    ) -> None:
+        self.ids = ids
+        self.neighbors = neighbors
+        self.distances = distances
+        self.hashes = hashes
+        self._rows: dict[str, int] | None = None
+
+    @property
+    def k(self) -> int:
+        return self.neighbors.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids: list[str], datapoints: np.ndarray, k: int = DEFAULT_K) -> "NeighborTable":
+        engine = search.ExactSearch(datapoints)
+        distances, rows = engine.search(datapoints, k, exclude_rows=range(len(ids)))
+        return cls(ids, rows.astype(np.int32), distances, _hashes(datapoints))
+
+    def refresh(self, ids: list[str], datapoints: np.ndarray) -> tuple["NeighborTable", np.ndarray]:
+        """Return the table of the new index and the rows whose neighbors changed."""
+        k = self.k
+        hashes = _hashes(datapoints)
+        old_rows = {_id: x for x, _id in enumerate(self.ids)}
+
+        # new row of every old row, -1 when removed or changed.  The extra last
+        # entry maps the -1 of the missing neighbors to -1
+        remap = np.full(len(self.ids) + 1, -1, dtype=np.int64)
+        fresh = []
+        for row, _id in enumerate(ids):
+            old = old_rows.get(_id)
+            if old is not None and self.hashes[old] == hashes[row]:
+                remap[old] = row
+            else:
+                fresh.append(row)
+        fresh = np.array(fresh, dtype=np.int64)
+
+        if len(fresh) > REBUILD_RATIO * len(ids) or not len(ids):
+            table = NeighborTable.build(ids, datapoints, k)
+            return table, np.arange(len(ids))
+
+        # old rows kept in the index, and their neighbors in the new rows
+        kept = np.nonzero(remap[:-1] >= 0)[0]
+        neighbors = np.full((len(ids), k), -1, dtype=np.int64)
+        distances = np.full((len(ids), k), np.inf, dtype=np.float32)
+        neighbors[remap[kept]] = remap[self.neighbors[kept]]
+        distances[remap[kept]] = self.distances[kept]
+
+        # a row that lost a neighbor must be searched again, unless it never had k of them
+        lost = (neighbors[remap[kept]] < 0) & (self.neighbors[kept] >= 0)
+        stale = np.zeros(len(ids), dtype=bool)
+        stale[remap[kept][lost.any(axis=1)]] = True
+        stale[fresh] = True
+        distances[neighbors < 0] = np.inf
+
+        changed = stale.copy()
+        others = np.nonzero(~stale)[0]
+        if len(fresh) and len(others):
+            # the new neighbors of the other rows can only be new or changed items
+            candidates, rows = search.ExactSearch(datapoints[fresh]).search(datapoints[others], k)
+            rows = np.where(rows >= 0, fresh[np.maximum(rows, 0)], -1)
+            merged_distances, merged = _top(
+                np.concatenate([distances[others], candidates], axis=1),
+                np.concatenate([neighbors[others], rows], axis=1),
+                k
+            )
+            changed[others] = (merged != neighbors[others]).any(axis=1)
+            neighbors[others] = merged
+            distances[others] = merged_distances
+
+        if stale.any():
+            rows = np.nonzero(stale)[0]
+            engine = search.ExactSearch(datapoints)
+            distances[rows], neighbors[rows] = engine.search(datapoints[rows], k, exclude_rows=rows)
+
+        table = NeighborTable(ids, neighbors.astype(np.int32), distances, hashes)
+        return table, np.nonzero(changed)[0]
+
+    def row(self, _id: str) -> int | None:
+        if self._rows is None:
+            self._rows = {x: row for row, x in enumerate(self.ids)}
+        return self._rows.get(_id)
+
+    def lookup(self, _id: str, number: int | None = None) -> list[tuple[str, float]] | None:
+        """Return the precomputed neighbors of an indexed item, None if it is not in the table."""
+        if (row := self.row(_id)) is None:
+            return None
+        return [
+            (self.ids[x], float(d))
+            for x, d in zip(self.neighbors[row][:number], self.distances[row][:number])
+            if x >= 0
+        ]
+
+    def save(self, path: str = NEIGHBORS_FILE):
+        ids = "\n".join(self.ids).encode()
+
+        def write(f):
+            f.write(_HEADER.pack(MAGIC, VERSION, self.k, len(self.ids), len(ids)))
+            f.write(ids)
+            f.write(np.ascontiguousarray(self.neighbors, dtype="<i4").tobytes())
+            f.write(np.ascontiguousarray(self.distances, dtype="<f4").tobytes())
+            f.write(np.ascontiguousarray(self.hashes, dtype="<u8").tobytes())
+
+        core.replace_file(path, write, mode='wb')
+
+    @classmethod
+    def load(cls, path: str = NEIGHBORS_FILE) -> "NeighborTable":
+        with open(path, mode='rb') as f:
+            magic, version, k, count, ids_size = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a neighbor table")
+            ids = f.read(ids_size).decode().split("\n") if count else []
+            neighbors = np.frombuffer(f.read(count * k * 4), dtype="<i4").reshape((count, k))
+            distances = np.frombuffer(f.read(count * k * 4), dtype="<f4").reshape((count, k))
+            hashes = np.frombuffer(f.read(count * 8), dtype="<u8")
+        if len(hashes) != count:
+            raise ValueError(f"{path} is truncated")
+        return cls(ids, neighbors, distances, hashes)
+
+    def to_firestore(self, rows: Iterable[int], field: str = "neighbors") -> int:
+        """Write the neighbors of these rows in their item document, return the number written."""
+        database = core.get_database()
+        collection = core.get_item_collection()
+        batch = database.batch()
+        written = 0
+        for row in rows:
+            batch.update(collection.document(self.ids[row]), {
+                field: [{"id": _id, "distance": d} for _id, d in self.lookup(self.ids[row])]
+            })
+            written += 1
+            if written % FIRESTORE_BATCH == 0:
+                batch.commit()
+                batch = database.batch()
+                print(f"{written} items updated", flush=True)
+        if written % FIRESTORE_BATCH:
+            batch.commit()
+        return written
+
+
+def update(
+    k: int = DEFAULT_K,
+    path: str = NEIGHBORS_FILE,
+    full: bool = False
+) -> tuple[NeighborTable, np.ndarray]:
+    """Build or refresh the table of the local index and save it.
+
+    Return the table and the rows whose neighbors changed.
+    """
+    ids, datapoints = core.load_index()
+    if len(ids) != datapoints.shape[0]:
+        raise ValueError("Inconsistences in data.")
+
+    previous = None
+    if not full:
+        try:
+            previous = NeighborTable.load(path)
+        except (OSError, ValueError):
+            pass
+
+    if previous is None or previous.k != k:
+        table, changed = NeighborTable.build(ids, datapoints, k), np.arange(len(ids))
+    else:
+        table, changed = previous.refresh(ids, datapoints)
+    table.save(path)
+    return table, changed
@@ -0,0 +1,205 @@
+"""Incremental synchronisation of a local index with a Vertex AI index.
+
+A manifest keeps a hash of every vector pushed by the last successful sync.  Only
+new or changed rows are upserted and ids that disappeared from the local index are
+removed.  Requests are throttled by a token bucket and several of them can be in
+flight at the same time.
+"""
+from typing import Any, Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+from . import core
+
+
+API_ENDPOINT = "northamerica-northeast1-aiplatform.googleapis.com"
+
+# Vertex AI quota of upsert/remove requests on a streaming index
+REQUESTS_PER_MINUTE = int(os.environ.get("VERTEX_REQUESTS_PER_MINUTE", 60))
+
+
+class TokenBucket:
+    """Allow ``rate`` acquisitions per ``per`` seconds with bursts of ``capacity``."""
+
+    def __init__(self, rate: float, per: float = 60.0, capacity: int = 1) -> None:
+        self.rate = rate / per
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_client():
+    # https://cloud.google.com/python/docs/reference/aiplatform/1.24.0/google.cloud.aiplatform_v1.services.index_service.IndexServiceClient
+    from google.cloud.aiplatform_v1 import IndexServiceClient
+    return IndexServiceClient(client_options={"api_endpoint": API_ENDPOINT})
+
+
+def vector_hash(vector: np.ndarray) -> str:
+    return hashlib.blake2b(np.ascontiguousarray(vector, dtype=np.float32).tobytes(), digest_size=16).hexdigest()
+
+
+def load_manifest(path: str, index: str) -> dict[str, str]:
+    try:
+        with open(path, mode='r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if data.get("index") != index:
+        print(f"Manifest {path} belongs to another index, ignoring it.")
+        return {}
+    return data.get("hashes", {})
+
+
+def save_manifest(path: str, index: str, hashes: dict[str, str]):
+    core.replace_file(path, lambda f: json.dump({"index": index, "hashes": hashes}, f))
+
+
+def compute_diff(
+    ids: list[str],
+    datapoints: np.ndarray,
+    synced: dict[str, str]
+) -> tuple[list[int], list[str], dict[str, str]]:
+    """Return the rows to upsert, the ids to remove and the hash of every local row."""
+    hashes = {}
+    to_upsert = []
+    for row, (_id, vector) in enumerate(zip(ids, datapoints)):
+        digest = vector_hash(vector)
+        hashes[_id] = digest
+        if synced.get(_id) != digest:
+            to_upsert.append(row)
+
+    to_remove = [_id for _id in synced if _id not in hashes]
+    return to_upsert, to_remove, hashes
+
+
+def _batches(items: list, size: int) -> Iterable[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _transient_errors() -> tuple[type[Exception], ...]:
+    """The errors worth retrying, an invalid request or a missing index fail right away."""
+    from .fakes import FakeQuotaExceeded
+
+    try:
+        from google.api_core import exceptions
+    except ImportError:
+        return (FakeQuotaExceeded,)
+    return (
+        FakeQuotaExceeded,
+        exceptions.ServiceUnavailable,
+        exceptions.DeadlineExceeded,
+        exceptions.ResourceExhausted,
+        exceptions.Aborted
+    )
+
+
+def _call_with_retry(func, request: dict[str, Any], max_retries: int, limiter: TokenBucket):
+    transient = _transient_errors()
+    delay = 1.0
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            return func(request=request)
+        except transient as e:
+            if attempt == max_retries:
+                raise
+            wait = delay * (1 + random.random())
+            print(f"Request failed ({e}), retrying in {wait:.1f}s...", flush=True)
+            time.sleep(wait)
+            delay = min(delay * 2, 60)
+
+
+def sync(
+    client,
+    index: str,
+    ids: list[str],
+    datapoints: np.ndarray,
+    manifest_path: str,
+    batch_size: int = 1000,
+    requests_per_minute: float = REQUESTS_PER_MINUTE,
+    concurrency: int = 4,
+    max_retries: int = 5,
+    full: bool = False,
+    dry_run: bool = False
+) -> tuple[int, int]:
+    """Push the local changes to the remote index.  Return (upserted, removed).
+
+    The manifest isn't saved when syncing against the fake client, the ids it
+    received never reached the real index.
+    """
+    from .fakes import FakeIndexServiceClient
+
+    persist = not isinstance(client, FakeIndexServiceClient)
+    synced = {} if full else load_manifest(manifest_path, index)
+    to_upsert, to_remove, hashes = compute_diff(ids, datapoints, synced)
+    print(f"{len(to_upsert)} datapoints to upsert, {len(to_remove)} to remove.")
+
+    if dry_run or (not to_upsert and not to_remove):
+        return len(to_upsert), len(to_remove)
+
+    limiter = TokenBucket(requests_per_minute, capacity=concurrency)
+    lock = threading.Lock()
+    done = {"upserted": 0, "removed": 0}
+
+    def upsert(rows: list[int]):
+        request = {
+            "index": index,
+            "datapoints": [
+                {"datapoint_id": ids[row], "feature_vector": datapoints[row].tolist()}
+                for row in rows
+            ]
+        }
+        _call_with_retry(client.upsert_datapoints, request, max_retries, limiter)
+        with lock:
+            for row in rows:
+                synced[ids[row]] = hashes[ids[row]]
+            done["upserted"] += len(rows)
+            print(f"Upserted {done['upserted']}/{len(to_upsert)}", flush=True)
+
+    def remove(batch: list[str]):
+        request = {"index": index, "datapoint_ids": batch}
+        _call_with_retry(client.remove_datapoints, request, max_retries, limiter)
+        with lock:
+            for _id in batch:
+                synced.pop(_id, None)
+            done["removed"] += len(batch)
+            print(f"Removed {done['removed']}/{len(to_remove)}", flush=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = [executor.submit(remove, batch) for batch in _batches(to_remove, batch_size)]
+            futures += [executor.submit(upsert, batch) for batch in _batches(to_upsert, batch_size)]
+            for future in as_completed(futures):
+                if error := future.exception():
+                    for pending in futures:
+                        pending.cancel()
+                    raise error
+    finally:
+        # keep the progress of the successful requests even if one of them failed
+        if persist:
+            with lock:
+                save_manifest(manifest_path, index, dict(synced))
+
+    return done["upserted"], done["removed"]
@@ -0,0 +1,260 @@
+"""Exact nearest neighbors search with matrix multiplications.
+
+Distances to every row are computed for a chunk of queries at once with a single
+``queries @ datapoints.T`` against precomputed row norms, then the top ``number``
+rows are selected with ``argpartition``.  Rows can be filtered out with a mask.
+
+Range search returns every row within a radius.  With the euclidean metric,
+``|norm(q) - norm(x)|`` is a lower bound of the distance, so only the rows whose
+norm is within the radius of the query norm are scanned, by increasing bound,
+and the scan stops as soon as the next bound exceeds the radius (or the
+``limit``-th closest distance found so far).
+"""
+from typing import Iterable, Iterator
+
+import numpy as np
+
+
+METRICS = ("euclidean", "cosine")
+
+# memory allowed for the distance matrix of one chunk of queries
+MAX_CHUNK_BYTES = 256 * 1024 * 1024
+
+# rows compared at once by the range search
+RANGE_BLOCK_ROWS = 4096
+
+# above this ratio of rows to scan, a range query is compared to every row at once
+DENSE_RANGE_RATIO = 0.1
+
+
+def range_scan(
+    datapoints: np.ndarray,
+    squared_norms: np.ndarray,
+    query: np.ndarray,
+    blocks: Iterable[tuple[np.ndarray, float]],
+    radius: float,
+    limit: int | None = None,
+    mask: np.ndarray | None = None,
+    exclude_row: int = -1
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the sorted (distances, rows) of the rows within radius of the query.
+
+    ``blocks`` yields (rows, lower bound of their distance) by increasing bound,
+    the scan stops at the first block that can't contain a result.
+    """
+    query_norm = float(query @ query)
+    bound = radius
+    distances = np.zeros(0, dtype=np.float32)
+    rows_found = np.zeros(0, dtype=np.int64)
+    for rows, lower in blocks:
+        if lower > bound:
+            break
+        if mask is not None:
+            rows = rows[mask[rows]]
+        if exclude_row >= 0:
+            rows = rows[rows != exclude_row]
+        if not len(rows):
+            continue
+
+        squared = squared_norms[rows] - 2 * (datapoints[rows] @ query) + query_norm
+        block = np.sqrt(np.maximum(squared, 0))
+        keep = block <= bound
+        distances = np.concatenate([distances, block[keep]])
+        rows_found = np.concatenate([rows_found, rows[keep]])
+        if limit and len(distances) >= limit:
+            closest = np.argpartition(distances, limit - 1)[:limit]
+            distances, rows_found = distances[closest], rows_found[closest]
+            bound = min(bound, float(distances.max()))
+
+    order = np.argsort(distances, kind="stable")[:limit]
+    return distances[order], rows_found[order]
+
+
+class ExactSearch:
+
+    def __init__(self, datapoints: np.ndarray, metric: str = "euclidean") -> None:
+        if metric not in METRICS:
+            raise ValueError(f"Invalid metric: {metric}")
+        self.datapoints = datapoints
+        self.metric = metric
+        norms = np.einsum("ij,ij->i", datapoints, datapoints, dtype=np.float32)
+        if metric == "cosine":
+            with np.errstate(divide="ignore"):
+                self.inverse_norms = np.where(norms > 0, 1 / np.sqrt(norms), 0).astype(np.float32)
+        else:
+            self.squared_norms = norms
+
+    def __len__(self) -> int:
+        return self.datapoints.shape[0]
+
+    def _distances(self, queries: np.ndarray) -> np.ndarray:
+        products = queries @ self.datapoints.T
+        if self.metric == "cosine":
+            norms = np.linalg.norm(queries, axis=1)
+            norms[norms == 0] = 1
+            products *= self.inverse_norms[None, :]
+            products /= norms[:, None]
+            return np.subtract(1, products, out=products)
+
+        products *= -2
+        products += self.squared_norms[None, :]
+        products += np.einsum("ij,ij->i", queries, queries)[:, None]
+        return np.maximum(products, 0, out=products)
+
+    def _sorted_norms(self) -> tuple[np.ndarray, np.ndarray]:
+        if not hasattr(self, "_norm_order"):
+            norms = np.sqrt(self.squared_norms)
+            self._norm_order = np.argsort(norms, kind="stable")
+            self._norms_sorted = norms[self._norm_order]
+        return self._norm_order, self._norms_sorted
+
+    def _norm_window(self, query: np.ndarray, radius: float) -> tuple[int, int, float]:
+        """Range of the sorted norms within radius of the query norm."""
+        _, norms = self._sorted_norms()
+        norm = float(np.sqrt(query @ query))
+        # a little slack for the rounding errors of the norms
+        slack = radius + 1e-4 * (1 + norm)
+        start = int(np.searchsorted(norms, norm - slack, side="left"))
+        end = int(np.searchsorted(norms, norm + slack, side="right"))
+        return start, end, norm
+
+    def _norm_blocks(self, start: int, end: int, norm: float) -> Iterator[tuple[np.ndarray, float]]:
+        """Blocks of the rows of a norm window, by increasing bound."""
+        order, norms = self._sorted_norms()
+        lower = np.abs(norms[start:end] - norm)
+        visit = np.argsort(lower, kind="stable")
+        window = order[start:end]
+        for x in range(0, len(visit), RANGE_BLOCK_ROWS):
+            block = visit[x:x + RANGE_BLOCK_ROWS]
+            yield window[block], max(0.0, float(lower[block[0]]) - 1e-4 * (1 + norm))
+
+    def _dense_range(
+        self,
+        queries: np.ndarray,
+        radius: float,
+        limit: int | None,
+        mask: np.ndarray | None,
+        exclude: list[int]
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Compare the queries to every row with one matrix multiplication per chunk."""
+        out = []
+        step = self.chunk_size()
+        for start in range(0, len(queries), step):
+            distances = self._distances(queries[start:start + step])
+            if self.metric == "euclidean":
+                np.sqrt(distances, out=distances)
+            if mask is not None:
+                distances[:, ~mask] = np.inf
+            for x, row_distances in enumerate(distances):
+                if exclude[start + x] >= 0:
+                    row_distances[exclude[start + x]] = np.inf
+                rows = np.nonzero(row_distances <= radius)[0]
+                order = np.argsort(row_distances[rows], kind="stable")[:limit]
+                out.append((row_distances[rows[order]], rows[order]))
+        return out
+
+    def range_search(
+        self,
+        queries: np.ndarray,
+        radius: float,
+        limit: int | None = None,
+        mask: np.ndarray | None = None,
+        exclude_rows: Iterable[int] | None = None
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Return the sorted (distances, rows) of the rows within radius of each query.
+
+        ``limit`` only keeps the closest ones.  ``mask`` and ``exclude_rows`` work
+        like in ``search``.  The queries whose norm window covers most of the rows
+        are compared to every row at once instead.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        exclude = [-1] * len(queries) if exclude_rows is None else list(exclude_rows)
+        if self.metric != "euclidean":
+            # no bound for the cosine distance
+            return self._dense_range(queries, radius, limit, mask, exclude)
+
+        out: list[tuple[np.ndarray, np.ndarray] | None] = [None] * len(queries)
+        dense = []
+        for x, query in enumerate(queries):
+            start, end, norm = self._norm_window(query, radius)
+            if end - start > DENSE_RANGE_RATIO * len(self):
+                dense.append(x)
+                continue
+            out[x] = range_scan(
+                self.datapoints, self.squared_norms, query, self._norm_blocks(start, end, norm),
+                radius, limit, mask, exclude[x]
+            )
+
+        if dense:
+            found = self._dense_range(queries[dense], radius, limit, mask, [exclude[x] for x in dense])
+            for x, result in zip(dense, found):
+                out[x] = result
+        return out
+
+    def chunk_size(self) -> int:
+        return max(1, MAX_CHUNK_BYTES // max(1, len(self) * 4))
+
+    def search(
+        self,
+        queries: np.ndarray,
+        number: int,
+        mask: np.ndarray | None = None,
+        exclude_rows: Iterable[int] | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return the (distances, rows) of the closest rows of each query.
+
+        ``mask`` is a boolean array of the rows that can be returned.  ``exclude_rows``
+        gives a row to skip for each query (-1 for none), like the query itself.
+        Missing results are padded with ``inf`` and -1.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        exclude = None if exclude_rows is None else np.asarray(list(exclude_rows), dtype=np.int64)
+        count = len(queries)
+        number = min(number, len(self))
+        out_distances = np.full((count, number), np.inf, dtype=np.float32)
+        out_rows = np.full((count, number), -1, dtype=np.int64)
+        if not number:
+            return out_distances, out_rows
+
+        step = self.chunk_size()
+        for start in range(0, count, step):
+            end = min(start + step, count)
+            distances = self._distances(queries[start:end])
+            if mask is not None:
+                distances[:, ~mask] = np.inf
+            if exclude is not None:
+                chunk = exclude[start:end]
+                valid = chunk >= 0
+                distances[np.nonzero(valid)[0], chunk[valid]] = np.inf
+
+            rows = np.argpartition(distances, number - 1, axis=1)[:, :number]
+            part = np.take_along_axis(distances, rows, axis=1)
+            order = np.argsort(part, axis=1)
+            rows = np.take_along_axis(rows, order, axis=1)
+            part = np.take_along_axis(part, order, axis=1)
+            rows[np.isinf(part)] = -1
+            out_rows[start:end] = rows
+            out_distances[start:end] = part
+
+        if self.metric == "euclidean":
+            np.sqrt(out_distances, out=out_distances)
+        return out_distances, out_rows
+
+
+def mask_excluding(ids: list[str], excluded: Iterable[str]) -> np.ndarray:
+    excluded = set(excluded)
+    return np.fromiter((_id not in excluded for _id in ids), dtype=bool, count=len(ids))
+
+
+def to_range_results(ids: list[str], found: list[tuple[np.ndarray, np.ndarray]]) -> list[list[tuple[str, float]]]:
+    return [
+        [(ids[row], float(d)) for row, d in zip(rows.tolist(), distances.tolist())]
+        for distances, rows in found
+    ]
+
+
+def to_results(ids: list[str], distances: np.ndarray, rows: np.ndarray) -> list[list[tuple[str, float]]]:
+    return [
+        [(ids[row], float(d)) for row, d in zip(query_rows, query_distances) if row >= 0]
+        for query_rows, query_distances in zip(rows.tolist(), distances.tolist())
+    ]
@@ -0,0 +1,571 @@
+"""Index made of immutable segments.
+
+Every ``segment-index update`` writes a new small segment (``seg-XXXXXX.ids`` and
+``seg-XXXXXX.bin``) instead of rewriting the whole index.  Deleted ids are
+appended to a per segment tombstone file (``seg-XXXXXX.del``).  The manifest lists
+the live segments and is always replaced atomically, so readers either see the
+old or the new set of segments.  Small segments and segments with many tombstones
+are merged together by ``merge`` which can run in a background thread.
+
+Only one process writes to the segments at a time: the writes take the exclusive
+lock of ``writer.lock``, the threads of that process share it.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator
+import json
+import os
+import threading
+
+import numpy as np
+
+from . import core, journal
+
+
+SEGMENTS_DIR = "./segments"
+
+BUCKET_PREFIX = "embeddings/segments"
+
+# merge when there are more than this number of small segments
+MERGE_FACTOR = 8
+
+# a segment with less rows than this is considered small
+SMALL_SEGMENT_ROWS = 10000
+
+# rewrite a segment when this ratio of its rows are deleted
+MAX_DELETED_RATIO = 0.3
+
+LOCK_FILE = "writer.lock"
+
+
+class Segment:
+
+    def __init__(self, root: Path, name: str) -> None:
+        self.name = name
+        self.ids_path = root.joinpath(f"{name}.ids")
+        self.datapoints_path = root.joinpath(f"{name}.bin")
+        self.deleted_path = root.joinpath(f"{name}.del")
+
+        with open(self.ids_path, mode='r') as f:
+            self.ids = [x.strip() for x in f.readlines()]
+        self.rows = {_id: x for x, _id in enumerate(self.ids)}
+
+        if self.ids:
+            self.datapoints = np.memmap(
+                self.datapoints_path, dtype=np.float32, mode='r', shape=(len(self.ids), core.DIMENSION)
+            )
+        else:
+            self.datapoints = np.zeros((0, core.DIMENSION), dtype=np.float32)
+        self.deleted: set[str] = set()
+        self.load_deleted()
+        self._engine = None
+
+    @property
+    def engine(self):
+        from .search import ExactSearch
+        if self._engine is None:
+            self._engine = ExactSearch(self.datapoints)
+        return self._engine
+
+    def load_deleted(self):
+        if self.deleted_path.exists():
+            with open(self.deleted_path, mode='r') as f:
+                self.deleted = {x.strip() for x in f.readlines() if x.strip()}
+
+    @property
+    def live_count(self) -> int:
+        return len(self.ids) - len(self.deleted)
+
+    def live_mask(self) -> np.ndarray:
+        mask = np.ones(len(self.ids), dtype=bool)
+        for _id in self.deleted:
+            if (row := self.rows.get(_id)) is not None:
+                mask[row] = False
+        return mask
+
+    def files(self) -> list[Path]:
+        return [x for x in (self.ids_path, self.datapoints_path, self.deleted_path) if x.exists()]
+
+
+def exists(root: str = SEGMENTS_DIR) -> bool:
+    return Path(root).joinpath("manifest.json").exists()
+
+
+def refuse_local_writes(command: str, root: str = SEGMENTS_DIR) -> bool:
+    """Once the segments exist, serve and the clustering only read them: a command
+    rewriting ``ids.txt`` and ``datapoints.bin`` would be lost.  Print it and
+    return True in that case."""
+    if not exists(root):
+        return False
+    print(
+        f"The index is stored in {root}, `{command}` would only change the local "
+        "index files. Use `segment-index` instead."
+    )
+    return True
+
+
+class SegmentedIndex:
+
+    def __init__(self, root: str = SEGMENTS_DIR) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.root.joinpath("manifest.json")
+        self.lock = threading.RLock()
+        self._writer_guard = threading.Lock()
+        self._writers = 0
+        self._writer_file = None
+        self._segments: dict[str, Segment] = {}
+        self._masks: tuple[tuple, dict[str, np.ndarray]] | None = None
+        self.manifest: dict = {}
+        self.refresh()
+
+    # manifest
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, mode='r') as f:
+                return json.load(f)
+        except OSError:
+            return {"next": 1, "last_id": None, "segments": []}
+
+    def _write_manifest(self, manifest: dict):
+        tmp = self.manifest_path.with_name("manifest.json.tmp")
+        with open(tmp, mode='w') as f:
+            json.dump(manifest, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+        self.manifest = manifest
+
+    def refresh(self) -> list[str]:
+        """Reload the manifest, open the new segments only.  Return their names."""
+        with self.lock:
+            self.manifest = self._read_manifest()
+            names = self.manifest["segments"]
+            added = [x for x in names if x not in self._segments]
+            segments = {}
+            for name in names:
+                if segment := self._segments.get(name):
+                    segment.load_deleted()
+                else:
+                    segment = Segment(self.root, name)
+                segments[name] = segment
+            self._segments = segments
+            return added
+
+    @property
+    def segments(self) -> list[Segment]:
+        return list(self._segments.values())
+
+    @property
+    def last_id(self) -> str | None:
+        return self.manifest.get("last_id")
+
+    # writes
+
+    def acquire_writer(self, blocking: bool = True) -> bool:
+        """Take the writer lock of the directory.  Return False if another process holds it."""
+        with self._writer_guard:
+            if self._writers:
+                self._writers += 1
+                return True
+
+            f = open(self.root.joinpath(LOCK_FILE), mode='a')
+            try:
+                import fcntl
+            except ImportError:
+                # no advisory locks on this platform
+                fcntl = None
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    f.close()
+                    return False
+            self._writer_file = f
+            self._writers = 1
+            return True
+
+    def release_writer(self):
+        with self._writer_guard:
+            self._writers -= 1
+            if not self._writers and self._writer_file is not None:
+                # closing the file releases the lock
+                self._writer_file.close()
+                self._writer_file = None
+
+    @contextmanager
+    def writing(self, blocking: bool = True) -> Iterator["SegmentedIndex"]:
+        if not self.acquire_writer(blocking):
+            raise RuntimeError(f"Another process is writing to {self.root}.")
+        try:
+            yield self
+        finally:
+            self.release_writer()
+
+    def _next_name(self) -> str:
+        with self.lock:
+            manifest = self._read_manifest()
+            name = f"seg-{manifest['next']:06d}"
+            manifest["next"] += 1
+            self._write_manifest(manifest)
+            return name
+
+    def _commit(self, name: str, last_id: str | None = None, replaces: Iterable[str] = ()):
+        with self.lock:
+            manifest = self._read_manifest()
+            replaces = set(replaces)
+            segments = manifest["segments"]
+            # a merged segment takes the place of the first segment it replaces
+            position = min((segments.index(x) for x in replaces if x in segments), default=len(segments))
+            segments.insert(position, name)
+            manifest["segments"] = [x for x in segments if x not in replaces]
+            if last_id is not None:
+                manifest["last_id"] = last_id
+            self._write_manifest(manifest)
+            self.refresh()
+
+    def recover(self) -> list[str]:
+        """Commit segments left behind by an interrupted update.
+
+        Raise RuntimeError if another process is writing, its segments are not
+        left behind.
+        """
+        with self.writing(blocking=False):
+            return self._recover()
+
+    def _recover(self) -> list[str]:
+        recovered = []
+        manifest = self._read_manifest()
+        for checkpoint in sorted(self.root.glob("seg-*.checkpoint")):
+            name = checkpoint.stem
+            if name in manifest["segments"]:
+                checkpoint.unlink()
+                continue
+            rows = journal.repair(
+                str(self.root.joinpath(f"{name}.ids")),
+                str(self.root.joinpath(f"{name}.bin")),
+                str(checkpoint)
+            )
+            last_id = journal.read_checkpoint(str(checkpoint))["last_id"]
+            if rows:
+                self._commit(name, last_id)
+                recovered.append(name)
+            checkpoint.unlink()
+
+        # files of an interrupted merge
+        manifest = self._read_manifest()
+        for path in self.root.glob("seg-*.*"):
+            if path.stem not in manifest["segments"] and path.suffix in (".ids", ".bin", ".del"):
+                path.unlink()
+        return recovered
+
+    @contextmanager
+    def new_segment(self, checkpoint_every: int = 25) -> Iterator[journal.JournaledIndexWriter]:
+        """Write a new segment.  It is added to the manifest when the block exits,
+        with ``writer.last_id`` as the last indexed id (the last appended one
+        unless the block changes it)."""
+        with self.writing():
+            yield from self._new_segment(checkpoint_every)
+
+    def _new_segment(self, checkpoint_every: int) -> Iterator[journal.JournaledIndexWriter]:
+        name = self._next_name()
+        checkpoint = self.root.joinpath(f"{name}.checkpoint")
+        writer = journal.JournaledIndexWriter(
+            str(self.root.joinpath(f"{name}.ids")),
+            str(self.root.joinpath(f"{name}.bin")),
+            str(checkpoint),
+            checkpoint_every
+        )
+        try:
+            with writer:
+                yield writer
+        finally:
+            if writer.rows:
+                self._commit(name, writer.last_id)
+            else:
+                for ext in ("ids", "bin"):
+                    self.root.joinpath(f"{name}.{ext}").unlink(missing_ok=True)
+            checkpoint.unlink(missing_ok=True)
+
+    def add(self, ids: list[str], datapoints: np.ndarray):
+        with self.new_segment(checkpoint_every=max(1, len(ids))) as writer:
+            for _id, vector in zip(ids, datapoints):
+                writer.append(_id, vector)
+
+    def delete(self, ids: Iterable[str]) -> list[str]:
+        """Record tombstones for the ids.  Return the ids that were found."""
+        found = []
+        with self.writing(), self.lock:
+            self.refresh()
+            for _id in ids:
+                for segment in self.segments:
+                    if _id in segment.rows and _id not in segment.deleted:
+                        with open(segment.deleted_path, mode='a') as f:
+                            f.write(f"{_id}\n")
+                        segment.deleted.add(_id)
+                        found.append(_id)
+        return found
+
+    # reads
+
+    def live(self) -> tuple[list[str], np.ndarray]:
+        """Return the ids and datapoints of all the live rows, in segment order."""
+        ids = []
+        parts = []
+        with self.lock:
+            segments, masks = self.segments, self.live_masks()
+        for segment in segments:
+            mask = masks[segment.name]
+            ids.extend(_id for _id, alive in zip(segment.ids, mask) if alive)
+            parts.append(segment.datapoints[mask])
+        if not parts:
+            return ids, np.zeros((0, core.DIMENSION), dtype=np.float32)
+        return ids, np.concatenate(parts)
+
+    def get_vector(self, _id: str) -> np.ndarray | None:
+        # the most recent segment wins
+        for segment in reversed(self.segments):
+            if (row := segment.rows.get(_id)) is not None and _id not in segment.deleted:
+                return np.array(segment.datapoints[row])
+        return None
+
+    def live_masks(self) -> dict[str, np.ndarray]:
+        """The rows of each segment to read: the live rows whose id isn't live in a
+        more recent segment.  Cached until a segment or a tombstone is added."""
+        with self.lock:
+            segments = self.segments
+            key = tuple((x.name, len(x.deleted)) for x in segments)
+            if self._masks is not None and self._masks[0] == key:
+                return self._masks[1]
+
+            masks = {}
+            newer: set[str] = set()
+            for segment in reversed(segments):
+                mask = segment.live_mask()
+                for _id in newer.intersection(segment.rows):
+                    mask[segment.rows[_id]] = False
+                newer.update(_id for _id, alive in zip(segment.ids, mask) if alive)
+                masks[segment.name] = mask
+            self._masks = (key, masks)
+            return masks
+
+    def __len__(self) -> int:
+        return int(sum(x.sum() for x in self.live_masks().values()))
+
+    def search(
+        self,
+        vectors: np.ndarray,
+        number: int,
+        exclude: Iterable[str] | None = None
+    ) -> list[list[tuple[str, float]]]:
+        """Search every segment and merge their top ``number`` euclidean neighbors.
+
+        An id found in several segments is only returned from the most recent one,
+        like ``get_vector``.
+        """
+        from . import search
+
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        excluded = set(exclude or [])
+        candidates: list[list[tuple[float, str]]] = [[] for _ in range(len(vectors))]
+        with self.lock:
+            segments, masks = self.segments, self.live_masks()
+        for segment in segments:
+            if not segment.live_count:
+                continue
+            mask = masks[segment.name]
+            if excluded:
+                mask = mask & search.mask_excluding(segment.ids, excluded)
+            distances, rows = segment.engine.search(vectors, number, mask)
+            for query, found in enumerate(search.to_results(segment.ids, distances, rows)):
+                candidates[query].extend((d, _id) for _id, d in found)
+
+        out = []
+        for found in candidates:
+            found.sort()
+            out.append([(_id, d) for d, _id in found[:number]])
+        return out
+
+    def search_radius(
+        self,
+        vectors: np.ndarray,
+        radius: float,
+        limit: int | None = None,
+        exclude: Iterable[str] | None = None
+    ) -> list[list[tuple[str, float]]]:
+        """Range search every segment and merge the ids within radius."""
+        from . import search
+
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        excluded = set(exclude or [])
+        candidates: list[list[tuple[float, str]]] = [[] for _ in range(len(vectors))]
+        with self.lock:
+            segments, masks = self.segments, self.live_masks()
+        for segment in segments:
+            if not segment.live_count:
+                continue
+            mask = masks[segment.name]
+            if excluded:
+                mask = mask & search.mask_excluding(segment.ids, excluded)
+            found = segment.engine.range_search(vectors, radius, limit, mask)
+            for query, results in enumerate(search.to_range_results(segment.ids, found)):
+                candidates[query].extend((d, _id) for _id, d in results)
+
+        out = []
+        for found in candidates:
+            found.sort()
+            out.append([(_id, d) for d, _id in found[:limit]])
+        return out
+
+    # merge
+
+    def merge_candidates(self) -> list[Segment]:
+        """Only adjacent segments are merged, the rows must stay in timestamp order."""
+        segments = self.segments
+        small = [x.live_count < SMALL_SEGMENT_ROWS for x in segments]
+        if sum(small) > MERGE_FACTOR:
+            # the longest run of adjacent small segments
+            best = (0, 0)
+            start = 0
+            for x, is_small in enumerate([*small, False]):
+                if not is_small:
+                    if x - start > best[1] - best[0]:
+                        best = (start, x)
+                    start = x + 1
+            if best[1] - best[0] > 1:
+                return segments[best[0]:best[1]]
+
+        # rewrite a single segment to purge its tombstones
+        for segment in self.segments:
+            if segment.ids and len(segment.deleted) / len(segment.ids) > MAX_DELETED_RATIO:
+                return [segment]
+        return []
+
+    def merge(self, segments: list[Segment] | None = None) -> str | None:
+        """Merge the segments (or the ones chosen by the merge policy) into one."""
+        with self.writing():
+            return self._merge(segments)
+
+    def _merge(self, segments: list[Segment] | None) -> str | None:
+        with self.lock:
+            self.refresh()
+            if segments is None:
+                segments = self.merge_candidates()
+            if not segments:
+                return None
+            order = {x.name: position for position, x in enumerate(self.segments)}
+            positions = sorted(order[x.name] for x in segments)
+            if positions != list(range(positions[0], positions[0] + len(positions))):
+                raise ValueError("Only adjacent segments can be merged.")
+            segments = [self.segments[x] for x in positions]
+            snapshot = {x.name: set(x.deleted) for x in segments}
+
+        # segment order is preserved so the ids stay in timestamp order
+        names = [x.name for x in segments]
+        print(f"Merging {', '.join(names)}...")
+        name = self._next_name()
+        ids_path = self.root.joinpath(f"{name}.ids")
+        with (
+            open(ids_path, mode='w') as ids_file,
+            open(self.root.joinpath(f"{name}.bin"), mode='wb') as datapoints_file
+        ):
+            for segment in segments:
+                mask = segment.live_mask()
+                for _id, alive in zip(segment.ids, mask):
+                    if alive:
+                        ids_file.write(f"{_id}\n")
+                datapoints_file.write(segment.datapoints[mask].tobytes())
+            # both files are on disk before the manifest points at them
+            for f in (ids_file, datapoints_file):
+                f.flush()
+                os.fsync(f.fileno())
+
+        with self.lock:
+            # tombstones written while merging are moved to the new segment
+            late = []
+            for segment in segments:
+                segment.load_deleted()
+                late.extend(segment.deleted - snapshot[segment.name])
+            if late:
+                with open(self.root.joinpath(f"{name}.del"), mode='w') as f:
+                    f.writelines(f"{_id}\n" for _id in late)
+
+            self._commit(name, replaces=names)
+            for segment in segments:
+                for path in segment.files():
+                    path.unlink(missing_ok=True)
+        return name
+
+    def merge_all(self) -> str | None:
+        return self.merge(self.segments)
+
+    # bucket
+
+    def upload(self, bucket=None):
+        with self.writing():
+            self._upload(bucket)
+
+    def _upload(self, bucket):
+        from . import transfer
+        bucket = bucket or core.get_bucket()
+        self.refresh()
+        for segment in self.segments:
+            for path in segment.files():
+                transfer.upload_file(bucket, str(path), f"{BUCKET_PREFIX}/{path.name}")
+        # the manifest is uploaded last so readers never see a missing segment
+        transfer.upload_file(bucket, str(self.manifest_path), f"{BUCKET_PREFIX}/manifest.json")
+
+        # then the segments merged away are deleted
+        live = set(self.manifest["segments"])
+        for blob in list(bucket.list_blobs(prefix=f"{BUCKET_PREFIX}/seg-")):
+            if blob.name.rsplit("/", 1)[-1].split(".", 1)[0] not in live:
+                blob.delete()
+
+    def download(self, bucket=None) -> list[str]:
+        """Download the new segments and tombstones.  Return the new segment names."""
+        with self.writing():
+            return self._download(bucket)
+
+    def _download(self, bucket) -> list[str]:
+        from . import transfer
+        bucket = bucket or core.get_bucket()
+        tmp = self.root.joinpath("manifest.remote.json")
+        transfer.download_file(bucket, f"{BUCKET_PREFIX}/manifest.json", str(tmp))
+        with open(tmp, mode='r') as f:
+            remote = json.load(f)
+
+        for name in remote["segments"]:
+            for ext in ("ids", "bin", "del"):
+                blob_name = f"{BUCKET_PREFIX}/{name}.{ext}"
+                if ext == "del" and bucket.get_blob(blob_name) is None:
+                    continue
+                transfer.download_file(bucket, blob_name, str(self.root.joinpath(f"{name}.{ext}")))
+
+        with self.lock:
+            os.replace(tmp, self.manifest_path)
+            for path in self.root.glob("seg-*.*"):
+                if path.stem not in remote["segments"] and path.suffix != ".checkpoint":
+                    path.unlink()
+            return self.refresh()
+
+
+class BackgroundMerger(threading.Thread):
+    """Apply the merge policy every ``interval`` seconds."""
+
+    def __init__(self, index: SegmentedIndex, interval: float = 60.0) -> None:
+        super().__init__(daemon=True)
+        self.index = index
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                while self.index.merge():
+                    pass
+            except Exception as e:
+                print(f"Background merge failed: {e}", flush=True)
+
+    def stop(self):
+        self.stopped.set()
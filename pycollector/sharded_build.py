@@ -0,0 +1,240 @@
+"""Build the local index (or the dup index) with several worker processes.
+
+The timestamp ordered ids to process are split in contiguous shards, recorded in
+``shards/plan.json``.  Each worker process streams the items of its shard from
+Firestore, vectorizes them and appends them to its own journaled partial index,
+so an interrupted build resumes where every shard stopped.  The merge
+concatenates the shards in plan order, which is the global timestamp order, after
+checking that every shard only holds its own ids, in order and once.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from . import core, journal
+
+
+SHARDS_DIR = "./shards"
+
+SOURCES = ("items", "duplicates")
+
+# rows copied at once by the merge
+MERGE_ROWS = 4096
+
+
+def _plan_path(root: str) -> str:
+    return os.path.join(root, "plan.json")
+
+
+def shard_paths(shard: int, root: str = SHARDS_DIR) -> tuple[str, str, str]:
+    """The ids, datapoints and checkpoint files of a shard."""
+    name = os.path.join(root, f"shard-{shard:03d}")
+    return f"{name}.ids", f"{name}.bin", f"{name}.checkpoint"
+
+
+def _query(source: str, start_id: str | None = None, start_after_id: str | None = None):
+    if source == "duplicates":
+        query = core.dup_query(start_id)
+        if start_after_id:
+            collection = core.get_admin_user().collection("duplicates")
+            query = query.start_after(collection.document(start_after_id).get(["timestamp"]))
+        return query
+    return core._items_query(start_id, start_after_id, fields=[])
+
+
+def plan(
+    source: str,
+    shards: int,
+    start_after_id: str | None = None,
+    root: str = SHARDS_DIR
+) -> list[list[str]]:
+    """Split the ids after start_after_id in contiguous shards and save the plan."""
+    if source not in SOURCES:
+        raise ValueError(f"Invalid source: {source}")
+
+    print("Listing the items...")
+    ids = [x.id for x in core.stream_query(_query(source, start_after_id=start_after_id))]
+    shards = max(1, min(shards, len(ids)))
+    size, extra = divmod(len(ids), shards)
+    bounds = [x * size + min(x, extra) for x in range(shards + 1)]
+    parts = [ids[a:b] for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    os.makedirs(root, exist_ok=True)
+    core.replace_file(
+        _plan_path(root),
+        lambda f: json.dump({"source": source, "start_after_id": start_after_id, "shards": parts}, f)
+    )
+    return parts
+
+
+def load_plan(root: str = SHARDS_DIR) -> dict | None:
+    try:
+        with open(_plan_path(root), mode='r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _init_worker(threads: int):
+    # share the cores between the workers instead of each tensorflow using all of them
+    os.environ.setdefault("TF_NUM_INTRAOP_THREADS", str(threads))
+    os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+
+
+def build_shard(
+    source: str,
+    shard: int,
+    ids: list[str],
+    stop_at: str | None = None,
+    update_text: bool = False,
+    checkpoint_every: int = 25,
+    root: str = SHARDS_DIR
+) -> int:
+    """Vectorize the ids of a shard that are not in its partial index yet.  Return its row count.
+
+    ``stop_at`` is the first id of the next shard, the stream ends there even if
+    the last id of this shard was deleted in the meantime.
+    """
+    ids_path, datapoints_path, checkpoint_path = shard_paths(shard, root)
+    with journal.JournaledIndexWriter(ids_path, datapoints_path, checkpoint_path, checkpoint_every) as writer:
+        with open(ids_path, mode='r') as f:
+            done = {x.strip() for x in f}
+        remaining = [x for x in ids if x not in done]
+        if not remaining:
+            return writer.rows
+
+        planned = set(remaining)
+        last = remaining[-1]
+
+        def items() -> Iterator:
+            # items added inside the range after the plan was made are skipped
+            for item in core.stream_query(_query(source, start_id=remaining[0])):
+                if item.id == stop_at:
+                    return
+                if item.id in planned:
+                    yield item
+                if item.id == last:
+                    return
+
+        if source == "duplicates":
+            core.append_dup_items(writer, items(), len(remaining))
+        else:
+            core.append_items(writer, items(), update_text, len(remaining))
+        rows = writer.rows
+    return rows
+
+
+def build(
+    parts: list[list[str]],
+    source: str,
+    workers: int,
+    update_text: bool = False,
+    checkpoint_every: int = 25,
+    root: str = SHARDS_DIR
+) -> list[int]:
+    """Build every shard, ``workers`` at a time.  Return the row count of each shard."""
+    workers = max(1, min(workers, len(parts)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    # tensorflow doesn't survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(threads,)) as executor:
+        futures = [
+            executor.submit(
+                build_shard,
+                source,
+                shard,
+                ids,
+                parts[shard + 1][0] if shard + 1 < len(parts) else None,
+                update_text,
+                checkpoint_every,
+                root
+            )
+            for shard, ids in enumerate(parts)
+        ]
+        return [future.result() for future in futures]
+
+
+def check(parts: list[list[str]], root: str = SHARDS_DIR) -> tuple[list[list[str]], list[str]]:
+    """Return the ids of each shard and the planned ids missing from them.
+
+    Raise ValueError if a shard is inconsistent, holds ids of another shard or
+    holds them out of order.
+    """
+    shard_ids = []
+    missing = []
+    seen: set[str] = set()
+    for shard, planned in enumerate(parts):
+        ids_path, datapoints_path, checkpoint_path = shard_paths(shard, root)
+        report = journal.inspect(ids_path, datapoints_path, checkpoint_path)
+        if not journal.is_consistent(report):
+            raise ValueError(f"Shard {shard} is inconsistent, build it again to repair it.")
+
+        with open(ids_path, mode='r') as f:
+            ids = [x.strip() for x in f]
+
+        order = {_id: x for x, _id in enumerate(planned)}
+        positions = [order.get(_id, -1) for _id in ids]
+        if -1 in positions:
+            raise ValueError(f"Shard {shard} contains ids that are not part of it.")
+        if any(b <= a for a, b in zip(positions[:-1], positions[1:])):
+            raise ValueError(f"Shard {shard} is not in timestamp order.")
+        if duplicates := seen.intersection(ids):
+            raise ValueError(f"Shard {shard} contains ids of another shard: {', '.join(sorted(duplicates))}")
+        seen.update(ids)
+
+        present = set(ids)
+        missing.extend(x for x in planned if x not in present)
+        shard_ids.append(ids)
+    return shard_ids, missing
+
+
+def merge(
+    parts: list[list[str]],
+    ids_path: str,
+    datapoints_path: str,
+    checkpoint_path: str,
+    start_after_id: str | None = None,
+    root: str = SHARDS_DIR
+) -> int:
+    """Concatenate the shards in plan order into the index.  Return the number of rows merged.
+
+    When the plan starts after an id, the rows are appended after it with the
+    journaled writer, else the index files are replaced.
+    """
+    shard_ids, missing = check(parts, root)
+    for _id in missing:
+        print(f"Warning: {_id} was not built, it may have been deleted.")
+
+    def shard_rows() -> Iterator[np.ndarray]:
+        for shard, ids in enumerate(shard_ids):
+            if not ids:
+                continue
+            datapoints = np.memmap(shard_paths(shard, root)[1], dtype=np.float32, mode='r', shape=(len(ids), core.DIMENSION))
+            for start in range(0, len(ids), MERGE_ROWS):
+                yield datapoints[start:start + MERGE_ROWS]
+
+    all_ids = [_id for ids in shard_ids for _id in ids]
+    if start_after_id:
+        with journal.JournaledIndexWriter(ids_path, datapoints_path, checkpoint_path) as writer:
+            if writer.last_id != start_after_id:
+                raise ValueError(f"The index doesn't end with {start_after_id} anymore, the shards can't be appended.")
+            ids = iter(all_ids)
+            for rows in shard_rows():
+                for vector in rows:
+                    writer.append(next(ids), vector)
+        return len(all_ids)
+
+    def write_datapoints(f):
+        for rows in shard_rows():
+            f.write(np.ascontiguousarray(rows).tobytes())
+
+    # the ids last, like core.write_datapoints / core.write_ids
+    core.replace_file(datapoints_path, write_datapoints, mode='wb')
+    core.replace_file(ids_path, lambda f: f.write("".join(f"{x}\n" for x in all_ids)))
+    journal.write_checkpoint(len(all_ids), all_ids[-1] if all_ids else None, checkpoint_path)
+    return len(all_ids)
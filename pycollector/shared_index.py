@@ -0,0 +1,145 @@
+"""Index shared by the ``serve`` worker processes.
+
+The parent process copies the ids and datapoints in a shared memory block and
+publishes its name and a generation number in memory inherited by the forked
+workers.  A worker maps the block when the generation changes, so every worker
+sees the same single copy of the index and reloads it as soon as the parent
+publishes a new one.
+"""
+from multiprocessing import shared_memory
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+
+from . import core
+
+
+# set in the worker processes, used by nearest_neighbors instead of the files
+READER: "SharedIndexReader | None" = None
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always tracks the block, the forked workers share the
+        # resource tracker of the parent so registering it again does nothing
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedIndexPublisher:
+    """Created in the parent process before forking the workers."""
+
+    def __init__(self) -> None:
+        self.generation = multiprocessing.Value('q', 0)
+        self.name = multiprocessing.Array('c', 64)
+        self.rows = multiprocessing.Value('q', 0)
+        self.ids_size = multiprocessing.Value('q', 0)
+        self.stamp: tuple | None = None
+        self._shm: shared_memory.SharedMemory | None = None
+
+    def _index_stamp(self) -> tuple:
+        from . import segments
+        if segments.exists():
+            root = segments.SEGMENTS_DIR
+            files = [os.path.join(root, x) for x in sorted(os.listdir(root))]
+        else:
+            files = [core.IDS_FILE, core.DATAPOINTS_FILE]
+        return tuple((x, os.stat(x).st_mtime_ns, os.stat(x).st_size) for x in files if os.path.exists(x))
+
+    def changed(self) -> bool:
+        return self._index_stamp() != self.stamp
+
+    def publish(self):
+        stamp = self._index_stamp()
+        ids, datapoints = core.load_index()
+        datapoints = np.ascontiguousarray(datapoints, dtype=np.float32)
+        ids_bytes = "\n".join(ids).encode()
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, datapoints.nbytes + len(ids_bytes)))
+        shared = np.ndarray(datapoints.shape, dtype=np.float32, buffer=shm.buf)
+        shared[:] = datapoints
+        shm.buf[datapoints.nbytes:datapoints.nbytes + len(ids_bytes)] = ids_bytes
+        del shared
+
+        with self.generation.get_lock():
+            self.name.value = shm.name.encode()
+            self.rows.value = datapoints.shape[0]
+            self.ids_size.value = len(ids_bytes)
+            self.generation.value += 1
+
+        # the workers still using the old block keep their mapping until they switch
+        self.close()
+        self._shm = shm
+        self.stamp = stamp
+        print(f"Published index generation {self.generation.value} ({datapoints.shape[0]} rows)", flush=True)
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+class SharedIndexReader:
+    """Used in the worker processes to map the published index."""
+
+    def __init__(self, publisher: SharedIndexPublisher) -> None:
+        self.publisher = publisher
+        self.generation = -1
+        self.loaded: tuple | None = None
+        self._blocks: list[shared_memory.SharedMemory] = []
+        # the lane threads of the worker map and release the blocks concurrently
+        self._lock = threading.Lock()
+
+    def _release(self):
+        """Called with the lock held."""
+        # the old blocks can be closed once nothing references their buffer anymore
+        for shm in self._blocks[:-1]:
+            try:
+                shm.close()
+                self._blocks.remove(shm)
+            except BufferError:
+                pass
+
+    def get(self) -> tuple[tuple, list[str], "search.ExactSearch", dict[str, int]]:
+        """Return the index like ``nearest_neighbors._load``."""
+        with self._lock:
+            return self._get()
+
+    def _get(self) -> tuple[tuple, list[str], "search.ExactSearch", dict[str, int]]:
+        from . import search
+
+        publisher = self.publisher
+        while self.generation != publisher.generation.value:
+            if not publisher.generation.value:
+                raise FileNotFoundError("No index has been published")
+            with publisher.generation.get_lock():
+                generation = publisher.generation.value
+                name = publisher.name.value.decode()
+                rows = publisher.rows.value
+                ids_size = publisher.ids_size.value
+            try:
+                shm = _attach(name)
+            except FileNotFoundError:
+                # replaced while we were reading it, try the new one
+                continue
+
+            # frombuffer holds an export of the mapping: the block can't be closed
+            # while a thread still reads these datapoints
+            datapoints = np.frombuffer(shm.buf, dtype=np.float32, count=rows * core.DIMENSION)
+            datapoints = datapoints.reshape((rows, core.DIMENSION))
+            offset = datapoints.nbytes
+            ids = bytes(shm.buf[offset:offset + ids_size]).decode().split("\n") if rows else []
+            self.loaded = (
+                ("shared", generation),
+                ids,
+                search.ExactSearch(datapoints),
+                {_id: x for x, _id in enumerate(ids)}
+            )
+            self._blocks.append(shm)
+            self.generation = generation
+            self._release()
+        return self.loaded
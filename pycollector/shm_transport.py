@@ -0,0 +1,140 @@
+"""Hand large ``serve`` responses over in shared memory.
+
+When a local client asks for ``"response": "shm"``, large vectors are written as
+raw float32 in a named shared memory block and large json payloads are written
+as text in one.  Only a small handle goes through the socket:
+
+    {"vector": {"shm": "psm_1234", "dtype": "float32", "shape": [1280]}}
+    {"shm": "psm_1234", "size": 5321, "format": "json"}
+
+The client owns the block once it received the handle and must unlink it (on
+linux it is the file ``/dev/shm/<name>``).  Blocks that are not claimed after
+``SHM_TTL`` seconds are unlinked by a timer of the server.  Payloads and arrays
+smaller than ``SHM_THRESHOLD`` are sent inline, a block costs more than that.
+"""
+from multiprocessing import shared_memory
+from typing import Any
+import json
+import threading
+import time
+
+import numpy as np
+
+
+# json payloads and arrays smaller than this are sent inline
+SHM_THRESHOLD = 16 * 1024
+
+SHM_TTL = 60.0
+
+
+def _create(size: int) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(create=True, size=max(1, size), track=False)
+    except TypeError:
+        # python < 3.13, the resource tracker would unlink the block when the server exits
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _unlink(name: str):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+class ShmResponses:
+
+    def __init__(self, threshold: int = SHM_THRESHOLD, ttl: float = SHM_TTL) -> None:
+        self.threshold = threshold
+        self.ttl = ttl
+        self._pending: list[tuple[float, str]] = []
+        self._lock = threading.Lock()
+        self._expirer: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    def _write(self, data: bytes) -> str:
+        shm = _create(len(data))
+        shm.buf[:len(data)] = data
+        name = shm.name
+        shm.close()
+        with self._lock:
+            self._pending.append((time.monotonic(), name))
+            if self._expirer is None:
+                # started by the first block, in the process that serves it
+                self._expirer = threading.Thread(target=self._expire_loop, daemon=True)
+                self._expirer.start()
+        return name
+
+    def _expire_loop(self):
+        while not self._stopped.wait(self.ttl / 2):
+            self.expire()
+
+    def close(self):
+        """Stop the timer and unlink the blocks that were not claimed yet."""
+        self._stopped.set()
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for _, name in pending:
+            _unlink(name)
+
+    def expire(self):
+        """Unlink the blocks that were never claimed by a client."""
+        limit = time.monotonic() - self.ttl
+        with self._lock:
+            expired = [x for x in self._pending if x[0] < limit]
+            self._pending = [x for x in self._pending if x[0] >= limit]
+        for _, name in expired:
+            _unlink(name)
+
+    def encode(self, response: dict[str, Any]) -> bytes:
+        out = {}
+        for key, value in response.items():
+            if isinstance(value, np.ndarray) and value.size * 4 >= self.threshold:
+                array = np.ascontiguousarray(value, dtype=np.float32)
+                out[key] = {"shm": self._write(array.tobytes()), "dtype": "float32", "shape": list(array.shape)}
+            elif isinstance(value, np.ndarray):
+                out[key] = value.tolist()
+            else:
+                out[key] = value
+
+        data = json.dumps(out).encode()
+        if len(data) <= self.threshold:
+            return data
+        return json.dumps({"shm": self._write(data), "size": len(data), "format": "json"}).encode()
+
+
+def encode_json(response: dict[str, Any]) -> bytes:
+    """Regular response, numpy arrays are sent as lists."""
+    return json.dumps({
+        key: value.tolist() if isinstance(value, np.ndarray) else value
+        for key, value in response.items()
+    }).encode()
+
+
+def _read(name: str, size: int | None = None) -> bytes:
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size] if size is not None else shm.buf)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def decode(response: dict[str, Any]) -> dict[str, Any]:
+    """Client side, resolve and unlink the shared memory blocks of a response."""
+    if response.get("format") == "json" and "shm" in response:
+        response = json.loads(_read(response["shm"], response["size"]))
+
+    out = {}
+    for key, value in response.items():
+        if isinstance(value, dict) and "shm" in value and "dtype" in value:
+            size = int(np.prod(value["shape"])) * np.dtype(value["dtype"]).itemsize
+            out[key] = np.frombuffer(_read(value["shm"], size), dtype=value["dtype"]).reshape(value["shape"])
+        else:
+            out[key] = value
+    return out
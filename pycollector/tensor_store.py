@@ -0,0 +1,176 @@
+"""Store of the preprocessed images, ready to feed the model.
+
+Every image is decoded, converted to RGB and resized to 224x224 once, then
+appended as raw uint8 to ``tensors.bin`` with its id in ``tensors.ids``.  The
+tensors file is memory mapped, so vectorizing the whole corpus again is a
+sequential read of one file instead of downloading and decoding every image.
+
+Like the local index, the tensors are written before the ids and a row only
+exists once its id is on disk.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+import os
+
+import numpy as np
+
+from . import core
+
+
+TENSORS_FILE = "./tensors.bin"
+
+TENSOR_IDS_FILE = "./tensors.ids"
+
+SHAPE = (224, 224, 3)
+
+ROW_SIZE = int(np.prod(SHAPE))
+
+
+def preprocess(filename: str) -> np.ndarray:
+    """Decode an image as the model expects it."""
+    from PIL import Image
+
+    img = Image.open(filename).convert("RGB")
+    return np.array(img.resize([224, 224]))
+
+
+def _fetch(_id: str) -> tuple[str, np.ndarray | None, str]:
+    try:
+        with core.DownloadOrLocalImage(_id) as filename:
+            return _id, preprocess(filename), ""
+    except Exception as e:
+        return _id, None, str(e)
+
+
+class TensorStore:
+
+    def __init__(self, tensors_path: str = TENSORS_FILE, ids_path: str = TENSOR_IDS_FILE) -> None:
+        self.tensors_path = tensors_path
+        self.ids_path = ids_path
+        self.reload()
+
+    def reload(self):
+        try:
+            with open(self.ids_path, mode='r') as f:
+                ids = [x.strip() for x in f if x.endswith("\n")]
+        except FileNotFoundError:
+            ids = []
+        size = os.path.getsize(self.tensors_path) if os.path.exists(self.tensors_path) else 0
+        # ignore the tensors of an interrupted append
+        self.ids = ids[:size // ROW_SIZE]
+        self.rows = {_id: x for x, _id in enumerate(self.ids)}
+        self.tensors = (
+            np.memmap(self.tensors_path, dtype=np.uint8, mode='r', shape=(len(self.ids), *SHAPE))
+            if self.ids else np.zeros((0, *SHAPE), dtype=np.uint8)
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, _id: str) -> bool:
+        return _id in self.rows
+
+    def get(self, _id: str) -> np.ndarray | None:
+        if (row := self.rows.get(_id)) is None:
+            return None
+        return self.tensors[row]
+
+    def _truncate(self):
+        # drop the trailing bytes of an interrupted append before writing after them
+        with open(self.tensors_path, mode='ab') as f:
+            f.truncate(len(self.ids) * ROW_SIZE)
+        with open(self.ids_path, mode='a') as f:
+            f.truncate(sum(len(x.encode()) + 1 for x in self.ids))
+
+    def append(self, items: Iterable[tuple[str, np.ndarray]], sync_every: int = 256) -> int:
+        """Append the tensors of new ids, return the number of rows added."""
+        self._truncate()
+        added = 0
+        with open(self.tensors_path, mode='ab') as tensors_file, open(self.ids_path, mode='a') as ids_file:
+            pending: list[str] = []
+
+            def sync():
+                tensors_file.flush()
+                os.fsync(tensors_file.fileno())
+                ids_file.write("".join(f"{x}\n" for x in pending))
+                ids_file.flush()
+                os.fsync(ids_file.fileno())
+                pending.clear()
+
+            for _id, tensor in items:
+                if _id in self.rows or _id in pending:
+                    continue
+                tensor = np.ascontiguousarray(tensor, dtype=np.uint8)
+                if tensor.shape != SHAPE:
+                    raise ValueError(f"Invalid tensor shape for {_id}: {tensor.shape}")
+                tensors_file.write(tensor.tobytes())
+                pending.append(_id)
+                added += 1
+                if len(pending) >= sync_every:
+                    sync()
+            sync()
+        self.reload()
+        return added
+
+    def build(self, ids: Iterable[str], workers: int = 8, chunksize: int = 4) -> tuple[int, dict[str, str]]:
+        """Download and decode the missing ids in parallel.  Return the number added
+        and the error of the ids that couldn't be decoded."""
+        missing = [x for x in dict.fromkeys(ids) if x not in self.rows]
+        errors: dict[str, str] = {}
+
+        def fetched() -> Iterator[tuple[str, np.ndarray]]:
+            with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+                for x, (_id, tensor, error) in enumerate(executor.map(_fetch, missing, chunksize=chunksize)):
+                    print(f"{x + 1}/{len(missing)} {_id}", flush=True)
+                    if tensor is None:
+                        errors[_id] = error
+                        continue
+                    yield _id, tensor
+
+        return self.append(fetched()), errors
+
+    def compact(self, keep: Iterable[str]) -> int:
+        """Rewrite the store with only these ids, return the number of rows removed."""
+        keep = set(keep)
+        rows = [x for x, _id in enumerate(self.ids) if _id in keep]
+        removed = len(self.ids) - len(rows)
+        if not removed:
+            return 0
+
+        def write(f):
+            for start in range(0, len(rows), 256):
+                f.write(self.tensors[rows[start:start + 256]].tobytes())
+
+        ids = "".join(f"{self.ids[x]}\n" for x in rows)
+        # the store is emptied while the rows move, a crash in between loses the
+        # store (it is only a cache) but never gives an id the tensor of another one
+        core.replace_file(self.ids_path, lambda f: None)
+        core.replace_file(self.tensors_path, write, mode='wb')
+        core.replace_file(self.ids_path, lambda f: f.write(ids))
+        self.reload()
+        return removed
+
+    def batches(self, ids: Iterable[str] | None = None, batch_size: int = 64) -> Iterator[tuple[list[str], np.ndarray]]:
+        """Yield the (ids, tensors) of the stored ids, in the order of the file."""
+        rows = range(len(self.ids)) if ids is None else sorted(self.rows[x] for x in ids if x in self.rows)
+        rows = list(rows)
+        for start in range(0, len(rows), batch_size):
+            chunk = rows[start:start + batch_size]
+            yield [self.ids[x] for x in chunk], np.asarray(self.tensors[chunk])
+
+
+# (ids file stamp, store) of the last loaded local store
+_STORE: tuple[tuple, TensorStore] | None = None
+
+
+def get_store() -> TensorStore | None:
+    """The local store, if it was built.  Reloaded when its ids change."""
+    global _STORE
+    try:
+        stat = os.stat(TENSOR_IDS_FILE)
+    except FileNotFoundError:
+        return None
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if _STORE is None or _STORE[0] != stamp:
+        _STORE = (stamp, TensorStore())
+    return _STORE[1]
@@ -0,0 +1,149 @@
+"""Checksum aware transfers between local files and the bucket.
+
+Files whose checksum already matches the remote blob are skipped.  Large files are
+transferred in slices by several threads.  Downloads are written to a ``.part``
+file, the completed slices are recorded next to it so an interrupted download can
+be resumed, and the destination is only replaced once the checksum is verified.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import hashlib
+import json
+import os
+import threading
+
+
+CHUNK_SIZE = 32 * 1024 * 1024
+
+PARALLEL_THRESHOLD = 2 * CHUNK_SIZE
+
+MAX_WORKERS = 8
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def file_checksums(path: str) -> dict[str, str]:
+    """Return the base64 crc32c (when available) and md5 of a local file, like gcs."""
+    md5 = hashlib.md5()
+    try:
+        import google_crc32c
+        crc = google_crc32c.Checksum()
+    except ImportError:
+        crc = None
+
+    with open(path, mode='rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            md5.update(chunk)
+            if crc is not None:
+                crc.update(chunk)
+
+    out = {"md5_hash": base64.b64encode(md5.digest()).decode()}
+    if crc is not None:
+        out["crc32c"] = base64.b64encode(crc.digest()).decode()
+    return out
+
+
+def same_content(path: str, blob) -> bool:
+    if not os.path.exists(path) or blob is None or os.path.getsize(path) != blob.size:
+        return False
+
+    checksums = file_checksums(path)
+    # composite and multipart objects only have a crc32c
+    if blob.crc32c and "crc32c" in checksums:
+        return blob.crc32c == checksums["crc32c"]
+    if blob.md5_hash:
+        return blob.md5_hash == checksums["md5_hash"]
+    return False
+
+
+def _is_gcs(blob) -> bool:
+    return type(blob).__module__.startswith("google.cloud.storage")
+
+
+def upload_file(bucket, path: str, blob_name: str, max_workers: int = MAX_WORKERS) -> bool:
+    """Upload path to blob_name unless it is already there.  Return if it was uploaded."""
+    remote = bucket.get_blob(blob_name)
+    if same_content(path, remote):
+        print(f"{blob_name} is up to date.")
+        return False
+
+    print(f"uploading {path}...")
+    blob = bucket.blob(blob_name)
+    if _is_gcs(blob) and os.path.getsize(path) > PARALLEL_THRESHOLD:
+        from google.cloud.storage import transfer_manager
+        transfer_manager.upload_chunks_concurrently(
+            path, blob, chunk_size=CHUNK_SIZE, max_workers=max_workers
+        )
+    else:
+        blob.upload_from_filename(path)
+    return True
+
+
+def _load_progress(path: str, generation, size: int) -> set[int]:
+    try:
+        with open(path, mode='r') as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return set()
+
+    if progress.get("generation") != generation or progress.get("size") != size:
+        return set()
+    return set(progress.get("done", []))
+
+
+def _save_progress(path: str, generation, size: int, done: set[int]):
+    with open(path, mode='w') as f:
+        json.dump({"generation": generation, "size": size, "done": sorted(done)}, f)
+
+
+def download_file(bucket, blob_name: str, path: str, max_workers: int = MAX_WORKERS) -> bool:
+    """Download blob_name to path unless it already matches.  Return if it was downloaded."""
+    blob = bucket.get_blob(blob_name)
+    if blob is None:
+        raise FileNotFoundError(f"{blob_name} doesn't exist in bucket {bucket.name}")
+
+    if same_content(path, blob):
+        print(f"{path} is up to date.")
+        return False
+
+    print(f"downloading {blob_name}...")
+    part = f"{path}.part"
+    progress_file = f"{part}.json"
+    size = blob.size
+    done = _load_progress(progress_file, blob.generation, size) if os.path.exists(part) else set()
+    if done:
+        print(f"resuming download, {len(done)} slices already downloaded.")
+
+    with open(part, mode='r+b' if done else 'wb') as f:
+        f.truncate(size)
+
+    offsets = [x for x in range(0, size, CHUNK_SIZE) if x not in done]
+    lock = threading.Lock()
+
+    def fetch(offset: int):
+        end = min(offset + CHUNK_SIZE, size) - 1
+        # pin the generation so a concurrent upload cannot mix two versions
+        data = blob.download_as_bytes(start=offset, end=end, if_generation_match=blob.generation)
+        with open(part, mode='r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        with lock:
+            done.add(offset)
+            _save_progress(progress_file, blob.generation, size, done)
+
+    workers = max_workers if size > PARALLEL_THRESHOLD else 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(fetch, offsets))
+
+    if not same_content(part, blob):
+        for file in (part, progress_file):
+            if os.path.exists(file):
+                os.remove(file)
+        raise ChecksumError(f"checksum mismatch downloading {blob_name}")
+
+    os.replace(part, path)
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+    return True
@@ -0,0 +1,39 @@
+import json
+
+import numpy as np
+import pytest
+
+from pycollector import batch_export, core
+
+
+@pytest.fixture
+def index(tmp_path):
+    ids = [f"id{x}" for x in range(5)]
+    path = tmp_path.joinpath("datapoints.bin")
+    np.arange(5 * core.DIMENSION, dtype=np.float32).tofile(path)
+    return ids, str(path)
+
+
+def test_export_writes_the_shards_in_order(index, tmp_path):
+    ids, datapoints_path = index
+    output = tmp_path.joinpath("export")
+    output.mkdir()
+    output.joinpath("shard-00009.json").write_text("stale")
+
+    rows, deleted, _ = batch_export.select_rows(ids, datapoints_path, since_id="id1")
+    files = batch_export.export(ids, datapoints_path, str(output), rows, ["gone"], shard_rows=2, workers=2)
+
+    assert [x.name for x in files] == ["shard-00000.json", "shard-00001.json", "delete.txt"]
+    assert sorted(x.name for x in output.glob("shard-*")) == ["shard-00000.json", "shard-00001.json"]
+    records = [json.loads(line) for x in files[:2] for line in x.read_text().splitlines()]
+    assert [x["id"] for x in records] == ["id2", "id3", "id4"]
+    assert records[0]["embedding"][0] == 2 * core.DIMENSION
+    assert len(records[0]["embedding"]) == core.DIMENSION
+    assert output.joinpath("delete", "delete.txt").read_text() == "gone\n"
+
+
+def test_unknown_since_id(index):
+    ids, datapoints_path = index
+
+    with pytest.raises(ValueError, match="missing is not in the index"):
+        batch_export.select_rows(ids, datapoints_path, since_id="missing")
@@ -0,0 +1,46 @@
+import socket
+import threading
+
+import pytest
+
+from pycollector import client
+
+
+def _server(handle):
+    server = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            handle(conn)
+        server.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def test_closed_connection_raises_serve_error():
+    port = _server(lambda conn: conn.recv(65536))
+
+    with pytest.raises(client.ServeError):
+        client.request({"command": "vectorize", "file": "a"}, port=port, unix="")
+
+
+def test_stalled_server_times_out(monkeypatch):
+    monkeypatch.setattr(client, "READ_TIMEOUT", 0.2)
+    stop = threading.Event()
+    port = _server(lambda conn: stop.wait(5))
+
+    try:
+        with pytest.raises(client.ServeError, match="timed out"):
+            client.request({"command": "vectorize", "file": "a"}, port=port, unix="")
+    finally:
+        stop.set()
+
+
+def test_no_server_returns_none():
+    server = socket.create_server(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    server.close()
+
+    assert client.request({"command": "vectorize", "file": "a"}, port=port, unix="") is None
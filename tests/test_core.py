@@ -0,0 +1,56 @@
+import os
+import threading
+
+from pycollector import core
+from pycollector.fakes import LocalBucket
+
+
+def test_concurrent_downloads_of_the_same_image(tmp_path, monkeypatch):
+    bucket = LocalBucket(tmp_path.joinpath("bucket"))
+    bucket.blob("item.png").upload_from_string(b"png data")
+    monkeypatch.setattr(core, "BUCKET", bucket)
+    monkeypatch.chdir(tmp_path)
+
+    barrier = threading.Barrier(4)
+    seen = []
+
+    def download():
+        with core.DownloadOrLocalImage("item") as filename:
+            barrier.wait()
+            with open(filename, mode='rb') as f:
+                seen.append((filename, f.read()))
+            barrier.wait()
+
+    threads = [threading.Thread(target=download) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({filename for filename, _ in seen}) == 4
+    assert all(data == b"png data" for _, data in seen)
+    assert not any(os.path.exists(filename) for filename, _ in seen)
+
+
+def test_local_image_is_kept(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("local.png").write_bytes(b"png data")
+
+    with core.DownloadOrLocalImage("local.png") as filename:
+        assert filename == "local.png"
+    assert tmp_path.joinpath("local.png").exists()
+
+
+def test_stream_query_pages_in_timestamp_order():
+    from pycollector.fakes import MemoryDatabase
+
+    database = MemoryDatabase({
+        f"items/{_id}": {"timestamp": timestamp, "name": _id}
+        for _id, timestamp in [("c", 2), ("a", 1), ("b", 2), ("d", 3), ("e", 0)]
+    })
+    query = database.collection("items").order_by("timestamp").select(["timestamp"])
+
+    ids = [x.id for x in core.stream_query(query, page_size=2)]
+
+    assert ids == ["e", "a", "b", "c", "d"]
+    assert core.count_query(query) == 5
@@ -0,0 +1,10 @@
+from pycollector.fakes import SlowAnnotator
+
+
+def test_slow_annotator_returns_the_canned_texts(tmp_path):
+    path = tmp_path.joinpath("image.png")
+    path.write_bytes(b"png data")
+
+    annotator = SlowAnnotator(texts=["pin", "gallery"])
+
+    assert annotator.detect_text(str(path)) == ["pin", "gallery"]
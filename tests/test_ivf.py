@@ -0,0 +1,40 @@
+import numpy as np
+
+from pycollector import ivf, search
+
+
+def _index(count: int = 300, nlist: int = 8):
+    rng = np.random.default_rng(0)
+    datapoints = rng.random((count, 16), dtype=np.float32)
+    ids = [f"id{x}" for x in range(count)]
+    return ids, datapoints, ivf.IVFIndex.build(ids, datapoints, nlist)
+
+
+def test_probing_every_list_is_exact():
+    ids, datapoints, index = _index()
+    queries = datapoints[:5] + 0.01
+    mask = np.ones(len(ids), dtype=bool)
+    mask[1] = False
+
+    distances, rows = index.search(queries, datapoints, 10, index.nlist, mask)
+    expected_distances, expected_rows = search.ExactSearch(datapoints).search(queries, 10, mask)
+
+    assert (rows == expected_rows).all()
+    assert np.allclose(distances, expected_distances, atol=1e-4)
+
+
+def test_load_for_checks_the_ids_once_per_stamp(tmp_path, monkeypatch, capsys):
+    ids, _, index = _index()
+    path = str(tmp_path.joinpath("ivf.npz"))
+    index.save(path)
+    digests = []
+    digest = ivf._ids_digest
+    monkeypatch.setattr(ivf, "_ids_digest", lambda x: digests.append(x) or digest(x))
+
+    for _ in range(3):
+        assert ivf.load_for(ids, path, ids_stamp=("ids", 1)) is not None
+    assert len(digests) == 1
+
+    for _ in range(3):
+        assert ivf.load_for(ids[1:], path, ids_stamp=("ids", 2)) is None
+    assert capsys.readouterr().out.count("outdated") == 1
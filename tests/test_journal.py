@@ -0,0 +1,53 @@
+import numpy as np
+
+from pycollector import core, journal
+
+
+def _write(ids):
+    with journal.JournaledIndexWriter(checkpoint_every=1) as writer:
+        for x, _id in enumerate(ids):
+            writer.append(_id, np.full(core.DIMENSION, x, dtype=np.float32))
+
+
+def test_repair_truncates_a_partial_row(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _write(["a", "b", "c"])
+
+    # interrupted between the datapoints and the id of the fourth row
+    with open(core.DATAPOINTS_FILE, mode='ab') as f:
+        f.write(np.zeros(core.DIMENSION // 2, dtype=np.float32).tobytes())
+    with open(core.IDS_FILE, mode='a') as f:
+        f.write("d")
+
+    assert journal.repair() == 3
+    assert core.load_ids() == ["a", "b", "c"]
+    assert core.load_datapoints()[:, 0].tolist() == [0, 1, 2]
+    assert journal.read_checkpoint() == {"rows": 3, "last_id": "c"}
+
+
+def test_no_warning_after_rewriting_the_ids(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    _write(["a", "b", "c"])
+
+    datapoints = core.load_datapoints()
+    core.write_datapoints(datapoints[:2])
+    core.write_ids(["a", "b"])
+
+    assert journal.repair() == 2
+    assert "Warning" not in capsys.readouterr().out
+
+
+def test_update_refuses_a_torn_index_without_resume(tmp_path, monkeypatch, capsys):
+    from argparse import Namespace
+    from pycollector.commands.local_index import LocalIndex
+
+    monkeypatch.chdir(tmp_path)
+    _write(["a", "b"])
+    with open(core.DATAPOINTS_FILE, mode='ab') as f:
+        f.write(b"\0" * 16)
+
+    namespace = Namespace(resume=False, override=False, update_text=False, checkpoint_every=25)
+    LocalIndex().update(namespace)
+
+    assert "Use --resume" in capsys.readouterr().out
+    assert core.load_ids() == ["a", "b"]
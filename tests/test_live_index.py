@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from pycollector import core, live_index, segments
+from pycollector.fakes import LocalBucket, MemoryDatabase
+
+ITEMS = "Users/rTw4N7tjtaxOR6y0YC98/items"
+
+
+def _timestamp(day: int) -> datetime:
+    return datetime(2024, 1, day, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(core, "BUCKET", LocalBucket(tmp_path.joinpath("bucket")))
+    database = MemoryDatabase({
+        f"{ITEMS}/{_id}": {"timestamp": _timestamp(day)}
+        for _id, day in [("a", 1), ("b", 2), ("c", 3)]
+    })
+    monkeypatch.setattr(core, "FIRESTORE_DB", database)
+    return database
+
+
+@pytest.fixture
+def failing(monkeypatch):
+    """Ids that can't be vectorized, the others are written without the model."""
+    failing = set()
+
+    def append_items(writer, items, update_text=False, total="?"):
+        for item in items:
+            if item.id in failing:
+                raise RuntimeError("download failed")
+            writer.append(item.id, np.full(core.DIMENSION, ord(item.id), dtype=np.float32))
+
+    monkeypatch.setattr(core, "append_items", append_items)
+    return failing
+
+
+def _change(database, kind, _id):
+    return kind, database.document(f"{ITEMS}/{_id}").get()
+
+
+def test_added_and_removed_items(database, failing):
+    indexer = live_index.LiveIndexer(segments.SegmentedIndex())
+
+    assert indexer.process([_change(database, "ADDED", x) for x in ("b", "a")]) == (2, 0)
+    assert indexer.index.live()[0] == ["a", "b"]
+    assert indexer.index.last_id == "b"
+
+    removed = _change(database, "REMOVED", "a")
+    database.document(f"{ITEMS}/a").delete()
+    assert indexer.process([removed, _change(database, "ADDED", "c")]) == (1, 1)
+    assert indexer.index.live()[0] == ["b", "c"]
+    assert indexer.indexed == {"b", "c"}
+
+
+def test_retried_items_keep_the_last_id(database, failing):
+    indexer = live_index.LiveIndexer(segments.SegmentedIndex())
+    failing.add("a")
+
+    assert indexer.process([_change(database, "ADDED", x) for x in ("a", "b")]) == (1, 0)
+    assert set(indexer.failed) == {"a"}
+    assert indexer.index.last_id == "b"
+
+    failing.clear()
+    assert indexer.process([]) == (1, 0)
+    assert not indexer.failed
+    assert indexer.index.last_id == "b"
+    assert indexer._read_state()["last_id"] == "b"
+    assert indexer._start_timestamp() == _timestamp(2)
+
+
+def test_listener_error_unsubscribes_the_watch(database, failing):
+    indexer = live_index.LiveIndexer(segments.SegmentedIndex(), batch_delay=0)
+
+    class Watch:
+        is_active = True
+        unsubscribed = False
+
+        def unsubscribe(self):
+            self.unsubscribed = True
+
+    def collect():
+        indexer.stop()
+        raise RuntimeError("stream closed")
+
+    watch = indexer.watch = Watch()
+    indexer._collect = collect
+    indexer._run()
+
+    assert watch.unsubscribed
+    assert indexer.watch is None
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from pycollector import remote_sync
+from pycollector.fakes import FakeIndexServiceClient, FakeQuotaExceeded
+
+
+INDEX = "projects/test/indexes/1"
+
+
+def _datapoints(count: int) -> np.ndarray:
+    return np.arange(count * 4, dtype=np.float32).reshape(count, 4)
+
+
+def test_compute_diff_only_returns_the_changes():
+    ids = ["a", "b", "c"]
+    datapoints = _datapoints(3)
+    _, _, hashes = remote_sync.compute_diff(ids, datapoints, {})
+
+    datapoints[1] += 1
+    synced = {**hashes, "gone": "0"}
+    to_upsert, to_remove, _ = remote_sync.compute_diff(ids, datapoints, synced)
+
+    assert to_upsert == [1]
+    assert to_remove == ["gone"]
+
+
+def test_sync_pushes_the_diff_to_the_fake_client(tmp_path):
+    manifest = tmp_path.joinpath("manifest.json")
+    ids = ["a", "b", "c"]
+    datapoints = _datapoints(3)
+    _, _, hashes = remote_sync.compute_diff(ids[:2], datapoints[:2], {})
+    remote_sync.save_manifest(str(manifest), INDEX, {**hashes, "gone": "0"})
+    client = FakeIndexServiceClient()
+
+    upserted, removed = remote_sync.sync(client, INDEX, ids, datapoints, str(manifest), batch_size=1)
+
+    assert (upserted, removed) == (1, 1)
+    assert list(client.datapoints) == ["c"]
+    assert sorted(client.calls) == [("remove", 1), ("upsert", 1)]
+    # the fake never reached the real index
+    assert remote_sync.load_manifest(str(manifest), INDEX) == {**hashes, "gone": "0"}
+
+
+def test_sync_retries_the_quota_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(remote_sync.time, "sleep", lambda _: None)
+    client = FakeIndexServiceClient(fail_every=2)
+
+    upserted, _ = remote_sync.sync(
+        client, INDEX, ["a", "b"], _datapoints(2), str(tmp_path.joinpath("manifest.json")),
+        batch_size=1, requests_per_minute=60000, concurrency=1
+    )
+
+    assert upserted == 2
+    assert sorted(client.datapoints) == ["a", "b"]
+
+
+def test_sync_gives_up_after_the_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(remote_sync.time, "sleep", lambda _: None)
+    client = FakeIndexServiceClient(fail_every=1)
+
+    with pytest.raises(FakeQuotaExceeded):
+        remote_sync.sync(
+            client, INDEX, ["a"], _datapoints(1), str(tmp_path.joinpath("manifest.json")),
+            requests_per_minute=60000, max_retries=2
+        )
+    assert len(client.calls) == 3
+
+
+def test_manifest_of_another_index_is_ignored(tmp_path):
+    manifest = str(tmp_path.joinpath("manifest.json"))
+    remote_sync.save_manifest(manifest, INDEX, {"a": "0"})
+
+    assert remote_sync.load_manifest(manifest, INDEX) == {"a": "0"}
+    assert remote_sync.load_manifest(manifest, "projects/test/indexes/2") == {}
@@ -0,0 +1,70 @@
+from argparse import Namespace
+
+import numpy as np
+import pytest
+
+from pycollector import core, segments
+from pycollector.fakes import LocalBucket
+
+
+def _vectors(*values: float) -> np.ndarray:
+    return np.array([np.full(core.DIMENSION, x, dtype=np.float32) for x in values])
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(core, "BUCKET", LocalBucket(tmp_path.joinpath("bucket")))
+    return segments.SegmentedIndex()
+
+
+def test_search_returns_the_most_recent_copy_once(index):
+    index.add(["a", "b"], _vectors(0, 1))
+    index.add(["b", "c"], _vectors(5, 2))
+
+    found = index.search(_vectors(1.5), 3)[0]
+
+    assert [x for x, _ in found] == ["c", "a", "b"]
+    assert found[2][1] == pytest.approx(3.5 * core.DIMENSION ** 0.5)
+    assert len(index) == 3
+    assert index.live()[0] == ["a", "b", "c"]
+    assert float(index.get_vector("b")[0]) == 5
+
+
+def test_merge_keeps_the_rows_in_order(index, monkeypatch):
+    monkeypatch.setattr(segments, "MERGE_FACTOR", 2)
+    for x in range(3):
+        index.add([f"id{x}"], _vectors(x))
+    index.delete(["id1"])
+
+    assert index.merge()
+    assert len(index.segments) == 1
+    assert index.live()[0] == ["id0", "id2"]
+
+    first = index.segments[0]
+    index.add(["id3"], _vectors(3))
+    second = index.segments[-1]
+    index.add(["id4"], _vectors(4))
+    with pytest.raises(ValueError):
+        index.merge([first, index.segments[-1]])
+    assert index.merge([first, second])
+
+
+def test_local_index_remove_tombstones_the_segments(index):
+    from pycollector.commands.local_index import LocalIndex
+
+    index.add(["a", "b"], _vectors(0, 1))
+
+    LocalIndex().run(Namespace(subcommand="remove", datapoints=["a"]))
+
+    index.refresh()
+    assert index.live()[0] == ["b"]
+
+
+def test_local_writers_refuse_the_segmented_index(index, capsys):
+    assert not segments.refuse_local_writes("rebuild-with-text")
+
+    index.add(["a"], _vectors(0))
+
+    assert segments.refuse_local_writes("rebuild-with-text")
+    assert "segment-index" in capsys.readouterr().out
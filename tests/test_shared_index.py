@@ -0,0 +1,39 @@
+import threading
+
+import numpy as np
+
+from pycollector import core, shared_index
+
+
+def test_concurrent_reads_during_reloads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    core.write_datapoints(np.ones((4, core.DIMENSION), dtype=np.float32))
+    core.write_ids(["a", "b", "c", "d"])
+    publisher = shared_index.SharedIndexPublisher()
+    publisher.publish()
+    reader = shared_index.SharedIndexReader(publisher)
+    errors = []
+    stopped = threading.Event()
+
+    def read():
+        while not stopped.is_set():
+            try:
+                _, ids, engine, _ = reader.get()
+                assert len(ids) == len(engine) == 4
+                assert float(engine.datapoints[3].sum()) == core.DIMENSION
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    try:
+        for thread in threads:
+            thread.start()
+        for _ in range(20):
+            publisher.publish()
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+        publisher.close()
+
+    assert not errors
@@ -0,0 +1,49 @@
+import json
+import time
+
+import numpy as np
+
+from pycollector import shm_transport
+
+
+def test_small_arrays_are_sent_inline():
+    responses = shm_transport.ShmResponses()
+    vector = np.arange(1280, dtype=np.float32)
+
+    data = json.loads(responses.encode({"vector": vector}))
+
+    assert data == {"vector": vector.tolist()}
+    assert not responses._pending
+
+
+def test_large_arrays_go_through_shared_memory():
+    responses = shm_transport.ShmResponses(threshold=1024)
+    vectors = np.arange(4 * 1280, dtype=np.float32).reshape(4, 1280)
+
+    data = json.loads(responses.encode({"vectors": vectors, "count": 4}))
+
+    assert "shm" in data["vectors"]
+    decoded = shm_transport.decode(data)
+    assert decoded["count"] == 4
+    assert (decoded["vectors"] == vectors).all()
+    responses.close()
+
+
+def test_unclaimed_blocks_expire_on_a_timer():
+    responses = shm_transport.ShmResponses(threshold=200, ttl=0.2)
+    name = json.loads(responses.encode({"vector": np.ones(64, dtype=np.float32)}))["vector"]["shm"]
+
+    # the timer drops the block from the pending list before unlinking it
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            shm = shm_transport.shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            break
+        shm.close()
+        time.sleep(0.05)
+    else:
+        raise AssertionError(f"{name} was not unlinked")
+
+    assert not responses._pending
+    responses.close()
@@ -0,0 +1,56 @@
+import pytest
+
+from pycollector import transfer
+from pycollector.fakes import LocalBlob, LocalBucket
+
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "CHUNK_SIZE", 100)
+    bucket = LocalBucket(tmp_path.joinpath("bucket"))
+    bucket.blob("embeddings/datapoints.bin").upload_from_string(DATA)
+    return bucket
+
+
+def test_skip_when_the_checksum_matches(bucket, tmp_path):
+    path = tmp_path.joinpath("datapoints.bin")
+    path.write_bytes(DATA)
+
+    assert not transfer.download_file(bucket, "embeddings/datapoints.bin", str(path))
+    assert not transfer.upload_file(bucket, str(path), "embeddings/datapoints.bin")
+
+    path.write_bytes(DATA[::-1])
+    assert transfer.upload_file(bucket, str(path), "embeddings/datapoints.bin")
+    assert bucket.blob("embeddings/datapoints.bin").path.read_bytes() == DATA[::-1]
+
+
+def test_resume_an_interrupted_download(bucket, tmp_path, monkeypatch):
+    path = tmp_path.joinpath("datapoints.bin")
+    download = LocalBlob.download_as_bytes
+    calls = []
+    failing = {300}
+
+    def interrupted(self, start=None, end=None, **kwargs):
+        calls.append(start)
+        if start in failing:
+            raise ConnectionError("interrupted")
+        return download(self, start, end, **kwargs)
+
+    monkeypatch.setattr(LocalBlob, "download_as_bytes", interrupted)
+    with pytest.raises(ConnectionError):
+        transfer.download_file(bucket, "embeddings/datapoints.bin", str(path))
+    assert not path.exists()
+    first = set(calls) - failing
+    assert {0, 100, 200} <= first
+
+    failing.clear()
+    calls.clear()
+    assert transfer.download_file(bucket, "embeddings/datapoints.bin", str(path))
+    assert path.read_bytes() == DATA
+    # the slices of the first attempt are not downloaded again
+    assert 300 in calls
+    assert not first & set(calls)
+    assert not tmp_path.joinpath("datapoints.bin.part.json").exists()